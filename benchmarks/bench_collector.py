@@ -0,0 +1,260 @@
+"""Collector benchmarks with JSON baselines
+
+    python benchmarks/bench_collector.py                     # run all, compare with baseline.json
+    python benchmarks/bench_collector.py --only emit,fleet   # run some
+    python benchmarks/bench_collector.py --update-baseline   # accept the current numbers
+
+Exits with status 1 when a result is worse than the baseline by more than
+--tolerance, so it can gate a rollout. Baselines are only comparable on the
+same machine; refresh them when the hardware changes.
+"""
+import argparse
+import datetime
+import json
+import logging
+import os
+import platform
+import statistics
+import sys
+import time
+import tracemalloc
+
+from harness import DogStatsdSink, StubDishServer, load_fixture, make_collector, percentile, prime
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+
+def throughput(func, seconds=1.0):
+    """Calls of func per second, over at least the given wall time"""
+    calls = 0
+    started = time.perf_counter()
+    deadline = started + seconds
+    while True:
+        for _ in range(100):
+            func()
+        calls += 100
+        now = time.perf_counter()
+        if now >= deadline:
+            return calls / (now - started)
+
+def result(value, unit, better):
+    return {"value": round(value, 4), "unit": unit, "better": better}
+
+def emit_cycle(collector):
+    """The body of run() for one emit: every target's cycle, then the flush"""
+    for target in collector.targets:
+        collector.collect_cycle(target)
+        if collector.adaptive_probing:
+            collector.adapt_probe_rate(target)
+    collector.emitter.flush()
+
+def bench_parse(stub):
+    """Per-probe processing: RTT burst statistics and HTTP timing derivation"""
+    results = {}
+    with DogStatsdSink() as sink:
+        collector = make_collector(sink)
+        bursts = load_fixture("ping_bursts.json")
+        index = [0]
+
+        def summarize():
+            burst = bursts[index[0] % len(bursts)]
+            index[0] += 1
+            collector.summarize_ping_samples(burst["rtts"], burst["sent"], len(burst["rtts"]))
+
+        target = collector.targets[0]
+        results["parse.ping_summaries_per_s"] = result(throughput(summarize), "1/s", "higher")
+        results["parse.ping_probes_per_s"] = result(
+            throughput(lambda: collector.get_enhanced_ping_metrics(target)), "1/s", "higher"
+        )
+        results["parse.http_derivations_per_s"] = result(
+            throughput(lambda: collector.get_http_performance_metrics(target.ip)), "1/s", "higher"
+        )
+
+        # Real keep-alive pool and timing probe against the stub dish: one cold and one warm request
+        collector = make_collector(sink, fixture_http=False, STARLINK_IP=f"127.0.0.1:{stub.port}")
+        samples = []
+        for _ in range(200):
+            started = time.perf_counter()
+            collector.get_http_performance_metrics()
+            samples.append((time.perf_counter() - started) * 1000)
+        results["parse.http_stub_probe_ms_p50"] = result(statistics.median(samples), "ms", "lower")
+        collector.http_pool.close()
+        collector.scheduler.shutdown()
+    return results
+
+def bench_cycle(stub):
+    """Latency of one emit for a single target whose probes have all reported"""
+    with DogStatsdSink() as sink:
+        collector = make_collector(sink, STARLINK_IP=f"127.0.0.1:{stub.port}")
+        prime(collector)
+        emit_cycle(collector)
+        sink.wait_for(1)
+        sink.reset()
+        datagrams = collector.emitter.datagrams_sent
+        samples = []
+        for _ in range(300):
+            started = time.perf_counter()
+            emit_cycle(collector)
+            samples.append((time.perf_counter() - started) * 1000)
+        lines = sink.wait_for(10 ** 9, timeout=1.0) / len(samples)
+        collector.scheduler.shutdown()
+        return {
+            "cycle.latency_ms_p50": result(statistics.median(samples), "ms", "lower"),
+            "cycle.latency_ms_p99": result(percentile(samples, 99), "ms", "lower"),
+            "cycle.lines_per_cycle": result(lines, "lines", "lower"),
+            "cycle.datagrams_per_cycle": result((collector.emitter.datagrams_sent - datagrams) / len(samples), "datagrams", "lower"),
+        }
+
+def bench_emit():
+    """Raw emitter throughput into the sink over UDP and the Unix socket"""
+    results = {}
+    for transport, unix in (("udp", False), ("uds", True)):
+        with DogStatsdSink(unix=unix) as sink:
+            collector = make_collector(sink)
+            emitter = collector.emitter
+            tag_suffix = collector.targets[0].tag_suffix
+            lines = 200000
+            started = time.perf_counter()
+            for i in range(lines):
+                emitter.metric("starlink.ping_avg_ms", 27.5 + i % 10, tag_suffix=tag_suffix)
+            emitter.flush()
+            elapsed = time.perf_counter() - started
+            received = sink.wait_for(lines)
+            if sink.malformed:
+                raise RuntimeError(f"sink could not parse {sink.malformed[:3]}")
+            results[f"emit.{transport}_lines_per_s"] = result(lines / elapsed, "1/s", "higher")
+            results[f"emit.{transport}_packets_per_s"] = result(emitter.datagrams_sent / elapsed, "1/s", "higher")
+            results[f"emit.{transport}_delivered_pct"] = result(received / lines * 100, "%", "higher")
+            collector.scheduler.shutdown()
+    return results
+
+def bench_fleet(stub, targets):
+    """Many simulated terminals: time to the first complete round and per-emit cost per target
+
+    Costs are divided by the target count so baselines taken with a different
+    --fleet-targets stay comparable; the count itself is recorded as a parameter.
+    Memory is the Python heap each added target holds after the first emit:
+    tracemalloc compares the fleet with a one-target collector, so neither the
+    collector's fixed allocations nor allocator noise in the RSS show up.
+    """
+    with DogStatsdSink(parse=False) as sink:
+        heaps = []
+        for count in (1, targets):
+            spec = ",".join(f"127.0.{1 + i // 250}.{1 + i % 250}:{stub.port} site:bench-{i}" for i in range(count))
+            tracemalloc.start()
+            collector = make_collector(sink, STARLINK_TARGETS=spec, PING_INTERVAL="5", HTTP_INTERVAL="5")
+            started = time.perf_counter()
+            # First runs are staggered across each interval; the daily speed test is left out
+            prime(collector, kinds=("ping", "http"), timeout=60)
+            primed = time.perf_counter() - started
+            emit_cycle(collector)
+            heaps.append(tracemalloc.get_traced_memory()[0])
+            tracemalloc.stop()
+            if count < targets:
+                collector.scheduler.shutdown()
+
+        datagrams = collector.emitter.datagrams_sent
+        wall, cpu = [], []
+        for _ in range(5):
+            wall_start, cpu_start = time.perf_counter(), time.thread_time()
+            emit_cycle(collector)
+            wall.append((time.perf_counter() - wall_start) * 1000)
+            cpu.append((time.thread_time() - cpu_start) * 1000)
+        collector.scheduler.shutdown()
+        return {
+            "fleet.first_round_s": result(primed, "s", "lower"),
+            "fleet.cycle_us_per_target_p50": result(statistics.median(wall) * 1000 / targets, "us", "lower"),
+            "fleet.cycle_cpu_us_per_target_p50": result(statistics.median(cpu) * 1000 / targets, "us", "lower"),
+            "fleet.datagrams_per_target": result((collector.emitter.datagrams_sent - datagrams) / len(wall) / targets, "datagrams", "lower"),
+            "fleet.heap_kb_per_target": result((heaps[1] - heaps[0]) / 1024 / max(1, targets - 1), "KB", "lower"),
+        }
+
+def best_of(repeat, bench, *args):
+    """Run a benchmark group repeat times and keep the best value of each result"""
+    runs = [bench(*args) for _ in range(repeat)]
+    best = {}
+    for name, first in runs[0].items():
+        values = [run[name]["value"] for run in runs]
+        best[name] = {**first, "value": max(values) if first["better"] == "higher" else min(values)}
+    return best
+
+def compare(results, baseline, tolerance):
+    """Print results against the baseline; return the names that regressed"""
+    regressions = []
+    print(f"{'benchmark':40} {'value':>14} {'baseline':>14} {'change':>8}")
+    for name, current in results.items():
+        base = baseline.get(name)
+        line = f"{name:40} {current['value']:>14.4g}"
+        if base and base["value"]:
+            change = (current["value"] - base["value"]) / base["value"]
+            line += f" {base['value']:>14.4g} {change:>+8.1%}"
+            worse = -change if current["better"] == "higher" else change
+            if worse > tolerance:
+                regressions.append(name)
+                line += "  REGRESSION"
+        print(f"{line}  {current['unit']}")
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the Starlink collector")
+    parser.add_argument("--only", default="parse,cycle,emit,fleet", help="comma-separated benchmark groups")
+    parser.add_argument("--fleet-targets", type=int, default=200)
+    parser.add_argument("--repeat", type=int, default=3, help="runs per group, best result kept (fleet runs once)")
+    parser.add_argument("--baseline", default=BASELINE)
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed fractional slowdown before failing")
+    parser.add_argument("--update-baseline", action="store_true", help="write the results as the new baseline")
+    parser.add_argument("--output", help="also write the results to this JSON file")
+    args = parser.parse_args(argv)
+
+    # Per-cycle INFO logging would dominate the measurements
+    logging.getLogger("starlink_collector").setLevel(logging.WARNING)
+    groups = [group.strip() for group in args.only.split(",")]
+    results = {}
+    with StubDishServer() as stub:
+        if "parse" in groups:
+            results.update(best_of(args.repeat, bench_parse, stub))
+        if "cycle" in groups:
+            results.update(best_of(args.repeat, bench_cycle, stub))
+        if "emit" in groups:
+            results.update(best_of(args.repeat, bench_emit))
+        if "fleet" in groups:
+            results.update(bench_fleet(stub, args.fleet_targets))
+
+    report = {
+        "created": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+        "machine": {"python": platform.python_version(), "platform": platform.platform(), "cpus": os.cpu_count()},
+        "parameters": {"fleet_targets": args.fleet_targets} if "fleet" in groups else {},
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+    baseline = {}
+    if os.path.exists(args.baseline) and not args.update_baseline:
+        with open(args.baseline) as f:
+            stored = json.load(f)
+        baseline = stored["results"]
+        fleet_targets = stored.get("parameters", {}).get("fleet_targets")
+        if "fleet" in groups and fleet_targets not in (None, args.fleet_targets):
+            print(f"Baseline fleet ran {fleet_targets} targets, this run {args.fleet_targets}; fleet costs are per target")
+    regressions = compare(results, baseline, args.tolerance)
+
+    if args.update_baseline:
+        if os.path.exists(args.baseline):
+            with open(args.baseline) as f:
+                previous = json.load(f)
+            # Keep the groups that were not run; drop every old result of the ones that were
+            kept = {name: value for name, value in previous["results"].items() if name.split(".", 1)[0] not in groups}
+            report["parameters"] = {**previous.get("parameters", {}), **report["parameters"]}
+            report["results"] = {**kept, **results}
+        with open(args.baseline, "w") as f:
+            json.dump(report, f, indent=2)
+            f.write("\n")
+        print(f"Baseline written to {args.baseline}")
+    elif regressions:
+        print(f"{len(regressions)} regression(s) beyond {args.tolerance:.0%}: {', '.join(regressions)}")
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
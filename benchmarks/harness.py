@@ -0,0 +1,256 @@
+"""Fakes and fixtures for benchmarking the collector without a dish or a Datadog agent
+
+FixtureProber and FixtureHttpProbe replay recorded probe results, StubDishServer
+stands in for the dish's web UI and DogStatsdSink receives and parses what the
+collector emits over UDP or a Unix datagram socket.
+"""
+import contextlib
+import http.server
+import itertools
+import json
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import starlink_collector  # noqa: E402
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+def load_fixture(name):
+    with open(os.path.join(FIXTURES, name)) as f:
+        return json.load(f)
+
+class FixtureProber:
+    """Drop-in for IcmpProber.burst() that cycles through recorded RTT bursts"""
+    mode = "fixture"
+
+    def __init__(self, bursts=None):
+        self.bursts = itertools.cycle(bursts or load_fixture("ping_bursts.json"))
+        self.lock = threading.Lock()
+
+    def burst(self, host, count, interval, timeout):
+        with self.lock:
+            burst = next(self.bursts)
+        return list(burst["rtts"]), burst["sent"], len(burst["rtts"])
+
+    def close(self):
+        pass
+
+class FixtureHttpProbe:
+    """Drop-in for HttpTimingProbe.measure() that alternates recorded cold and warm timings"""
+    NOT_REUSED = {"reused": False, "dns": 0.0, "connect": 0.0, "tls": 0.0, "starttransfer": 0.0, "total": 0.0, "size": 0, "status": 0}
+
+    def __init__(self, timings=None):
+        self.timings = itertools.cycle(timings or load_fixture("http_timings.json"))
+        self.lock = threading.Lock()
+        self.warm = {}
+
+    def measure(self, url, fresh=False, max_duration=None):
+        with self.lock:
+            if fresh:
+                entry = next(self.timings)
+                self.warm[url] = entry["warm"]
+                return dict(entry["cold"])
+            return dict(self.warm.pop(url, self.NOT_REUSED))
+
+class StubDishServer:
+    """Threaded HTTP server on 0.0.0.0:<ephemeral port> serving a page like the dish's UI
+
+    Any 127.x.y.z address reaches it, so fleet targets can be simulated as
+    127.0.1.1:<port>, 127.0.1.2:<port> and so on.
+    """
+
+    def __init__(self, body_size=1842):
+        body = (b"<html><head><title>Starlink</title></head><body>" + b"x" * body_size)[:body_size]
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # Headers and body go out in separate writes; Nagle would hold the body for a delayed ACK
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                self.send_response(200)
+                self.send_header("Content-Type", "text/html")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = http.server.ThreadingHTTPServer(("0.0.0.0", 0), Handler)
+        self.server.daemon_threads = True
+        self.port = self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever, name="stub-dish", daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+class DogStatsdSink:
+    """Receives DogStatsD datagrams over UDP or a Unix datagram socket and parses every line
+
+    Counts datagrams, bytes and lines by kind (metric, service check, event)
+    and records any line that does not parse in malformed. With parse=False
+    only datagrams and bytes are counted, to keep the sink's own CPU use low.
+    """
+
+    def __init__(self, unix=False, parse=True):
+        self.unix = unix
+        self.parsing = parse
+        if unix:
+            self.directory = tempfile.mkdtemp(prefix="dsd-sink-")
+            self.address = os.path.join(self.directory, "dsd.socket")
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            self.sock.bind(self.address)
+        else:
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.sock.bind(("127.0.0.1", 0))
+            self.address = self.sock.getsockname()
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 8 * 1024 * 1024)
+        self.sock.settimeout(0.2)
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.reset()
+        self.thread = threading.Thread(target=self._loop, name="dsd-sink", daemon=True)
+
+    def reset(self):
+        with self.lock:
+            self.datagrams = 0
+            self.bytes = 0
+            self.metrics = 0
+            self.service_checks = 0
+            self.events = 0
+            self.malformed = []
+
+    def env(self):
+        """Environment variables that point the collector at this sink"""
+        if self.unix:
+            return {"DD_DOGSTATSD_SOCKET": self.address}
+        return {"DATADOG_HOST": self.address[0], "DATADOG_PORT": str(self.address[1])}
+
+    def _loop(self):
+        while not self.stopped.is_set():
+            try:
+                data = self.sock.recv(65536)
+            except socket.timeout:
+                continue
+            except OSError:
+                return
+            counts = [0, 0, 0]
+            bad = []
+            for line in data.split(b"\n") if self.parsing else ():
+                kind = self.parse(line)
+                if kind is None:
+                    bad.append(line)
+                else:
+                    counts[kind] += 1
+            with self.lock:
+                self.datagrams += 1
+                self.bytes += len(data)
+                self.metrics += counts[0]
+                self.service_checks += counts[1]
+                self.events += counts[2]
+                if len(self.malformed) < 10:
+                    self.malformed.extend(bad[:10 - len(self.malformed)])
+
+    @staticmethod
+    def parse(line):
+        """0 for a metric, 1 for a service check, 2 for an event, None if malformed"""
+        if line.startswith(b"_sc|"):
+            fields = line.split(b"|")
+            return 1 if len(fields) >= 3 and fields[2] in (b"0", b"1", b"2", b"3") else None
+        if line.startswith(b"_e{"):
+            return 2 if b"}:" in line else None
+        name, _, rest = line.partition(b":")
+        fields = rest.split(b"|")
+        if not name or len(fields) < 2 or fields[1] not in (b"g", b"c", b"h", b"d", b"ms", b"s"):
+            return None
+        try:
+            for value in fields[0].split(b":"):
+                float(value)
+        except ValueError:
+            return None
+        return 0
+
+    def wait_for(self, lines, timeout=5.0):
+        """Wait until at least lines metric/check/event lines have arrived; return the count"""
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            with self.lock:
+                received = self.metrics + self.service_checks + self.events
+            if received >= lines:
+                return received
+            time.sleep(0.005)
+        return received
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stopped.set()
+        self.thread.join()
+        self.sock.close()
+        if self.unix:
+            os.unlink(self.address)
+            os.rmdir(self.directory)
+
+@contextlib.contextmanager
+def environment(**values):
+    """Temporarily set environment variables, for collector settings read in __init__"""
+    saved = {name: os.environ.get(name) for name in values}
+    os.environ.update({name: str(value) for name, value in values.items()})
+    try:
+        yield
+    finally:
+        for name, value in saved.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+
+def make_collector(sink, fixture_http=True, **settings):
+    """A collector wired to the sink, with fixture pings (and HTTP timings unless fixture_http=False)"""
+    env = {
+        "CONTINUOUS_PROBE_HZ": "0",
+        "SPEED_INTERVAL": "86400",
+        "SPEED_DURATION": "0.2",
+        "SPEED_OMIT": "0",
+        "SPEED_STREAMS": "1",
+        "COLLECTOR_SELF_METRICS": "false",
+        "ADAPTIVE_PROBING": "false",
+        **sink.env(),
+        **settings,
+    }
+    with environment(**env):
+        collector = starlink_collector.EnhancedStarlinkCollector()
+    prober = FixtureProber()
+    collector.get_prober = lambda: prober
+    if fixture_http:
+        collector.http_probe = FixtureHttpProbe()
+    return collector
+
+def prime(collector, kinds=("ping", "http", "speed"), timeout=30.0):
+    """Run the scheduler until every probe of the given kinds has reported once"""
+    scheduler = collector.scheduler
+    names = [name for name in scheduler.probes if name.split(":", 1)[0] in kinds]
+    scheduler.start()
+    deadline = time.monotonic() + timeout
+    while not all(scheduler.probes[name]["result_time"] is not None for name in names):
+        if time.monotonic() > deadline:
+            raise RuntimeError("probes did not all report in time")
+        scheduler.wait(min(scheduler.dispatch(), 0.05))
+
+def percentile(samples, q):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(q / 100 * len(ordered)))]
@@ -1,16 +1,2639 @@
 import time
-import requests
+import http.client
+import http.server
 import logging
 import os
-import subprocess
+import pstats
 import socket
+import ssl
+import fnmatch
+import argparse
+import bisect
+import contextlib
+import cProfile
+import functools
+import gzip
+import hashlib
+import heapq
 import json
-import re
+import math
+import mmap
+import operator
+import resource
+import select
+import signal
 import statistics
+import struct
+import sys
+import threading
+import tracemalloc
+from array import array
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+try:
+    import numpy as np
+except ImportError:  # only the recompute command needs it
+    np = None
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
 logger = logging.getLogger(__name__)
 
+def _run_profile_hook(hook):
+    """Call a worker's profile hook; a profiler that fails to start must not stop the probing"""
+    try:
+        hook()
+    except Exception as e:
+        logger.warning(f"Profile hook failed: {e}")
+
+class ProbeScheduler:
+    """Runs each probe on its own interval in a thread pool and keeps its latest result
+
+    A probe is never resubmitted while a previous run is still in flight, so a
+    hung probe only ties up its own worker. Results that arrive after the
+    probe's timeout budget are discarded. max_workers caps the number of
+    probes in flight across all targets.
+    """
+
+    def __init__(self, max_workers=None):
+        self.probes = {}
+        self.max_workers = max_workers
+        self.executor = None
+        self.due = []
+        self.running = set()
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        # (probe name, wall seconds, CPU seconds, start lag seconds) per finished run
+        self.timings = deque(maxlen=10000)
+        self.timeouts = 0
+        # Called on the worker thread before each run, see CollectorInstrumentation.profile_thread
+        self.profile_hook = None
+
+    def add_probe(self, name, func, interval, timeout, offset=0.0):
+        """Register a probe; offset delays its first run to spread load across the interval"""
+        self.probes[name] = {
+            "func": func,
+            "interval": interval,
+            "timeout": timeout,
+            "offset": offset,
+            "future": None,
+            "started": None,
+            "due": None,
+            "generation": 0,
+            "overdue": False,
+            "result": None,
+            "result_time": None,
+        }
+
+    def start(self):
+        workers = self.max_workers or max(1, len(self.probes))
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="probe")
+        now = time.monotonic()
+        self.due = [(now + probe["offset"], 0, name) for name, probe in self.probes.items()]
+        heapq.heapify(self.due)
+
+    def shutdown(self):
+        if self.executor:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def _execute(self, name):
+        probe = self.probes[name]
+        # The timeout budget starts when a worker picks the probe up, not while it is queued
+        with self.lock:
+            probe["started"] = time.monotonic()
+            lag = probe["started"] - probe["due"]
+        if self.profile_hook:
+            _run_profile_hook(self.profile_hook)
+        wall_start = time.perf_counter()
+        cpu_start = time.thread_time()
+        try:
+            return probe["func"]()
+        finally:
+            self.timings.append((name, time.perf_counter() - wall_start, time.thread_time() - cpu_start, lag))
+
+    def _on_done(self, name, future):
+        probe = self.probes[name]
+        try:
+            result = future.result()
+        except Exception as e:
+            logger.error(f"Probe {name} failed: {e}")
+            result = None
+        with self.lock:
+            started = probe["started"]
+            probe["future"] = None
+            probe["started"] = None
+            self.running.discard(name)
+            if started is None:
+                return
+            elapsed = time.monotonic() - started
+            if elapsed > probe["timeout"]:
+                self.timeouts += 1
+                logger.warning(f"Probe {name} finished after {elapsed:.1f}s, over its {probe['timeout']}s budget - result discarded")
+            else:
+                probe["result"] = result
+                probe["result_time"] = time.monotonic()
+        self.wakeup.set()
+
+    def dispatch(self):
+        """Submit due probes, flag overdue ones and return seconds until the next probe is due"""
+        now = time.monotonic()
+        submitted = []
+        with self.lock:
+            for name in self.running:
+                probe = self.probes[name]
+                if not probe["overdue"] and probe["started"] is not None and now - probe["started"] > probe["timeout"]:
+                    probe["overdue"] = True
+                    logger.warning(f"Probe {name} exceeded its {probe['timeout']}s budget, other probes continue")
+            
+            while self.due and self.due[0][0] <= now:
+                due_time, generation, name = heapq.heappop(self.due)
+                probe = self.probes[name]
+                if generation != probe["generation"]:
+                    # Superseded by set_interval()
+                    continue
+                # Keep the cadence anchored to the schedule rather than to when we got here
+                next_run = due_time + probe["interval"]
+                if next_run <= now:
+                    next_run = now + probe["interval"]
+                heapq.heappush(self.due, (next_run, generation, name))
+                if probe["future"] is not None:
+                    continue
+                probe["overdue"] = False
+                probe["due"] = due_time
+                probe["future"] = self.executor.submit(self._execute, name)
+                self.running.add(name)
+                submitted.append((name, probe["future"]))
+            next_due = self.due[0][0] - now if self.due else float("inf")
+        # Callbacks take the lock themselves and may run inline if the probe already finished
+        for name, future in submitted:
+            future.add_done_callback(lambda f, n=name: self._on_done(n, f))
+        return max(0.0, next_due)
+
+    def set_interval(self, name, interval, run_now=False):
+        """Change a probe's interval; with run_now the next run is due immediately"""
+        with self.lock:
+            probe = self.probes[name]
+            probe["interval"] = interval
+            if run_now and self.executor is not None:
+                probe["generation"] += 1
+                heapq.heappush(self.due, (time.monotonic(), probe["generation"], name))
+        if run_now:
+            self.wakeup.set()
+
+    def wait(self, timeout):
+        """Sleep until the timeout expires or a probe result arrives"""
+        if timeout > 0:
+            self.wakeup.wait(timeout)
+        self.wakeup.clear()
+
+    def latest(self, name):
+        """Latest result of a probe, or None if it has not reported within two intervals"""
+        with self.lock:
+            probe = self.probes[name]
+            if probe["result_time"] is None:
+                return None
+            max_age = 2 * probe["interval"] + probe["timeout"]
+            if time.monotonic() - probe["result_time"] > max_age:
+                return None
+            return probe["result"]
+
+    def all_reported(self):
+        with self.lock:
+            return all(probe["result_time"] is not None for probe in self.probes.values())
+
+def _icmp_checksum(data):
+    """RFC 1071 internet checksum"""
+    if len(data) % 2:
+        data += b"\x00"
+    total = sum(struct.unpack(f"!{len(data) // 2}H", data))
+    total = (total >> 16) + (total & 0xFFFF)
+    total += total >> 16
+    return ~total & 0xFFFF
+
+class IcmpProber:
+    """In-process echo prober matching replies to probes by sequence number
+
+    Uses an unprivileged ICMP datagram socket when the kernel allows it
+    (net.ipv4.ping_group_range) and falls back to UDP echo otherwise. One
+    prober can have probes outstanding to several hosts at once. With
+    recv_errors=True, ICMP errors for sent probes (such as time exceeded for
+    a TTL-limited probe) are queued by the kernel and read with errors().
+    """
+    ICMP_ECHO_REQUEST = 8
+    ICMP_ECHO_REPLY = 0
+    # Linux <linux/in.h> and <linux/errqueue.h>; the socket module lacks IP_RECVERR
+    IP_RECVERR = getattr(socket, "IP_RECVERR", 11)
+    MSG_ERRQUEUE = getattr(socket, "MSG_ERRQUEUE", 0x2000)
+    SO_EE_ORIGIN_ICMP = 2
+    EXTENDED_ERR = struct.Struct("=IBBBBII")
+
+    def __init__(self, udp_echo_port=7, payload_size=56, recv_errors=False):
+        try:
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_ICMP)
+            self.mode = "icmp"
+        except OSError:
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.mode = "udp"
+        self.sock.setblocking(False)
+        if recv_errors:
+            self.sock.setsockopt(socket.IPPROTO_IP, self.IP_RECVERR, 1)
+        self.default_ttl = self.sock.getsockopt(socket.IPPROTO_IP, socket.IP_TTL)
+        self.udp_echo_port = udp_echo_port
+        self.ident = os.getpid() & 0xFFFF
+        self.payload = bytes(payload_size)
+        self.seq = 0
+        self.pending = {}
+
+    def close(self):
+        self.sock.close()
+
+    def send(self, host, ttl=None):
+        """Send one probe to an IPv4 address and return its sequence number
+
+        A ttl limits how many hops the probe travels; the router where it
+        expires answers with time exceeded, read back through errors().
+        """
+        self.seq = (self.seq + 1) & 0xFFFF
+        seq = self.seq
+        if self.mode == "icmp":
+            header = struct.pack("!BBHHH", self.ICMP_ECHO_REQUEST, 0, 0, self.ident, seq)
+            checksum = _icmp_checksum(header + self.payload)
+            packet = struct.pack("!BBHHH", self.ICMP_ECHO_REQUEST, 0, checksum, self.ident, seq) + self.payload
+            address = (host, 0)
+        else:
+            packet = struct.pack("!HH", self.ident, seq) + self.payload
+            address = (host, self.udp_echo_port)
+        self.pending[seq] = (host, time.monotonic_ns())
+        try:
+            if ttl:
+                self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_TTL, ttl)
+            self.sock.sendto(packet, address)
+        except OSError as e:
+            # Count it as sent and lost, like ping does for unreachable hosts
+            logger.debug(f"Probe to {host} failed to send: {e}")
+        finally:
+            if ttl:
+                self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_TTL, self.default_ttl)
+        return seq
+
+    def poll(self, timeout):
+        """Wait up to timeout seconds for replies; returns a list of (seq, host, rtt_ms)"""
+        replies = []
+        readable, _, _ = select.select([self.sock], [], [], max(0.0, timeout))
+        if not readable:
+            return replies
+        while True:
+            try:
+                data, address = self.sock.recvfrom(2048)
+            except (BlockingIOError, InterruptedError):
+                break
+            except OSError as e:
+                logger.debug(f"Probe receive error: {e}")
+                break
+            received_ns = time.monotonic_ns()
+            if self.mode == "icmp":
+                # Datagram ICMP sockets deliver the ICMP message without the IP header;
+                # the kernel rewrites the identifier, so match on sequence only
+                if len(data) < 8 or data[0] != self.ICMP_ECHO_REPLY:
+                    continue
+                seq = struct.unpack_from("!H", data, 6)[0]
+            else:
+                if len(data) < 4:
+                    continue
+                ident, seq = struct.unpack_from("!HH", data, 0)
+                if ident != self.ident:
+                    continue
+            sent = self.pending.get(seq)
+            if sent is None or sent[0] != address[0]:
+                continue
+            del self.pending[seq]
+            replies.append((seq, sent[0], (received_ns - sent[1]) / 1e6))
+        return replies
+
+    def errors(self):
+        """Drain the error queue; returns a list of (seq, host, responder, icmp_type, rtt_ms)
+
+        Only usable with recv_errors=True. The kernel hands back the start of
+        the probe that caused each ICMP error, which carries its sequence
+        number. In UDP mode that needs a router that quotes more than the
+        8 bytes of the UDP header, which most do.
+        """
+        errors = []
+        while True:
+            try:
+                data, ancdata, _, _ = self.sock.recvmsg(512, 512, self.MSG_ERRQUEUE)
+            except (BlockingIOError, InterruptedError):
+                break
+            except OSError as e:
+                logger.debug(f"Probe error queue read failed: {e}")
+                break
+            received_ns = time.monotonic_ns()
+            for level, kind, value in ancdata:
+                if level != socket.IPPROTO_IP or kind != self.IP_RECVERR or len(value) < self.EXTENDED_ERR.size + 8:
+                    continue
+                _, origin, icmp_type, _, _, _, _ = self.EXTENDED_ERR.unpack_from(value)
+                if origin != self.SO_EE_ORIGIN_ICMP:
+                    continue
+                # SO_EE_OFFENDER: the sockaddr_in of the router that sent the error
+                responder = socket.inet_ntoa(value[self.EXTENDED_ERR.size + 4:self.EXTENDED_ERR.size + 8])
+                offset = 6 if self.mode == "icmp" else 2
+                if len(data) < offset + 2:
+                    continue
+                seq = struct.unpack_from("!H", data, offset)[0]
+                sent = self.pending.pop(seq, None)
+                if sent is None:
+                    continue
+                errors.append((seq, sent[0], responder, icmp_type, (received_ns - sent[1]) / 1e6))
+        return errors
+
+    def expire(self, max_age):
+        """Forget probes older than max_age seconds; returns a list of (seq, host) that were lost"""
+        cutoff = time.monotonic_ns() - int(max_age * 1e9)
+        lost = [(seq, host) for seq, (host, sent_ns) in self.pending.items() if sent_ns < cutoff]
+        for seq, _ in lost:
+            del self.pending[seq]
+        return lost
+
+    def burst(self, host, count, interval, timeout):
+        """Send count probes spaced by interval and wait up to timeout after the last one
+
+        Returns (rtt_samples_ms, sent, received).
+        """
+        outstanding = set()
+        samples = []
+        start = time.monotonic()
+        for i in range(count):
+            outstanding.add(self.send(host))
+            next_send = start + (i + 1) * interval
+            while True:
+                remaining = next_send - time.monotonic()
+                if remaining <= 0 and i < count - 1:
+                    break
+                if i == count - 1:
+                    remaining = start + i * interval + timeout - time.monotonic()
+                    if remaining <= 0 or not outstanding:
+                        break
+                for seq, _, rtt in self.poll(remaining):
+                    if seq in outstanding:
+                        outstanding.discard(seq)
+                        samples.append(rtt)
+        for seq in outstanding:
+            self.pending.pop(seq, None)
+        return samples, count, len(samples)
+
+class HttpConnectionPool:
+    """Idle keep-alive HTTP connections per (scheme, host, port), shared by all HTTP probes"""
+
+    def __init__(self, max_idle=4):
+        self.max_idle = max_idle
+        self.idle = {}
+        self.lock = threading.Lock()
+
+    def acquire(self, key):
+        """Return an idle connection for key, or None if a new one must be opened"""
+        with self.lock:
+            connections = self.idle.get(key)
+            if connections:
+                return connections.pop()
+        return None
+
+    def release(self, key, conn):
+        with self.lock:
+            connections = self.idle.setdefault(key, [])
+            if len(connections) < self.max_idle:
+                connections.append(conn)
+                return
+        conn.close()
+
+    def close(self):
+        with self.lock:
+            for connections in self.idle.values():
+                for conn in connections:
+                    conn.close()
+            self.idle.clear()
+
+class HttpTimingProbe:
+    """In-process HTTP GET with per-phase timings over pooled keep-alive connections
+
+    Phases are reported cumulatively from the start of the request, like
+    curl's -w timers: DNS, TCP connect, TLS handshake, first byte and total.
+    """
+
+    def __init__(self, pool, timeout=10, buffer_size=65536):
+        self.pool = pool
+        self.timeout = timeout
+        self.buffer_size = buffer_size
+        # One receive buffer per calling thread, allocated on its first request
+        self.local = threading.local()
+
+    def _open(self, scheme, host, port, timings, start):
+        addrinfo = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+        timings["dns"] = time.perf_counter() - start
+        # Connect to the full sockaddr; an IPv6 link-local address needs its scope id
+        family, kind, proto, _, sockaddr = addrinfo[0]
+        sock = socket.socket(family, kind, proto)
+        try:
+            sock.settimeout(self.timeout)
+            sock.connect(sockaddr)
+        except OSError:
+            sock.close()
+            raise
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        timings["connect"] = time.perf_counter() - start
+        if scheme == "https":
+            sock = ssl.create_default_context().wrap_socket(sock, server_hostname=host)
+            timings["tls"] = time.perf_counter() - start
+            conn = http.client.HTTPSConnection(host, port, timeout=self.timeout)
+        else:
+            conn = http.client.HTTPConnection(host, port, timeout=self.timeout)
+        conn.sock = sock
+        return conn
+
+    def measure(self, url, fresh=False, max_duration=None):
+        """GET url and return phase timings in seconds plus size and status
+
+        With fresh=True a new connection is opened even if an idle one is
+        pooled. max_duration stops reading the body early; the connection is
+        then closed instead of returned to the pool.
+        """
+        parts = urlsplit(url)
+        scheme = parts.scheme or "http"
+        host = parts.hostname
+        port = parts.port or (443 if scheme == "https" else 80)
+        path = parts.path or "/"
+        if parts.query:
+            path += "?" + parts.query
+        key = (scheme, host, port)
+        
+        for attempt in range(2):
+            conn = None if fresh or attempt else self.pool.acquire(key)
+            reused = conn is not None
+            timings = {"reused": reused, "dns": 0.0, "connect": 0.0, "tls": 0.0}
+            start = time.perf_counter()
+            try:
+                if conn is None:
+                    conn = self._open(scheme, host, port, timings, start)
+                conn.request("GET", path)
+                response = conn.getresponse()
+                timings["starttransfer"] = time.perf_counter() - start
+                
+                size = 0
+                truncated = False
+                view = getattr(self.local, "view", None)
+                if view is None:
+                    view = self.local.view = memoryview(bytearray(self.buffer_size))
+                while True:
+                    n = response.readinto(view)
+                    if not n:
+                        break
+                    size += n
+                    if max_duration is not None and time.perf_counter() - start > max_duration:
+                        truncated = True
+                        break
+                timings["total"] = time.perf_counter() - start
+                timings["size"] = size
+                timings["status"] = response.status
+                
+                if truncated or response.will_close:
+                    conn.close()
+                else:
+                    self.pool.release(key, conn)
+                return timings
+                
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                if conn is not None:
+                    conn.close()
+                # A pooled connection may have been closed by the server while idle
+                if not reused:
+                    raise
+            except Exception:
+                if conn is not None:
+                    conn.close()
+                raise
+
+class ThroughputTest:
+    """Multi-stream HTTP throughput test that reads straight into preallocated buffers
+
+    Each stream repeats requests on its own keep-alive connection from the
+    shared pool until the test duration is up, receiving with readinto()
+    into a fixed memoryview (or sending one for uploads). The buffers are
+    allocated once per thread calling run() and reused by its later tests.
+    A sampler records bytes per interval so the first omit seconds of TCP
+    slow start can be left out of the result.
+    """
+
+    def __init__(self, pool, streams=4, duration=5.0, sample_interval=0.25, omit=1.0,
+                 buffer_size=256 * 1024, upload_request_bytes=8 * 1024 * 1024, timeout=10):
+        self.pool = pool
+        self.streams = streams
+        self.duration = duration
+        self.sample_interval = sample_interval
+        self.omit = omit
+        self.buffer_size = buffer_size
+        self.upload_request_bytes = upload_request_bytes
+        self.timeout = timeout
+        # Stream buffers of the thread calling run(), kept for its next test
+        self.local = threading.local()
+
+    def _open(self, key):
+        scheme, host, port = key
+        if scheme == "https":
+            return http.client.HTTPSConnection(host, port, timeout=self.timeout, context=ssl.create_default_context())
+        return http.client.HTTPConnection(host, port, timeout=self.timeout)
+
+    def _stream(self, index, key, path, upload, view, counters, stop, errors):
+        conn = None
+        fresh = False
+        try:
+            while not stop.is_set():
+                reused = False
+                if conn is None:
+                    conn = None if fresh else self.pool.acquire(key)
+                    reused = conn is not None
+                    if conn is None:
+                        conn = self._open(key)
+                complete = True
+                try:
+                    if upload:
+                        conn.putrequest("POST", path)
+                        conn.putheader("Content-Type", "application/octet-stream")
+                        conn.putheader("Content-Length", str(self.upload_request_bytes))
+                        conn.endheaders()
+                        remaining = self.upload_request_bytes
+                        while remaining and not stop.is_set():
+                            chunk = view[:min(remaining, len(view))]
+                            conn.sock.sendall(chunk)
+                            counters[index] += len(chunk)
+                            remaining -= len(chunk)
+                        complete = not remaining
+                        if complete:
+                            response = conn.getresponse()
+                            while response.readinto(view):
+                                pass
+                    else:
+                        conn.request("GET", path)
+                        response = conn.getresponse()
+                        while True:
+                            n = response.readinto(view)
+                            if not n:
+                                break
+                            counters[index] += n
+                            if stop.is_set():
+                                complete = False
+                                break
+                except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                    conn.close()
+                    conn = None
+                    # A pooled connection may have been closed by the server while idle
+                    # (the HTTP probe leaves one behind); retry once on a new connection
+                    if not reused:
+                        raise
+                    fresh = True
+                    continue
+                if not complete or response.will_close:
+                    conn.close()
+                    conn = None
+            if conn is not None:
+                self.pool.release(key, conn)
+        except Exception as e:
+            errors.append(e)
+            if conn is not None:
+                conn.close()
+
+    def run(self, url, upload=False):
+        """Run the test against url; returns a dict with steady-state and per-interval Mbps"""
+        parts = urlsplit(url)
+        scheme = parts.scheme or "http"
+        if scheme not in ("http", "https"):
+            raise ValueError(f"Speed test URL {url} must be http or https")
+        key = (scheme, parts.hostname, parts.port or (443 if scheme == "https" else 80))
+        path = (parts.path or "/") + ("?" + parts.query if parts.query else "")
+        views = getattr(self.local, "views", None)
+        if views is None:
+            views = self.local.views = [memoryview(bytearray(self.buffer_size)) for _ in range(self.streams)]
+        counters = [0] * self.streams
+        stop = threading.Event()
+        errors = []
+        threads = [
+            threading.Thread(target=self._stream, args=(i, key, path, upload, views[i], counters, stop, errors), daemon=True)
+            for i in range(self.streams)
+        ]
+        
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        samples = []
+        previous_bytes, previous_time = 0, start
+        while True:
+            time.sleep(self.sample_interval)
+            now = time.perf_counter()
+            total = sum(counters)
+            samples.append((now - start, total - previous_bytes, now - previous_time))
+            previous_bytes, previous_time = total, now
+            if now - start >= self.duration or all(not t.is_alive() for t in threads):
+                break
+        stop.set()
+        for thread in threads:
+            thread.join(self.timeout)
+        
+        if errors and not sum(counters):
+            raise errors[0]
+        # Exclude slow start, unless the test was too short to have anything after it
+        steady = [sample for sample in samples if sample[0] - sample[2] >= self.omit] or samples
+        steady_bytes = sum(sample[1] for sample in steady)
+        steady_time = sum(sample[2] for sample in steady)
+        rates = [(sample[1] * 8) / (sample[2] * 1024 * 1024) for sample in steady if sample[2] > 0]
+        return {
+            "mbps": (steady_bytes * 8) / (steady_time * 1024 * 1024) if steady_time > 0 else 0.0,
+            "max_mbps": max(rates, default=0.0),
+            "min_mbps": min(rates, default=0.0),
+            "bytes": sum(counters),
+            "errors": len(errors),
+        }
+
+class DogStatsdEmitter:
+    """Packs DogStatsD metrics and service checks into newline-delimited datagrams
+
+    Lines are buffered until the next datagram would exceed max_packet_size
+    or flush() is called, so a whole collection cycle goes out in a handful
+    of packets. Sends over UDP, or over a Unix datagram socket when
+    socket_path is set. With enabled=False every line is dropped.
+    """
+    UDP_PACKET_SIZE = 1432
+    UDS_PACKET_SIZE = 8192
+
+    def __init__(self, host, port, tags, socket_path=None, max_packet_size=None, enabled=True):
+        self.enabled = enabled
+        if socket_path:
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            self.address = socket_path
+            self.max_packet_size = max_packet_size or self.UDS_PACKET_SIZE
+        else:
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.address = (host, port)
+            self.max_packet_size = max_packet_size or self.UDP_PACKET_SIZE
+        self.tag_suffix = self.build_tag_suffix(tags)
+        self.buffer = bytearray()
+        self.lock = threading.Lock()
+        self.datagrams_sent = 0
+        self.bytes_sent = 0
+
+    @staticmethod
+    def build_tag_suffix(tags):
+        """Encode tags once into the |#tag1,tag2 suffix appended to every line"""
+        return ("|#" + ",".join(tags)).encode("utf-8") if tags else b""
+
+    def metric(self, name, value, metric_type="g", tag_suffix=None, timestamp=None):
+        line = b"%s:%s|%s%s" % (
+            name.encode("utf-8"), str(value).encode("ascii"), metric_type.encode("ascii"),
+            self.tag_suffix if tag_suffix is None else tag_suffix,
+        )
+        if timestamp is not None:
+            # DogStatsD protocol v1.3 client-side timestamp, used when backfilling
+            line += b"|T%d" % int(timestamp)
+        self._append(line)
+
+    def distribution(self, name, values, tag_suffix=None):
+        """Queue raw samples as |d lines, packing several values per line (name:v1:v2|d)"""
+        suffix = b"|d" + (self.tag_suffix if tag_suffix is None else tag_suffix)
+        prefix = name.encode("utf-8")
+        room = self.max_packet_size - len(prefix) - len(suffix)
+        line = bytearray(prefix)
+        for value in values:
+            encoded = b":%.3f" % value
+            if len(line) - len(prefix) + len(encoded) > room and len(line) > len(prefix):
+                self._append(bytes(line + suffix))
+                line = bytearray(prefix)
+            line += encoded
+        if len(line) > len(prefix):
+            self._append(bytes(line + suffix))
+
+    def event(self, title, text, timestamp=None, alert_type="info", tag_suffix=None):
+        # DogStatsD event format: _e{<title length>,<text length>}:<title>|<text>|d:<timestamp>|t:<alert type>|#<tags>
+        title_bytes = title.encode("utf-8")
+        text_bytes = text.replace("\n", "\\n").encode("utf-8")
+        line = b"_e{%d,%d}:%s|%s|d:%d|t:%s%s" % (
+            len(title_bytes), len(text_bytes), title_bytes, text_bytes, int(timestamp or time.time()),
+            alert_type.encode("ascii"), self.tag_suffix if tag_suffix is None else tag_suffix,
+        )
+        self._append(line)
+
+    def service_check(self, name, status, message=None, timestamp=None, tag_suffix=None):
+        # DogStatsD service check format: _sc|<name>|<status>|d:<timestamp>|h:<hostname>|#<tags>|m:<message>
+        line = b"_sc|%s|%d|d:%d%s" % (
+            name.encode("utf-8"), status, int(timestamp or time.time()),
+            self.tag_suffix if tag_suffix is None else tag_suffix,
+        )
+        if message:
+            # Escape special characters in message
+            line += b"|m:" + message.replace("|", "\\|").replace("\n", "\\n").encode("utf-8")
+        self._append(line)
+
+    def _append(self, line):
+        if not self.enabled:
+            return
+        with self.lock:
+            if self.buffer and len(self.buffer) + 1 + len(line) > self.max_packet_size:
+                self._send(self.buffer)
+                self.buffer = bytearray()
+            if self.buffer:
+                self.buffer += b"\n"
+            self.buffer += line
+
+    def flush(self):
+        with self.lock:
+            if self.buffer:
+                self._send(self.buffer)
+                self.buffer = bytearray()
+
+    def _send(self, payload):
+        try:
+            self.sock.sendto(payload, self.address)
+            self.datagrams_sent += 1
+            self.bytes_sent += len(payload)
+        except OSError as e:
+            logger.error(f"Failed to send {len(payload)} byte DogStatsD datagram: {e}")
+
+class PrometheusExporter:
+    """Serves the latest metrics and service check states at /metrics in Prometheus text format
+
+    publish() renders the exposition body once per collection cycle. Scrapes
+    are answered from that cached buffer, gzipped at most once per body, and
+    with a content ETag so unchanged bodies get 304 Not Modified. The gzip
+    copy is a different representation, so it gets its own ETag. Scraping
+    therefore never triggers probes or rendering.
+    """
+    CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+    CHECK_HELP = "# HELP starlink_service_check Service check status: 0 OK, 1 WARNING, 2 CRITICAL, 3 UNKNOWN\n"
+
+    def __init__(self, address="0.0.0.0", port=9817):
+        self.address = address
+        self.port = port
+        self.targets = {}
+        self.names = {}
+        self.lock = threading.Lock()
+        self.body = b""
+        self.etag = self._etag(self.body)
+        self.gzipped = None
+        self.server = None
+
+    @staticmethod
+    def build_labels(tags):
+        """'{key="value",...}' from DogStatsD key:value tags"""
+        labels = []
+        for tag in tags:
+            key, _, value = tag.partition(":")
+            key = "".join(c if c.isalnum() or c == "_" else "_" for c in key)
+            value = value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+            labels.append(f'{key}="{value}"')
+        return "{" + ",".join(labels) + "}"
+
+    @staticmethod
+    def _etag(body):
+        return '"' + hashlib.blake2b(body, digest_size=8).hexdigest() + '"'
+
+    def _name(self, metric):
+        name = self.names.get(metric)
+        if name is None:
+            name = self.names[metric] = "starlink_" + "".join(c if c.isalnum() or c == "_" else "_" for c in metric)
+        return name
+
+    def update(self, key, labels, metrics, check_states, timestamp=None):
+        """Record one target's metrics and check states for the next publish()"""
+        self.targets[key] = (labels, metrics, dict(check_states), timestamp or time.time())
+
+    def publish(self):
+        """Render the exposition body from the latest update() of every target"""
+        families = {}
+        checks = []
+        stamps = []
+        for labels, metrics, check_states, timestamp in self.targets.values():
+            for metric, value in metrics.items():
+                if isinstance(value, bool) or not isinstance(value, (int, float)) or value != value:
+                    continue
+                families.setdefault(self._name(metric), []).append(f"{labels} {value}\n")
+            check_labels = labels[:-1] + ("," if len(labels) > 2 else "")
+            for check, status in check_states.items():
+                checks.append(f'starlink_service_check{check_labels}check="{check}"}} {status}\n')
+            stamps.append(f"starlink_last_collection_timestamp_seconds{labels} {timestamp:.3f}\n")
+        
+        lines = []
+        for name in sorted(families):
+            lines.append(f"# TYPE {name} gauge\n")
+            lines.extend(name + sample for sample in families[name])
+        if checks:
+            lines.append(self.CHECK_HELP)
+            lines.append("# TYPE starlink_service_check gauge\n")
+            lines.extend(checks)
+        lines.append("# TYPE starlink_last_collection_timestamp_seconds gauge\n")
+        lines.extend(stamps)
+        body = "".join(lines).encode("utf-8")
+        etag = self._etag(body)
+        with self.lock:
+            if etag != self.etag:
+                self.body, self.etag, self.gzipped = body, etag, None
+
+    def snapshot(self, gzipped=False):
+        """(body, etag) of the current exposition, compressing it on the first gzip request"""
+        with self.lock:
+            if not gzipped:
+                return self.body, self.etag
+            if self.gzipped is None:
+                self.gzipped = gzip.compress(self.body, compresslevel=6)
+            return self.gzipped, self.etag[:-1] + '-gz"'
+
+    def start(self):
+        exporter = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                if self.path.split("?", 1)[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                use_gzip = "gzip" in self.headers.get("Accept-Encoding", "")
+                body, etag = exporter.snapshot(use_gzip)
+                if etag in self.headers.get("If-None-Match", ""):
+                    self.send_response(304)
+                    self.send_header("ETag", etag)
+                    self.send_header("Vary", "Accept-Encoding")
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", exporter.CONTENT_TYPE)
+                self.send_header("ETag", etag)
+                self.send_header("Vary", "Accept-Encoding")
+                if use_gzip:
+                    self.send_header("Content-Encoding", "gzip")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logger.debug(f"Scrape from {self.client_address[0]}: {format % args}")
+
+        self.server = http.server.ThreadingHTTPServer((self.address, self.port), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, name="prometheus-exporter", daemon=True).start()
+        logger.info(f"Prometheus exporter listening on {self.address}:{self.server.server_address[1]}/metrics")
+
+    def stop(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+
+def parse_duration(text):
+    """Parse a duration such as 90, 90s, 15m, 1h or 7d into seconds"""
+    units = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+    text = text.strip()
+    if text and text[-1] in units:
+        return float(text[:-1]) * units[text[-1]]
+    return float(text)
+
+class DDSketch:
+    """Mergeable quantile sketch with bounded relative error (DDSketch, Masson et al. 2019)
+
+    Values are counted in logarithmic bins so any quantile is returned within
+    relative_accuracy of the true value, in memory that depends on the value
+    range rather than on the number of samples.
+    """
+
+    def __init__(self, relative_accuracy=0.01, max_bins=2048):
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.max_bins = max_bins
+        self.bins = {}
+        self.zero_count = 0
+        self.count = 0
+
+    def add(self, value):
+        self.count += 1
+        if value <= 1e-9:
+            self.zero_count += 1
+            return
+        key = math.ceil(math.log(value) / self.log_gamma)
+        self.bins[key] = self.bins.get(key, 0) + 1
+        if len(self.bins) > self.max_bins:
+            self._collapse()
+
+    def merge(self, other):
+        for key, count in other.bins.items():
+            self.bins[key] = self.bins.get(key, 0) + count
+        self.zero_count += other.zero_count
+        self.count += other.count
+        if len(self.bins) > self.max_bins:
+            self._collapse()
+
+    def _collapse(self):
+        # Fold the lowest bins together; only the smallest quantiles lose accuracy
+        keys = sorted(self.bins)
+        excess = len(keys) - self.max_bins + 1
+        folded = sum(self.bins.pop(key) for key in keys[:excess])
+        self.bins[keys[excess]] += folded
+
+    def clear(self):
+        self.bins.clear()
+        self.zero_count = 0
+        self.count = 0
+
+    def quantiles(self, qs):
+        """Values at each quantile in qs (ascending, 0-1), or None for an empty sketch"""
+        if not self.count:
+            return None
+        results = []
+        keys = sorted(self.bins)
+        cumulative = self.zero_count
+        position = 0
+        for q in qs:
+            rank = q * (self.count - 1)
+            if rank < self.zero_count:
+                results.append(0.0)
+                continue
+            while position < len(keys) and cumulative + self.bins[keys[position]] <= rank:
+                cumulative += self.bins[keys[position]]
+                position += 1
+            key = keys[min(position, len(keys) - 1)]
+            results.append(2 * self.gamma ** key / (self.gamma + 1))
+        return results
+
+class WindowedSketch:
+    """DDSketch over a rolling time window, kept as a ring of per-slot sketches"""
+
+    def __init__(self, window, slots=12, relative_accuracy=0.01):
+        self.slot_width = window / slots
+        self.sketches = [DDSketch(relative_accuracy) for _ in range(slots)]
+        self.slot_ids = [None] * slots
+        self.relative_accuracy = relative_accuracy
+
+    def add(self, value, now):
+        slot_id = int(now // self.slot_width)
+        index = slot_id % len(self.sketches)
+        if self.slot_ids[index] != slot_id:
+            self.sketches[index].clear()
+            self.slot_ids[index] = slot_id
+        self.sketches[index].add(value)
+
+    def merged(self, now):
+        """A single sketch of every sample still inside the window"""
+        oldest = int(now // self.slot_width) - len(self.sketches) + 1
+        result = DDSketch(self.relative_accuracy)
+        for slot_id, sketch in zip(self.slot_ids, self.sketches):
+            if slot_id is not None and slot_id >= oldest:
+                result.merge(sketch)
+        return result
+
+class LatencyDistribution:
+    """Per-target RTT sketches for several rolling windows plus raw samples awaiting emission"""
+    QUANTILES = ((0.5, "p50"), (0.9, "p90"), (0.99, "p99"), (0.999, "p999"))
+
+    def __init__(self, windows, keep_samples=False, max_pending=10000):
+        self.windows = {name: WindowedSketch(seconds) for name, seconds in windows}
+        self.pending = deque(maxlen=max_pending) if keep_samples else None
+        self.lock = threading.Lock()
+
+    def record(self, samples):
+        now = time.time()
+        with self.lock:
+            for value in samples:
+                for sketch in self.windows.values():
+                    sketch.add(value, now)
+            if self.pending is not None:
+                self.pending.extend(samples)
+
+    def percentiles(self, prefix="ping_rtt"):
+        """Metrics like ping_rtt_p99_ms_15m for every window holding samples"""
+        now = time.time()
+        metrics = {}
+        with self.lock:
+            merged = {name: sketch.merged(now) for name, sketch in self.windows.items()}
+        for name, sketch in merged.items():
+            values = sketch.quantiles([q for q, _ in self.QUANTILES])
+            if values is None:
+                continue
+            for (_, label), value in zip(self.QUANTILES, values):
+                metrics[f"{prefix}_{label}_ms_{name}"] = value
+        return metrics
+
+    def drain(self):
+        """Raw samples recorded since the last drain"""
+        if self.pending is None:
+            return []
+        with self.lock:
+            samples = list(self.pending)
+            self.pending.clear()
+        return samples
+
+class RollingMoments:
+    """Mean, variance and least-squares slope of (t, v) samples over a sliding time window
+
+    Samples are accumulated into fixed-width time slots stored in parallel
+    arrays. Window totals are kept with Welford updates as samples arrive and
+    the inverse Chan merge as slots expire, so every update is O(1) and memory
+    depends only on the slot count, not on how long the collector has run.
+    t is relative to origin, an epoch time; slots are aligned to multiples
+    of the slot width in epoch time, so they do not depend on when the
+    collector started and BatchRecompute can lay out the same slots.
+    """
+
+    def __init__(self, window, slots=20, origin=0.0):
+        self.slot_width = window / slots
+        self.phase = origin % self.slot_width
+        self.slots = slots
+        self.ids = array("q", [-1] * slots)
+        # Per slot: count, mean t, mean v, M2 t, M2 v, co-moment t/v
+        self.n = array("d", bytes(8 * slots))
+        self.mt = array("d", bytes(8 * slots))
+        self.mv = array("d", bytes(8 * slots))
+        self.m2t = array("d", bytes(8 * slots))
+        self.m2v = array("d", bytes(8 * slots))
+        self.ctv = array("d", bytes(8 * slots))
+        self.total = [0.0] * 6
+        self.last_id = None
+
+    def _expire(self, slot_id):
+        # Remove every slot that has fallen out of the window since the last update
+        if self.last_id is None:
+            self.last_id = slot_id
+            return
+        for old_id in range(max(self.last_id, slot_id - self.slots) + 1, slot_id + 1):
+            index = old_id % self.slots
+            if self.ids[index] != -1:
+                self._remove(index)
+        self.last_id = max(self.last_id, slot_id)
+
+    def _remove(self, i):
+        n, mt, mv, m2t, m2v, ctv = self.total
+        nb = self.n[i]
+        na = n - nb
+        if na <= 0:
+            self.total = [0.0] * 6
+        else:
+            mta = (n * mt - nb * self.mt[i]) / na
+            mva = (n * mv - nb * self.mv[i]) / na
+            dt = self.mt[i] - mta
+            dv = self.mv[i] - mva
+            f = na * nb / n
+            self.total = [
+                na, mta, mva,
+                max(0.0, m2t - self.m2t[i] - dt * dt * f),
+                max(0.0, m2v - self.m2v[i] - dv * dv * f),
+                ctv - self.ctv[i] - dt * dv * f,
+            ]
+        self.ids[i] = -1
+        self.n[i] = self.mt[i] = self.mv[i] = self.m2t[i] = self.m2v[i] = self.ctv[i] = 0.0
+
+    def add(self, t, v):
+        slot_id = int((t + self.phase) // self.slot_width)
+        self._expire(slot_id)
+        i = slot_id % self.slots
+        self.ids[i] = slot_id
+        
+        # Welford update of the slot
+        n = self.n[i] + 1
+        dt = t - self.mt[i]
+        dv = v - self.mv[i]
+        self.n[i] = n
+        self.mt[i] += dt / n
+        self.mv[i] += dv / n
+        self.m2t[i] += dt * (t - self.mt[i])
+        self.m2v[i] += dv * (v - self.mv[i])
+        self.ctv[i] += dt * (v - self.mv[i])
+        
+        # ... and of the window totals
+        total = self.total
+        n = total[0] + 1
+        dt = t - total[1]
+        dv = v - total[2]
+        total[0] = n
+        total[1] += dt / n
+        total[2] += dv / n
+        total[3] += dt * (t - total[1])
+        total[4] += dv * (v - total[2])
+        total[5] += dt * (v - total[2])
+
+    def stats(self, now):
+        """(count, mean, stdev, slope per second) of the samples inside the window"""
+        self._expire(int((now + self.phase) // self.slot_width))
+        n, _, mean, m2t, m2v, ctv = self.total
+        if n < 2:
+            return n, mean, 0.0, 0.0
+        stdev = math.sqrt(m2v / (n - 1))
+        slope = ctv / m2t if m2t > 0 else 0.0
+        return n, mean, stdev, slope
+
+class TrendEngine:
+    """Rolling trend statistics and EWMA for every numeric metric of one target
+
+    Each metric matching one of the patterns gets one RollingMoments per
+    horizon. The first horizon also produces the legacy *_trend_pct and
+    *_volatility metrics.
+    """
+
+    def __init__(self, horizons, patterns=("*",), slots=20, ewma_alpha=0.3):
+        self.horizons = horizons
+        self.patterns = patterns
+        self.slots = slots
+        self.ewma_alpha = ewma_alpha
+        self.start = time.time()
+        self.series = {}
+        self.ignored = set()
+
+    def _tracked(self, name):
+        if name in self.series:
+            return True
+        if name in self.ignored:
+            return False
+        if any(fnmatch.fnmatchcase(name, pattern) for pattern in self.patterns):
+            self.series[name] = ([None], [RollingMoments(seconds, self.slots, self.start) for _, seconds in self.horizons])
+            return True
+        self.ignored.add(name)
+        return False
+
+    def update(self, metrics, now=None):
+        """Add this cycle's values and return the trend metrics for every tracked series"""
+        # Times are kept relative to the engine start so the least-squares sums stay small
+        t = (now or time.time()) - self.start
+        for name, value in metrics.items():
+            if isinstance(value, bool) or not isinstance(value, (int, float)) or value != value:
+                continue
+            if not self._tracked(name):
+                continue
+            ewma, windows = self.series[name]
+            ewma[0] = value if ewma[0] is None else ewma[0] + self.ewma_alpha * (value - ewma[0])
+            for window in windows:
+                window.add(t, value)
+        
+        trends = {}
+        for name, (ewma, windows) in self.series.items():
+            if ewma[0] is not None:
+                trends[f"{name}_ewma"] = ewma[0]
+            for index, ((horizon, seconds), window) in enumerate(zip(self.horizons, windows)):
+                n, mean, stdev, slope = window.stats(t)
+                if n < 3:
+                    continue
+                trends[f"{name}_mean_{horizon}"] = mean
+                trends[f"{name}_volatility_{horizon}"] = stdev
+                trends[f"{name}_slope_{horizon}"] = slope * 3600
+                if index == 0:
+                    if mean != 0:
+                        trends[f"{name}_trend_pct"] = slope * seconds / abs(mean) * 100
+                    trends[f"{name}_volatility"] = stdev
+        return trends
+
+class CollectorInstrumentation:
+    """Self-metrics for the collector itself, emitted as starlink.collector.*
+
+    Covers probe wall/CPU time and start lag (histograms tagged by probe),
+    per-stage time of the emit cycle, cycle lag and drift, errors, RSS, CPU
+    and the DogStatsD output volume. Also toggles cProfile and tracemalloc
+    dumps on SIGUSR1 / SIGUSR2. cProfile covers every thread: threads started
+    while profiling get a profiler through threading.setprofile, and long-lived
+    ones (probe workers, background probers) call profile_thread() each
+    iteration to start or stop theirs. From Python 3.12 cProfile runs on
+    sys.monitoring, which sees every thread but allows only one active
+    profiler, so a single process-wide profiler is used instead.
+    """
+    PREFIX = "starlink.collector."
+    PROCESS_WIDE_PROFILER = sys.version_info >= (3, 12)
+
+    def __init__(self, emitter, profile_dir="/tmp"):
+        self.emitter = emitter
+        self.profile_dir = profile_dir
+        self.stage_seconds = {}
+        self.suffixes = {}
+        self.errors = 0
+        self.penalty_seconds = 0.0
+        self.last_datagrams = 0
+        self.last_bytes = 0
+        self.last_cpu = time.process_time()
+        self.last_wall = time.monotonic()
+        self.profile_session = None
+        self.profilers = []
+        self.local = threading.local()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stage_seconds[name] = self.stage_seconds.get(name, 0.0) + time.perf_counter() - start
+
+    def _suffix(self, tag):
+        suffix = self.suffixes.get(tag)
+        if suffix is None:
+            base = self.emitter.tag_suffix
+            suffix = self.suffixes[tag] = (base + b"," if base else b"|#") + tag.encode("utf-8")
+        return suffix
+
+    @staticmethod
+    def rss_bytes():
+        try:
+            with open("/proc/self/statm") as f:
+                return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+        except (OSError, ValueError):
+            # Peak rather than current RSS, but better than nothing off Linux
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    def emit(self, scheduler, cycle_lag, cycle_drift):
+        """Queue this cycle's self-metrics; the caller flushes"""
+        emit = self.emitter.metric
+        prefix = self.PREFIX
+        
+        timings = scheduler.timings
+        while timings:
+            name, wall, cpu, lag = timings.popleft()
+            suffix = self._suffix("probe:" + name.split(":", 1)[0])
+            emit(prefix + "probe_wall_ms", round(wall * 1000, 3), "h", suffix)
+            emit(prefix + "probe_cpu_ms", round(cpu * 1000, 3), "h", suffix)
+            emit(prefix + "probe_schedule_lag_ms", round(lag * 1000, 3), "h", suffix)
+        
+        for stage, seconds in self.stage_seconds.items():
+            emit(prefix + "stage_ms", round(seconds * 1000, 3), "g", self._suffix("stage:" + stage))
+        self.stage_seconds = {}
+        
+        emit(prefix + "cycle_lag_ms", round(cycle_lag * 1000, 3))
+        emit(prefix + "cycle_drift_ms", round(cycle_drift * 1000, 3))
+        emit(prefix + "errors", self.errors, "c")
+        emit(prefix + "penalty_sleep_seconds", self.penalty_seconds, "c")
+        emit(prefix + "probe_timeouts", scheduler.timeouts, "c")
+        self.errors = 0
+        self.penalty_seconds = 0.0
+        scheduler.timeouts = 0
+        
+        now, cpu = time.monotonic(), time.process_time()
+        if now > self.last_wall:
+            emit(prefix + "cpu_percent", round((cpu - self.last_cpu) / (now - self.last_wall) * 100, 2))
+        self.last_wall, self.last_cpu = now, cpu
+        emit(prefix + "rss_bytes", self.rss_bytes())
+        emit(prefix + "threads", threading.active_count())
+        
+        datagrams, sent_bytes = self.emitter.datagrams_sent, self.emitter.bytes_sent
+        emit(prefix + "datagrams_sent", datagrams - self.last_datagrams, "c")
+        emit(prefix + "bytes_sent", sent_bytes - self.last_bytes, "c")
+        self.last_datagrams, self.last_bytes = datagrams, sent_bytes
+
+    def install_signal_handlers(self):
+        # Signal handlers can only be set from the main thread
+        if hasattr(signal, "SIGUSR1") and threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGUSR1, self.toggle_profiler)
+            signal.signal(signal.SIGUSR2, self.toggle_tracemalloc)
+
+    def profile_thread(self, *args):
+        """Start or stop the calling thread's profiler to follow the current profiling session
+        
+        Also serves as the threading.setprofile hook; the profiler it enables
+        replaces the hook on its first call. Does nothing with a process-wide
+        profiler.
+        """
+        if self.PROCESS_WIDE_PROFILER:
+            return
+        session = self.profile_session
+        profiler = getattr(self.local, "profiler", None)
+        if profiler is not None and self.local.session is not session:
+            profiler.disable()
+            # disable() only clears the hook when called before the stats were taken
+            sys.setprofile(None)
+            self.local.profiler = profiler = None
+        if profiler is None and session is not None:
+            sys.setprofile(None)
+            profiler = self.local.profiler = cProfile.Profile()
+            self.local.session = session
+            self.profilers.append(profiler)
+            profiler.enable()
+
+    def toggle_profiler(self, signum=None, frame=None):
+        """First call starts cProfile on every thread, the next merges them into one .pstats file"""
+        if self.profile_session is None:
+            self.profile_session = object()
+            self.profilers = []
+            if self.PROCESS_WIDE_PROFILER:
+                profiler = cProfile.Profile()
+                self.profilers.append(profiler)
+                profiler.enable()
+            else:
+                threading.setprofile(self.profile_thread)
+                self.profile_thread()
+            logger.info("cProfile started on all threads, send SIGUSR1 again to dump")
+            return
+        self.profile_session = None
+        if self.PROCESS_WIDE_PROFILER:
+            self.profilers[0].disable()
+        else:
+            threading.setprofile(None)
+            # Stops this thread's profiler; the others stop at their next profile_thread() call
+            self.profile_thread()
+        profilers, self.profilers = self.profilers, []
+        stats = None
+        for profiler in profilers:
+            profiler.create_stats()
+            if not profiler.stats:
+                continue
+            if stats is None:
+                stats = pstats.Stats(profiler)
+            else:
+                stats.add(profiler)
+        if stats is None:
+            logger.info("cProfile recorded nothing")
+            return
+        path = os.path.join(self.profile_dir, f"starlink-collector-{int(time.time())}.pstats")
+        stats.dump_stats(path)
+        logger.info(f"cProfile stats written to {path}")
+
+    def toggle_tracemalloc(self, signum=None, frame=None):
+        """First call starts tracemalloc, the next dumps a snapshot and logs the top allocators"""
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(10)
+            logger.info("tracemalloc started, send SIGUSR2 again to dump")
+            return
+        snapshot = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+        path = os.path.join(self.profile_dir, f"starlink-collector-{int(time.time())}.tracemalloc")
+        snapshot.dump(path)
+        for stat in snapshot.statistics("lineno")[:10]:
+            logger.info(f"tracemalloc: {stat}")
+        logger.info(f"tracemalloc snapshot written to {path}")
+
+class MetricStore:
+    """Append-only local time-series files, one pair per metric under <root>/<series>/
+
+    <metric>.dat holds fixed-size blocks of BLOCK_RECORDS records laid out
+    column-wise (all timestamps, then all values, as float64). <metric>.idx
+    holds one entry per block with its time range, value min/max, sum and
+    record count, so range aggregates skip or short-cut whole blocks and only
+    scan partially covered ones through mmap.
+    """
+    BLOCK_RECORDS = 4096
+    BLOCK_BYTES = BLOCK_RECORDS * 16
+    INDEX_ENTRY = struct.Struct("<5dQ")
+    FLOAT = struct.Struct("<d")
+
+    def __init__(self, root):
+        self.root = root
+        self.tails = {}
+
+    def _path(self, series, metric, suffix):
+        safe = "".join(c if c.isalnum() or c in "._-" else "_" for c in metric)
+        return os.path.join(self.root, series, safe + suffix)
+
+    def _index(self, series, metric):
+        try:
+            with open(self._path(series, metric, ".idx"), "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return []
+        return list(self.INDEX_ENTRY.iter_unpack(data[:len(data) - len(data) % self.INDEX_ENTRY.size]))
+
+    def _tail(self, series, metric):
+        key = (series, metric)
+        tail = self.tails.get(key)
+        if tail is None:
+            entries = self._index(series, metric)
+            if entries:
+                tail = [len(entries) - 1, *entries[-1]]
+            else:
+                tail = [0, math.inf, -math.inf, math.inf, -math.inf, 0.0, 0]
+            self.tails[key] = tail
+        return tail
+
+    def append(self, series, timestamp, metrics):
+        """Append one record to each metric's series"""
+        os.makedirs(os.path.join(self.root, series), exist_ok=True)
+        for metric, value in metrics.items():
+            tail = self._tail(series, metric)
+            if tail[6] == self.BLOCK_RECORDS:
+                tail[:] = [tail[0] + 1, math.inf, -math.inf, math.inf, -math.inf, 0.0, 0]
+            block, count = tail[0], tail[6]
+            base = block * self.BLOCK_BYTES
+            
+            fd = os.open(self._path(series, metric, ".dat"), os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                if count == 0:
+                    os.ftruncate(fd, base + self.BLOCK_BYTES)
+                os.pwrite(fd, self.FLOAT.pack(timestamp), base + count * 8)
+                os.pwrite(fd, self.FLOAT.pack(value), base + (self.BLOCK_RECORDS + count) * 8)
+            finally:
+                os.close(fd)
+            
+            tail[1] = min(tail[1], timestamp)
+            tail[2] = max(tail[2], timestamp)
+            tail[3] = min(tail[3], value)
+            tail[4] = max(tail[4], value)
+            tail[5] += value
+            tail[6] = count + 1
+            fd = os.open(self._path(series, metric, ".idx"), os.O_WRONLY | os.O_CREAT, 0o644)
+            try:
+                os.pwrite(fd, self.INDEX_ENTRY.pack(*tail[1:]), block * self.INDEX_ENTRY.size)
+            finally:
+                os.close(fd)
+
+    def series(self):
+        try:
+            return sorted(os.listdir(self.root))
+        except FileNotFoundError:
+            return []
+
+    def metrics(self, series):
+        try:
+            names = os.listdir(os.path.join(self.root, series))
+        except FileNotFoundError:
+            return []
+        return sorted(name[:-4] for name in names if name.endswith(".idx"))
+
+    def scan(self, series, metric, start, end, summary_ok=False):
+        """Yield (timestamps, values) arrays for records with start <= t <= end
+
+        With summary_ok, blocks wholly inside the range are yielded as their
+        index entry (t_min, t_max, v_min, v_max, v_sum, count) instead.
+        """
+        entries = self._index(series, metric)
+        if not entries:
+            return
+        with open(self._path(series, metric, ".dat"), "rb") as f, \
+                mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm, \
+                memoryview(mm) as view:
+            for block, entry in enumerate(entries):
+                t_min, t_max, _, _, _, count = entry
+                if count == 0 or t_max < start or t_min > end:
+                    continue
+                if summary_ok and start <= t_min and t_max <= end:
+                    yield entry
+                    continue
+                base = block * self.BLOCK_BYTES
+                with view[base:base + count * 8].cast("d") as ts:
+                    lo = bisect.bisect_left(ts, start)
+                    hi = bisect.bisect_right(ts, end)
+                values_base = base + self.BLOCK_RECORDS * 8
+                timestamps = array("d")
+                timestamps.frombytes(view[base + lo * 8:base + hi * 8])
+                values = array("d")
+                values.frombytes(view[values_base + lo * 8:values_base + hi * 8])
+                yield timestamps, values
+
+    def aggregate(self, series, metric, agg, start, end):
+        """count, sum, avg, min, max, last or a percentile such as p95 / p99.9; None if no data"""
+        percentile = float(agg[1:]) if agg.startswith("p") else None
+        summary_ok = agg in ("count", "sum", "avg", "min", "max")
+        count, total, low, high = 0, 0.0, math.inf, -math.inf
+        collected = array("d")
+        last = None
+        for chunk in self.scan(series, metric, start, end, summary_ok=summary_ok):
+            if len(chunk) == 6:
+                _, _, v_min, v_max, v_sum, n = chunk
+                count += n
+                total += v_sum
+                low = min(low, v_min)
+                high = max(high, v_max)
+                continue
+            timestamps, values = chunk
+            if not values:
+                continue
+            count += len(values)
+            total += sum(values)
+            low = min(low, min(values))
+            high = max(high, max(values))
+            last = values[-1]
+            if percentile is not None:
+                collected.extend(values)
+        if not count:
+            return None
+        if agg == "count":
+            return count
+        if agg == "sum":
+            return total
+        if agg == "avg":
+            return total / count
+        if agg == "min":
+            return low
+        if agg == "max":
+            return high
+        if agg == "last":
+            return last
+        if percentile is not None:
+            ordered = sorted(collected)
+            rank = percentile / 100 * (len(ordered) - 1)
+            lower = int(rank)
+            upper = min(lower + 1, len(ordered) - 1)
+            return ordered[lower] + (ordered[upper] - ordered[lower]) * (rank - lower)
+        raise ValueError(f"Unknown aggregate {agg}")
+
+class ProbeRecorder:
+    """Raw probe results captured to compact per-target files under <root>/<series>/
+
+    ping.rtt holds the RTT samples of each burst as float32 and ping.rec one
+    (time, sent, received, first sample) record per burst, so a burst's
+    samples are found by position and samples orphaned by a crash between
+    the two writes are never attributed to another burst. http.rec and
+    speed.rec hold one fixed-size record per probe run. A record torn by a
+    crash is cut off before the next append. Every derived metric can be
+    recomputed from these files offline, see BatchRecompute.
+    """
+    PING = struct.Struct("<dHHQ")
+    RTT_SIZE = 4
+    HTTP = struct.Struct("<d9f")
+    SPEED = struct.Struct("<d8d")
+    # Field order of the http.rec and speed.rec records after the timestamp
+    HTTP_FIELDS = ("dns", "connect", "tls", "starttransfer", "total", "size", "status", "warm_starttransfer", "warm_total")
+    SPEED_FIELDS = (
+        "download_mbps", "download_max_mbps", "download_min_mbps", "download_bytes",
+        "upload_mbps", "upload_max_mbps", "upload_min_mbps", "upload_bytes",
+    )
+
+    def __init__(self, root):
+        self.root = root
+        self.lock = threading.Lock()
+        self.created = set()
+        self.sizes = {}
+
+    def _append(self, series, name, data, record_size):
+        """Append data and return the file size before it; callers hold the lock"""
+        path = os.path.join(self.root, series, name)
+        size = self.sizes.get(path)
+        if size is None:
+            directory = os.path.dirname(path)
+            if directory not in self.created:
+                os.makedirs(directory, exist_ok=True)
+                self.created.add(directory)
+            # Drop a partial record left by a crash so later records stay aligned
+            size = os.path.getsize(path) if os.path.exists(path) else 0
+            if size % record_size:
+                size -= size % record_size
+                os.truncate(path, size)
+        with open(path, "ab") as f:
+            f.write(data)
+        self.sizes[path] = size + len(data)
+        return size
+
+    def record_ping(self, series, timestamp, rtts, sent):
+        with self.lock:
+            first = self._append(series, "ping.rtt", array("f", rtts).tobytes(), self.RTT_SIZE) // self.RTT_SIZE
+            self._append(series, "ping.rec", self.PING.pack(timestamp, sent, len(rtts), first), self.PING.size)
+
+    def record_http(self, series, timestamp, cold, warm):
+        warm_times = (warm["starttransfer"], warm["total"]) if warm and warm["reused"] else (math.nan, math.nan)
+        record = self.HTTP.pack(
+            timestamp, cold["dns"], cold["connect"], cold["tls"], cold["starttransfer"],
+            cold["total"], cold["size"], cold["status"], *warm_times,
+        )
+        with self.lock:
+            self._append(series, "http.rec", record, self.HTTP.size)
+
+    def record_speed(self, series, timestamp, download, upload):
+        fields = []
+        for result in (download, upload):
+            if result and result["bytes"] > 0:
+                fields += [result["mbps"], result["max_mbps"], result["min_mbps"], result["bytes"]]
+            else:
+                fields += [math.nan] * 4
+        with self.lock:
+            self._append(series, "speed.rec", self.SPEED.pack(timestamp, *fields), self.SPEED.size)
+
+    def series(self):
+        try:
+            return sorted(os.listdir(self.root))
+        except FileNotFoundError:
+            return []
+
+    def _read(self, series, name, dtype):
+        try:
+            with open(os.path.join(self.root, series, name), "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return np.zeros(0, dtype=dtype)
+        return np.frombuffer(data, dtype=dtype, count=len(data) // dtype.itemsize)
+
+    def load(self, series, start=-math.inf, end=math.inf):
+        """Captured results with start <= t <= end as numpy arrays
+        
+        Returns {"ping": (records, rtts, offsets), "http": records, "speed": records},
+        where ping burst i has the samples rtts[offsets[i]:offsets[i + 1]].
+        """
+        ping = self._read(series, "ping.rec", np.dtype([("t", "<f8"), ("sent", "<u2"), ("received", "<u2"), ("first", "<u8")]))
+        ping = ping[(ping["t"] >= start) & (ping["t"] <= end)]
+        samples = self._read(series, "ping.rtt", np.dtype("<f4"))
+        ping = ping[ping["first"] + ping["received"] <= len(samples)]
+        # Gather each burst's samples by its recorded position, skipping any orphans in between
+        counts = ping["received"].astype(np.int64)
+        offsets = np.concatenate(([0], np.cumsum(counts)))
+        index = np.repeat(ping["first"].astype(np.int64) - offsets[:-1], counts) + np.arange(offsets[-1])
+        ping_range = (ping, samples[index], offsets)
+        
+        captured = {"ping": ping_range}
+        for kind, fields in (("http", self.HTTP_FIELDS), ("speed", self.SPEED_FIELDS)):
+            code = "<f4" if kind == "http" else "<f8"
+            records = self._read(series, f"{kind}.rec", np.dtype([("t", "<f8")] + [(field, code) for field in fields]))
+            captured[kind] = records[(records["t"] >= start) & (records["t"] <= end)]
+        return captured
+
+class ContinuousProber:
+    """Background echo probing of every target at a low fixed rate, with outage detection
+
+    One thread and one socket probe all targets each tick. Outcomes are
+    processed in send order and written to a preallocated ring buffer per
+    target (send time, RTT or NaN when lost), so memory and CPU stay flat
+    however long it runs. A run of at least outage_threshold consecutive
+    losses is an outage. on_outage(key, start, duration, lost, ended) is
+    called once when the run reaches the threshold, with ended False, and
+    again with ended True and the full duration on the first reply after it.
+    Shorter runs count as micro-drops. Sends are spread evenly over each
+    tick. Above MAX_PACKETS_PER_SECOND in total the thread takes a growing
+    share of the GIL from the emit loop and probe workers.
+    """
+    MAX_PACKETS_PER_SECOND = 2000
+
+    class State:
+        __slots__ = ("key", "ip", "lock", "times", "rtts", "written", "read", "outstanding",
+                     "run", "run_start", "outage_seconds", "outages", "microdrops")
+
+        def __init__(self, key, ip, ring_size):
+            self.key = key
+            self.ip = ip
+            self.lock = threading.Lock()
+            self.times = array("d", bytes(8 * ring_size))
+            self.rtts = array("d", bytes(8 * ring_size))
+            self.written = 0
+            self.read = 0
+            self.outstanding = deque()
+            self.run = 0
+            self.run_start = 0.0
+            self.outage_seconds = 0.0
+            self.outages = 0
+            self.microdrops = 0
+
+    def __init__(self, rate_hz=10, reply_timeout=1.0, ring_seconds=600, outage_threshold=5,
+                 udp_echo_port=7, on_sample=None, on_outage=None):
+        self.period = 1.0 / rate_hz
+        self.reply_timeout = reply_timeout
+        self.ring_size = max(1, int(ring_seconds * rate_hz))
+        self.outage_threshold = outage_threshold
+        self.udp_echo_port = udp_echo_port
+        self.on_sample = on_sample
+        self.on_outage = on_outage
+        self.profile_hook = None
+        self.states = []
+        self.by_key = {}
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def add_target(self, key, ip):
+        state = self.State(key, ip, self.ring_size)
+        self.states.append(state)
+        self.by_key[key] = state
+
+    def start(self):
+        self.thread = threading.Thread(target=self._loop, name="continuous-prober", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def _loop(self):
+        prober = IcmpProber(self.udp_echo_port)
+        replies = {}
+        next_tick = time.monotonic()
+        try:
+            while not self.stop_event.is_set():
+                if self.profile_hook:
+                    _run_profile_hook(self.profile_hook)
+                # Spread the sends over the tick; replies to one back-to-back burst
+                # to a large fleet overflow the socket's receive buffer
+                spacing = self.period / max(1, len(self.states))
+                for index, state in enumerate(self.states):
+                    self._poll_until(prober, replies, next_tick + index * spacing)
+                    state.outstanding.append((prober.send(state.ip), time.time()))
+                next_tick += self.period
+                # Fall behind gracefully instead of sending a burst to catch up
+                if next_tick < time.monotonic():
+                    next_tick = time.monotonic() + self.period
+                self._poll_until(prober, replies, next_tick)
+                prober.expire(self.reply_timeout)
+                now = time.time()
+                for state in self.states:
+                    self._resolve(state, replies, now)
+        except Exception as e:
+            logger.error(f"Continuous prober stopped: {e}")
+        finally:
+            prober.close()
+
+    @staticmethod
+    def _poll_until(prober, replies, deadline):
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            for seq, _, rtt in prober.poll(remaining):
+                replies[seq] = rtt
+
+    def _resolve(self, state, replies, now):
+        # Handle outcomes strictly in send order so loss runs are contiguous
+        outstanding = state.outstanding
+        while outstanding:
+            seq, sent_at = outstanding[0]
+            rtt = replies.pop(seq, None)
+            if rtt is None:
+                if now - sent_at <= self.reply_timeout:
+                    break
+                rtt = math.nan
+            outstanding.popleft()
+            self._record(state, sent_at, rtt)
+
+    def _record(self, state, sent_at, rtt):
+        outage = None
+        with state.lock:
+            index = state.written % self.ring_size
+            state.times[index] = sent_at
+            state.rtts[index] = rtt
+            state.written += 1
+            if rtt != rtt:
+                state.run += 1
+                if state.run == 1:
+                    state.run_start = sent_at
+                if state.run == self.outage_threshold:
+                    state.outage_seconds += self.outage_threshold * self.period
+                    outage = (state.run_start, sent_at + self.period - state.run_start, state.run, False)
+                elif state.run > self.outage_threshold:
+                    state.outage_seconds += self.period
+            else:
+                if state.run >= self.outage_threshold:
+                    state.outages += 1
+                    outage = (state.run_start, sent_at - state.run_start, state.run, True)
+                elif state.run:
+                    state.microdrops += 1
+                state.run = 0
+        if outage and self.on_outage:
+            self.on_outage(state.key, *outage)
+        if rtt == rtt and self.on_sample:
+            self.on_sample(state.key, rtt)
+
+    def drain(self, key):
+        """Loss, RTT, outage and micro-drop metrics for the samples since the last drain"""
+        state = self.by_key[key]
+        with state.lock:
+            first = max(state.read, state.written - self.ring_size)
+            sent = state.written - first
+            lost = 0
+            total = 0.0
+            for position in range(first, state.written):
+                rtt = state.rtts[position % self.ring_size]
+                if rtt != rtt:
+                    lost += 1
+                else:
+                    total += rtt
+            state.read = state.written
+            metrics = {
+                "outage_seconds": state.outage_seconds,
+                "outage_count": state.outages,
+                "microdrop_count": state.microdrops,
+            }
+            state.outage_seconds = 0.0
+            state.outages = 0
+            state.microdrops = 0
+        if not sent:
+            return {}
+        metrics["continuous_probes_sent"] = sent
+        metrics["continuous_loss_pct"] = lost / sent * 100
+        if sent > lost:
+            metrics["continuous_rtt_avg_ms"] = total / (sent - lost)
+        return metrics
+
+def default_gateway(route_file="/proc/net/route"):
+    """IPv4 gateway of the default route from the kernel routing table, or None"""
+    try:
+        with open(route_file) as f:
+            next(f)
+            for line in f:
+                fields = line.split()
+                # Destination 0.0.0.0 with the RTF_GATEWAY flag; addresses are little-endian hex
+                if len(fields) > 3 and fields[1] == "00000000" and int(fields[3], 16) & 0x2:
+                    return socket.inet_ntoa(struct.pack("<I", int(fields[2], 16)))
+    except (OSError, ValueError, StopIteration):
+        pass
+    return None
+
+class PathProber:
+    """Concurrent echo probing of each segment on the way to the internet
+
+    Targets are (segment, address) pairs in path order, typically the LAN
+    gateway, the dish, the first hop upstream of them (the Starlink PoP)
+    and public anchors. The address "auto" is the first hop beyond the
+    other targets, found by TTL-limited probes towards the first anchor and
+    looked up again every discovery_interval. One thread and one socket
+    pace probes to all targets round robin at packets_per_minute in total,
+    discovery included, so the budget does not grow with the target count.
+    drain() reports RTT and loss per target along with the change from the
+    segment before it, which places a slowdown on the LAN, the dish, the
+    Starlink network or beyond.
+    """
+    ICMP_TIME_EXCEEDED = 11
+
+    class Target:
+        __slots__ = ("segment", "address", "auto", "received", "lost", "total", "minimum")
+
+        def __init__(self, segment, address):
+            self.segment = segment
+            self.auto = address == "auto"
+            self.address = None if self.auto else address
+            self.received = 0
+            self.lost = 0
+            self.total = 0.0
+            self.minimum = math.inf
+
+    def __init__(self, targets, packets_per_minute=240, reply_timeout=1.0, max_hops=6,
+                 discovery_interval=600, udp_echo_port=7):
+        self.targets = [self.Target(segment, address) for segment, address in targets]
+        self.period = 60.0 / packets_per_minute
+        self.reply_timeout = reply_timeout
+        self.max_hops = max_hops
+        self.discovery_interval = discovery_interval
+        self.udp_echo_port = udp_echo_port
+        self.hop = next((target for target in self.targets if target.auto), None)
+        # Discovery traces towards the first target past the hop
+        beyond = self.targets[self.targets.index(self.hop) + 1:] if self.hop else []
+        self.anchor = beyond[0].address if beyond else None
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.profile_hook = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self._loop, name="path-prober", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def _loop(self):
+        prober = IcmpProber(self.udp_echo_port, recv_errors=True)
+        inflight = {}
+        hops = {}
+        responders = {}
+        discover = self.hop is not None and self.anchor is not None
+        next_send = next_discovery = time.monotonic()
+        discovery_deadline = None
+        turn = 0
+        try:
+            while not self.stop_event.is_set():
+                if self.profile_hook:
+                    _run_profile_hook(self.profile_hook)
+                now = time.monotonic()
+                if discover and now >= next_discovery:
+                    for ttl in range(1, self.max_hops + 1):
+                        hops[prober.send(self.anchor, ttl=ttl)] = ttl
+                    discovery_deadline = now + self.reply_timeout
+                    next_discovery = now + self.discovery_interval
+                    # Discovery probes come out of the same budget
+                    next_send = max(next_send, now) + self.max_hops * self.period
+                elif now >= next_send:
+                    active = [target for target in self.targets if target.address]
+                    if active:
+                        target = active[turn % len(active)]
+                        turn += 1
+                        inflight[prober.send(target.address)] = target
+                    next_send += self.period
+                    # Fall behind gracefully instead of sending a burst to catch up
+                    if next_send < now:
+                        next_send = now + self.period
+
+                wake = min(next_send, next_discovery if discover else math.inf, discovery_deadline or math.inf)
+                for seq, address, rtt in prober.poll(wake - time.monotonic()):
+                    ttl = hops.pop(seq, None)
+                    if ttl is not None:
+                        responders[ttl] = address
+                        continue
+                    target = inflight.pop(seq, None)
+                    if target is not None:
+                        with self.lock:
+                            target.received += 1
+                            target.total += rtt
+                            target.minimum = min(target.minimum, rtt)
+                for seq, _, responder, icmp_type, _ in prober.errors():
+                    ttl = hops.pop(seq, None)
+                    if ttl is not None:
+                        if icmp_type == self.ICMP_TIME_EXCEEDED:
+                            responders[ttl] = responder
+                        continue
+                    # Unreachable and other errors for a regular probe count as a loss
+                    target = inflight.pop(seq, None)
+                    if target is not None:
+                        with self.lock:
+                            target.lost += 1
+                for seq, _ in prober.expire(self.reply_timeout):
+                    hops.pop(seq, None)
+                    target = inflight.pop(seq, None)
+                    if target is not None:
+                        with self.lock:
+                            target.lost += 1
+                if discovery_deadline is not None and time.monotonic() >= discovery_deadline:
+                    self._choose_hop(responders)
+                    hops.clear()
+                    responders = {}
+                    discovery_deadline = None
+        except Exception as e:
+            logger.error(f"Path prober stopped: {e}")
+        finally:
+            prober.close()
+
+    def _choose_hop(self, responders):
+        """Take the first responder that is not already a target; keep the old hop if none answered"""
+        known = {target.address for target in self.targets if not target.auto}
+        for ttl in sorted(responders):
+            address = responders[ttl]
+            if address == self.anchor:
+                break
+            if address in known:
+                continue
+            if address != self.hop.address:
+                logger.info(f"Path hop for segment {self.hop.segment}: {address} at TTL {ttl}")
+                with self.lock:
+                    self.hop.address = address
+                    self.hop.received = self.hop.lost = 0
+                    self.hop.total = 0.0
+                    self.hop.minimum = math.inf
+            return
+        if self.hop.address is None:
+            logger.warning(f"No path hop found towards {self.anchor} within {self.max_hops} hops")
+
+    def drain(self):
+        """Per-target metrics since the last drain as (index, segment, address, metrics), in path order
+
+        The deltas compare a target with the best target of the nearest
+        earlier segment that answered, so the first segment's delta is its
+        own RTT as seen from the collector.
+        """
+        with self.lock:
+            counts = []
+            for target in self.targets:
+                counts.append((target.segment, target.address, target.received, target.lost, target.total, target.minimum))
+                target.received = target.lost = 0
+                target.total = 0.0
+                target.minimum = math.inf
+
+        results = []
+        base_rtt, base_loss = 0.0, 0.0
+        segment, best = None, None
+        for index, (name, address, received, lost, total, minimum) in enumerate(counts):
+            if name != segment:
+                if best is not None:
+                    base_rtt, base_loss = best
+                segment, best = name, None
+            resolved = received + lost
+            if not address or not resolved:
+                continue
+            loss = lost / resolved * 100
+            metrics = {
+                "path_probes_sent": resolved,
+                "path_loss_pct": loss,
+                "path_loss_delta_pct": loss - base_loss,
+            }
+            if received:
+                average = total / received
+                metrics["path_rtt_avg_ms"] = average
+                metrics["path_rtt_min_ms"] = minimum
+                metrics["path_rtt_delta_ms"] = average - base_rtt
+                if best is None or average < best[0]:
+                    best = (average, loss)
+            results.append((index, name, address, metrics))
+        return results
+
+DEFAULT_RULES = {
+    "scores": {
+        "quality_latency_score": {
+            "metric": "ping_avg_ms",
+            "curve": [
+                {"upto": 1, "value": 100},
+                {"upto": 10, "value": 100, "from": 1, "slope": -5},
+                {"upto": 50, "value": 50, "from": 10, "slope": -1.25},
+                {"value": 0},
+            ],
+        },
+        "quality_stability_score": {
+            "base": 100,
+            "penalties": [
+                {"metric": "ping_drop_rate", "scale": 2},
+                {"metric": "ping_mdev_ms", "scale": 10, "max": 50},
+            ],
+        },
+        "quality_http_score": {
+            "metric": "http_time_to_first_byte_ms",
+            "curve": [
+                {"upto": 5, "value": 100},
+                {"upto": 50, "value": 100, "from": 5, "slope": -2},
+                {"value": 10, "from": 50, "slope": -0.2},
+            ],
+        },
+        "quality_overall_score": {
+            "weights": {"quality_latency_score": 0.4, "quality_stability_score": 0.4, "quality_http_score": 0.2},
+            "min_inputs": 2,
+        },
+    },
+    "checks": {
+        "starlink.connectivity": {
+            "requires": ["ping_success_rate"],
+            "hysteresis": {"ping_success_rate": 2},
+            "levels": [
+                {"status": 0, "when": [["ping_success_rate", ">=", 95]], "message": "Starlink connected - {ping_success_rate:.1f}% success rate"},
+                {"status": 1, "when": [["ping_success_rate", ">=", 80]], "message": "Starlink connectivity degraded - {ping_success_rate:.1f}% success rate"},
+                {"status": 2, "message": "Starlink connectivity critical - {ping_success_rate:.1f}% success rate"},
+            ],
+            "missing": {"status": 3, "message": "Unable to determine connectivity status"},
+        },
+        "starlink.performance": {
+            "requires": ["quality_overall_score"],
+            "hysteresis": {"quality_overall_score": 5},
+            "levels": [
+                {"status": 0, "when": [["quality_overall_score", ">=", 80]], "message": "Excellent performance - {quality_overall_score:.1f}/100 score"},
+                {"status": 1, "when": [["quality_overall_score", ">=", 60]], "message": "Good performance - {quality_overall_score:.1f}/100 score"},
+                {"status": 1, "when": [["quality_overall_score", ">=", 40]], "message": "Fair performance - {quality_overall_score:.1f}/100 score"},
+                {"status": 2, "message": "Poor performance - {quality_overall_score:.1f}/100 score"},
+            ],
+        },
+        "starlink.latency": {
+            "requires": ["ping_avg_ms"],
+            "hysteresis": {"ping_avg_ms": 1},
+            "levels": [
+                {"status": 0, "when": [["ping_avg_ms", "<=", 5]], "message": "Excellent latency - {ping_avg_ms:.1f}ms average"},
+                {"status": 1, "when": [["ping_avg_ms", "<=", 20]], "message": "Good latency - {ping_avg_ms:.1f}ms average"},
+                {"status": 1, "when": [["ping_avg_ms", "<=", 50]], "message": "Fair latency - {ping_avg_ms:.1f}ms average"},
+                {"status": 2, "message": "High latency - {ping_avg_ms:.1f}ms average"},
+            ],
+        },
+        "starlink.stability": {
+            "requires": ["ping_drop_rate"],
+            "defaults": {"ping_mdev_ms": 0},
+            "hysteresis": {"ping_mdev_ms": 0.5},
+            "levels": [
+                {"status": 0, "when": [["ping_drop_rate", "==", 0], ["ping_mdev_ms", "<=", 1]], "message": "Excellent stability - 0% loss, {ping_mdev_ms:.1f}ms jitter"},
+                {"status": 1, "when": [["ping_drop_rate", "<=", 1], ["ping_mdev_ms", "<=", 5]], "message": "Good stability - {ping_drop_rate:.1f}% loss, {ping_mdev_ms:.1f}ms jitter"},
+                {"status": 1, "when": [["ping_drop_rate", "<=", 5], ["ping_mdev_ms", "<=", 10]], "message": "Fair stability - {ping_drop_rate:.1f}% loss, {ping_mdev_ms:.1f}ms jitter"},
+                {"status": 2, "message": "Poor stability - {ping_drop_rate:.1f}% loss, {ping_mdev_ms:.1f}ms jitter"},
+            ],
+        },
+    },
+}
+
+class RuleCheck:
+    """One compiled service check: required inputs, defaults and ordered levels"""
+    __slots__ = ("name", "requires", "defaults", "levels", "missing")
+    
+    def __init__(self, name, requires, defaults, levels, missing):
+        self.name = name
+        self.requires = requires
+        self.defaults = defaults
+        self.levels = levels
+        self.missing = missing
+    
+    def evaluate(self, values, previous=None):
+        """Return (status, message template, values) for values, or None to skip the check
+        
+        The template is left unformatted so that checks which are not sent cost nothing.
+        """
+        if any(values.get(metric) is None for metric in self.requires):
+            if self.missing is None:
+                return None
+            status, template = self.missing
+            return status, template, values
+        if self.defaults:
+            values = {**self.defaults, **values}
+        # Moving to a better status must clear the threshold by the hysteresis margin
+        hysteresis = previous in (1, 2)
+        for status, conditions, template in self.levels:
+            strict = hysteresis and status < previous
+            for metric, compare, threshold, tightened in conditions:
+                value = values.get(metric)
+                if value is None or not compare(value, tightened if strict else threshold):
+                    break
+            else:
+                return status, template, values
+        return None
+    
+    def evaluate_columns(self, columns, size, previous=None):
+        """Status of every row as an int array, -1 where the check would be skipped"""
+        status = np.full(size, -1, dtype=np.int8)
+        if self.defaults:
+            columns = dict(columns)
+            for metric, default in self.defaults.items():
+                values = columns.get(metric)
+                columns[metric] = np.full(size, float(default)) if values is None else np.where(np.isnan(values), default, values)
+        hysteresis = previous in (1, 2)
+        # Assign from the last level back so the first matching level wins
+        for level_status, conditions, _ in reversed(self.levels):
+            strict = hysteresis and level_status < previous
+            matched = np.ones(size, dtype=bool)
+            for metric, compare, threshold, tightened in conditions:
+                values = columns.get(metric)
+                if values is None:
+                    matched[:] = False
+                    break
+                matched &= ~np.isnan(values) & compare(values, tightened if strict else threshold)
+            status[matched] = level_status
+        missing = np.zeros(size, dtype=bool)
+        for metric in self.requires:
+            missing |= np.isnan(columns[metric]) if metric in columns else True
+        status[missing] = self.missing[0] if self.missing else -1
+        return status
+
+class RuleEngine:
+    """Quality scores and service check levels compiled once from a rules document
+    
+    Scores are evaluated in order, so a weighted score can combine the ones before it.
+    A curve is a list of segments {"upto", "value", "from", "slope"}: the first segment
+    whose upto is >= the input gives value + slope * (input - from); the last segment
+    may omit upto. Check levels are tried in order and the first whose conditions all
+    hold wins; a check whose required inputs are missing reports its "missing" level,
+    or is skipped. Hysteresis margins must be cleared before a check moves to a better
+    status, so a value hovering on a threshold does not flap.
+    """
+    
+    OPERATORS = {
+        "<": operator.lt, "<=": operator.le, ">": operator.gt,
+        ">=": operator.ge, "==": operator.eq, "!=": operator.ne,
+    }
+    # Direction in which a hysteresis margin moves each threshold
+    TIGHTEN = {"<": -1, "<=": -1, ">": 1, ">=": 1, "==": 0, "!=": 0}
+    # Keys each part of a rules document may use; anything else is a typo
+    SCORE_KEYS = {"metric", "curve", "base", "penalties", "weights", "min_inputs"}
+    SEGMENT_KEYS = {"upto", "value", "from", "slope"}
+    PENALTY_KEYS = {"metric", "scale", "max"}
+    CHECK_KEYS = {"requires", "defaults", "hysteresis", "levels", "missing"}
+    LEVEL_KEYS = {"status", "when", "message"}
+    
+    def __init__(self, rules):
+        self.scores = [self._compile_score(name, spec) for name, spec in rules.get("scores", {}).items()]
+        self.checks = [self._compile_check(name, spec) for name, spec in rules.get("checks", {}).items()]
+    
+    @classmethod
+    def from_file(cls, path):
+        """Load rules from a JSON file merged over DEFAULT_RULES
+        
+        Each score or check in the file replaces the built-in one of the same
+        name or is added after them; null removes a built-in one. Everything
+        the file does not name keeps its default.
+        """
+        with open(path) as handle:
+            rules = json.load(handle)
+        cls._check_keys(f"Rules file {path}", rules, {"scores", "checks"})
+        merged = {}
+        for section in ("scores", "checks"):
+            entries = dict(DEFAULT_RULES[section])
+            for name, spec in rules.get(section, {}).items():
+                if spec is None:
+                    entries.pop(name, None)
+                else:
+                    entries[name] = spec
+            merged[section] = entries
+        return cls(merged)
+    
+    @staticmethod
+    def _check_keys(where, spec, allowed):
+        if not isinstance(spec, dict):
+            raise ValueError(f"{where} must be an object")
+        unknown = set(spec) - allowed
+        if unknown:
+            raise ValueError(f"{where}: unknown keys {', '.join(sorted(unknown))}")
+    
+    @staticmethod
+    def _clamp(value):
+        return max(0, min(100, value))
+    
+    def _compile_score(self, name, spec):
+        self._check_keys(f"Score {name}", spec, self.SCORE_KEYS)
+        if "curve" in spec:
+            metric = spec["metric"]
+            for segment in spec["curve"]:
+                self._check_keys(f"Score {name} curve segment", segment, self.SEGMENT_KEYS)
+            bounds = [segment.get("upto", math.inf) for segment in spec["curve"]]
+            if any(low >= high for low, high in zip(bounds, bounds[1:])):
+                raise ValueError(f"Score {name}: curve upto bounds must be ascending, only the last may be omitted")
+            segments = [
+                (segment["value"], segment.get("from", 0), segment.get("slope", 0))
+                for segment in spec["curve"]
+            ]
+            
+            def evaluate(values):
+                x = values.get(metric)
+                if x is None:
+                    return None
+                value, origin, slope = segments[min(bisect.bisect_left(bounds, x), len(segments) - 1)]
+                return self._clamp(value + slope * (x - origin))
+            
+            def evaluate_columns(columns, size):
+                x = columns.get(metric)
+                if x is None:
+                    return None
+                index = np.minimum(np.searchsorted(bounds, x), len(segments) - 1)
+                value, origin, slope = (np.array(column)[index] for column in zip(*segments))
+                return np.where(np.isnan(x), np.nan, np.clip(value + slope * (x - origin), 0, 100))
+        elif "penalties" in spec:
+            base = spec.get("base", 100)
+            for penalty in spec["penalties"]:
+                self._check_keys(f"Score {name} penalty", penalty, self.PENALTY_KEYS)
+            penalties = [
+                (penalty["metric"], penalty.get("scale", 1), penalty.get("max", math.inf))
+                for penalty in spec["penalties"]
+            ]
+            
+            def evaluate(values):
+                score = base
+                seen = False
+                for metric, scale, cap in penalties:
+                    x = values.get(metric)
+                    if x is not None:
+                        score -= min(x * scale, cap)
+                        seen = True
+                return self._clamp(score) if seen else None
+            
+            def evaluate_columns(columns, size):
+                score = np.full(size, float(base))
+                seen = np.zeros(size, dtype=bool)
+                for metric, scale, cap in penalties:
+                    x = columns.get(metric)
+                    if x is not None:
+                        present = ~np.isnan(x)
+                        score -= np.where(present, np.minimum(x * scale, cap), 0)
+                        seen |= present
+                return np.where(seen, np.clip(score, 0, 100), np.nan)
+        elif "weights" in spec:
+            weights = list(spec["weights"].items())
+            min_inputs = spec.get("min_inputs", 1)
+            
+            def evaluate(values):
+                present = [(values[metric], weight) for metric, weight in weights if metric in values]
+                if len(present) < min_inputs:
+                    return None
+                return sum(value * weight for value, weight in present)
+            
+            def evaluate_columns(columns, size):
+                total = np.zeros(size)
+                count = np.zeros(size, dtype=int)
+                for metric, weight in weights:
+                    x = columns.get(metric)
+                    if x is not None:
+                        present = ~np.isnan(x)
+                        total += np.where(present, x * weight, 0)
+                        count += present
+                return np.where(count >= min_inputs, total, np.nan)
+        else:
+            raise ValueError(f"Score {name} needs a curve, penalties or weights")
+        return name, evaluate, evaluate_columns
+    
+    def _compile_check(self, name, spec):
+        self._check_keys(f"Check {name}", spec, self.CHECK_KEYS)
+        margins = spec.get("hysteresis", {})
+        levels = []
+        for level in spec["levels"]:
+            self._check_keys(f"Check {name} level", level, self.LEVEL_KEYS)
+            conditions = []
+            for metric, op, threshold in level.get("when", ()):
+                if op not in self.OPERATORS:
+                    raise ValueError(f"Check {name}: unknown operator {op!r}")
+                margin = margins.get(metric, 0) * self.TIGHTEN[op]
+                conditions.append((metric, self.OPERATORS[op], threshold, threshold + margin))
+            levels.append((level["status"], tuple(conditions), level.get("message")))
+        missing = spec.get("missing")
+        if missing:
+            self._check_keys(f"Check {name} missing level", missing, self.LEVEL_KEYS - {"when"})
+        return RuleCheck(
+            name, tuple(spec.get("requires", ())), spec.get("defaults", {}), tuple(levels),
+            (missing["status"], missing.get("message")) if missing else None,
+        )
+    
+    def score(self, values):
+        """Compute every score whose inputs are present; values maps metric name to value"""
+        values = dict(values)
+        scores = {}
+        for name, evaluate, _ in self.scores:
+            result = evaluate(values)
+            if result is not None:
+                scores[name] = values[name] = result
+        return scores
+    
+    def score_columns(self, columns, size):
+        """score() over whole columns at once: metric name -> float array, NaN where missing"""
+        columns = dict(columns)
+        scores = {}
+        for name, _, evaluate_columns in self.scores:
+            result = evaluate_columns(columns, size)
+            if result is not None:
+                scores[name] = columns[name] = result
+        return scores
+
+class BatchRecompute:
+    """Every derived metric over a whole ProbeRecorder capture, computed column-wise with numpy
+
+    Probe results are joined onto a fixed emit grid the way the scheduler
+    serves them live: each row takes the latest result of each probe unless
+    it is older than that probe's max age, with the ping bursts between two
+    emits pooled into one first. Ping statistics, HTTP and speed
+    metrics, quality scores and trends are then computed over whole columns.
+    Only check hysteresis depends on the previous state; each check is
+    evaluated once per possible previous state and a scan picks between them.
+    """
+
+    def __init__(self, rules, horizons, patterns=("*",), slots=20, ewma_alpha=0.3, max_ages=None):
+        self.rules = rules
+        self.horizons = horizons
+        self.patterns = patterns
+        self.slots = slots
+        self.ewma_alpha = ewma_alpha
+        self.max_ages = max_ages or {}
+
+    def run(self, captured, interval, start=None, end=None):
+        """Return (times, metric columns, check status columns); -1 marks a skipped check"""
+        ping, rtts, offsets = captured["ping"]
+        stamps = [records["t"] for records in (ping, captured["http"], captured["speed"]) if len(records)]
+        if not stamps:
+            return np.zeros(0), {}, {}
+        start = min(s[0] for s in stamps) if start is None else start
+        end = max(s[-1] for s in stamps) if end is None else end
+        times = start + np.arange(int((end - start) // interval) + 1) * interval
+        size = len(times)
+        ping, offsets = self._pool_bursts(ping, offsets, times)
+        
+        columns = {}
+        for kind, records, metrics in (
+            ("ping", ping, self._ping_metrics(ping, rtts, offsets)),
+            ("http", captured["http"], self._http_metrics(captured["http"])),
+            ("speed", captured["speed"], self._speed_metrics(captured["speed"])),
+        ):
+            if not len(records):
+                continue
+            # As-of join: latest result at or before each emit, unless it is stale
+            index = np.searchsorted(records["t"], times, side="right") - 1
+            valid = index >= 0
+            valid[valid] = times[valid] - records["t"][index[valid]] <= self.max_ages.get(kind, math.inf)
+            for name, values in metrics.items():
+                column = np.where(valid, values[np.maximum(index, 0)], np.nan)
+                if not np.isnan(column).all():
+                    columns[name] = column
+        
+        columns.update(self.rules.score_columns(columns, size))
+        checks = {check.name: self._check_states(check, columns, size) for check in self.rules.checks}
+        columns.update(self._trends(times, columns))
+        return times, columns, checks
+
+    @staticmethod
+    def _pool_bursts(ping, offsets, times):
+        """Merge the bursts between consecutive emits into one, as the live collector pools them
+
+        A pooled burst is stamped with the time of its last burst, which is
+        also what the probe's staleness is measured from.
+        """
+        if not len(ping):
+            return ping, offsets
+        # Emit row that consumes each burst: the first emit at or after it
+        row = np.searchsorted(times, ping["t"], side="left")
+        last = np.flatnonzero(np.append(row[1:] != row[:-1], True))
+        first = np.concatenate(([0], last[:-1] + 1))
+        pooled = np.zeros(len(last), dtype=[("t", "<f8"), ("sent", "<i8")])
+        pooled["t"] = ping["t"][last]
+        pooled["sent"] = np.add.reduceat(ping["sent"].astype(np.int64), first)
+        return pooled, offsets[np.append(first, len(ping))]
+
+    @staticmethod
+    def _ping_metrics(ping, rtts, offsets):
+        sent = ping["sent"].astype(np.float64)
+        counts = np.diff(offsets)
+        loss = np.where(sent > 0, (sent - counts) / np.maximum(sent, 1) * 100, 100.0)
+        metrics = {
+            "ping_success_rate": 100.0 - loss,
+            "ping_drop_rate": loss,
+            "ping_packet_count": counts.astype(np.float64),
+        }
+        if not len(rtts):
+            return metrics
+        
+        # Sort samples within each burst in one pass: the bits of a non-negative float32
+        # order like the float, so (burst << 32 | bits) sorts by burst, then RTT
+        burst = np.repeat(np.arange(len(counts), dtype=np.uint64), counts)
+        keys = np.sort((burst << np.uint64(32)) | np.maximum(rtts, 0).view(np.uint32).astype(np.uint64))
+        samples = (keys & np.uint64(0xFFFFFFFF)).astype(np.uint32).view(np.float32).astype(np.float64)
+        nonempty = counts > 0
+        n = counts[nonempty]
+        starts = offsets[:-1][nonempty]
+        mean = np.add.reduceat(samples, starts) / n
+        deviation = samples - np.repeat(mean, n)
+        squares = np.add.reduceat(deviation * deviation, starts)
+        low = samples[starts]
+        high = samples[starts + n - 1]
+        median = (samples[starts + (n - 1) // 2] + samples[starts + n // 2]) / 2
+        # statistics.quantiles(n=20)[18], the "exclusive" method, for bursts of 20 or more
+        j = 19 * (n + 1) // 20
+        delta = 19 * (n + 1) - 20 * j
+        p95 = (samples[starts + np.clip(j - 1, 0, n - 1)] * (20 - delta) + samples[starts + np.minimum(j, n - 1)] * delta) / 20
+        
+        per_burst = {
+            "ping_min_ms": low,
+            "ping_avg_ms": mean,
+            "ping_max_ms": high,
+            "ping_mdev_ms": np.sqrt(squares / n),
+            "ping_median_ms": median,
+            "ping_stdev_ms": np.where(n > 1, np.sqrt(squares / np.maximum(n - 1, 1)), 0.0),
+            "ping_95th_percentile_ms": np.where(n >= 20, p95, high),
+            "ping_jitter_ms": high - low,
+        }
+        for name, values in per_burst.items():
+            column = np.full(len(counts), np.nan)
+            column[nonempty] = values
+            metrics[name] = column
+        return metrics
+
+    @staticmethod
+    def _http_metrics(records):
+        total, dns, connect, starttransfer, size = (
+            records[field].astype(np.float64) for field in ("total", "dns", "connect", "starttransfer", "size")
+        )
+        speed = np.where(total > 0, size / np.where(total > 0, total, 1), 0.0)
+        return {
+            "http_total_time": total,
+            "http_namelookup_time": dns,
+            "http_connect_time": connect,
+            "http_starttransfer_time": starttransfer,
+            "http_size_download": size,
+            "http_speed_download": speed,
+            "http_http_code": records["status"].astype(np.float64),
+            "http_dns_resolution_ms": dns * 1000,
+            "http_tcp_connect_ms": connect * 1000,
+            "http_time_to_first_byte_ms": starttransfer * 1000,
+            "http_transfer_ms": (total - starttransfer) * 1000,
+            "http_cold_total_ms": total * 1000,
+            "http_download_speed_mbps": np.where(speed > 0, speed * 8 / (1024 * 1024), np.nan),
+            "http_warm_time_to_first_byte_ms": records["warm_starttransfer"].astype(np.float64) * 1000,
+            "http_warm_total_ms": records["warm_total"].astype(np.float64) * 1000,
+        }
+
+    @staticmethod
+    def _speed_metrics(records):
+        high = records["download_max_mbps"]
+        return {
+            "estimated_download_mbps": records["download_mbps"],
+            "download_speed_max_mbps": high,
+            "download_speed_min_mbps": records["download_min_mbps"],
+            "download_speed_consistency": np.where(
+                np.isnan(high), np.nan, np.where(high > 0, records["download_min_mbps"] / np.where(high > 0, high, 1) * 100, 0.0)
+            ),
+            "download_bytes": records["download_bytes"],
+            "estimated_upload_mbps": records["upload_mbps"],
+            "upload_speed_max_mbps": records["upload_max_mbps"],
+            "upload_speed_min_mbps": records["upload_min_mbps"],
+            "upload_bytes": records["upload_bytes"],
+        }
+
+    @staticmethod
+    def _check_states(check, columns, size):
+        plain = check.evaluate_columns(columns, size).tolist()
+        after = {previous: check.evaluate_columns(columns, size, previous).tolist() for previous in (1, 2)}
+        states = np.empty(size, dtype=np.int8)
+        previous = None
+        for i in range(size):
+            status = after[previous][i] if previous in after else plain[i]
+            if status != -1:
+                previous = status
+            states[i] = status
+        return states
+
+    @staticmethod
+    def _linear_recurrence(factor, x, initial):
+        """y[k] = factor * y[k - 1] + x[k] with y[-1] = initial, for 0 <= factor < 1
+
+        Prefix scan by doubling: after the step with shift s every y[k] includes
+        the terms up to k - 2s + 1, and the scan stops once factor ** s underflows.
+        """
+        y = x.astype(np.float64)
+        shift, weight = 1, factor
+        while shift < len(y) and weight > 0:
+            y[shift:] += weight * y[:-shift].copy()
+            shift, weight = shift * 2, weight * weight
+        return y + initial * factor ** np.arange(1, len(y) + 1)
+    
+    def _windows(self, t, rows, origin):
+        """Window bounds and time sums for samples at rows, shared by columns with the same gaps
+
+        For each emit row and horizon: the sample range [first, end) inside the
+        window, split where it crosses from one block of the horizon's length into
+        the next. Time is kept relative to the block start, so the sums stay small.
+        t is relative to the epoch time origin; slots are aligned in epoch time
+        like RollingMoments.
+        """
+        end = np.searchsorted(rows, np.arange(len(t)), side="right")
+        last = np.maximum(end - 1, 0)
+        windows = []
+        for horizon, seconds in self.horizons:
+            width = seconds / self.slots
+            phase = origin % width
+            slot = np.floor((t[rows] + phase) / width).astype(np.int64)
+            first = np.minimum(np.searchsorted(slot, np.floor((t + phase) / width).astype(np.int64) - self.slots + 1), end)
+            block = np.floor(t[rows] / seconds)
+            starts = np.flatnonzero(np.concatenate(([True], block[1:] != block[:-1])))
+            block_first = np.repeat(starts, np.diff(np.append(starts, len(rows))))
+            split = np.maximum(first, block_first[last])
+            u = t[rows] - block * seconds
+            n, na = end - first, split - first
+            sum_u = np.concatenate(([0.0], np.cumsum(u)))
+            sum_uu = np.concatenate(([0.0], np.cumsum(u * u)))
+            # Shift the older block's part to the newer block's origin
+            shift = -float(seconds)
+            ua = sum_u[split] - sum_u[first]
+            su = sum_u[end] - sum_u[first] + na * shift
+            suu = sum_uu[end] - sum_uu[first] + 2 * shift * ua + na * shift * shift
+            count = np.maximum(n, 1)
+            windows.append((first, split, end, n, u, su, suu - su * su / count, shift))
+        return end, windows
+
+    def _trends(self, times, columns):
+        """EWMA and TrendEngine's slotted window statistics for every matching column"""
+        trends = {}
+        t = times - times[0]
+        geometry = {}
+        for name, column in columns.items():
+            if not any(fnmatch.fnmatchcase(name, pattern) for pattern in self.patterns):
+                continue
+            missing = np.isnan(column)
+            rows = np.flatnonzero(~missing)
+            if not len(rows):
+                continue
+            key = missing.tobytes()
+            if key not in geometry:
+                geometry[key] = self._windows(t, rows, times[0])
+            end, windows = geometry[key]
+            x = column[rows]
+            # Live trends report every tracked series each cycle, using its latest value
+            ewma = self._linear_recurrence(1 - self.ewma_alpha, self.ewma_alpha * x, x[0])
+            trends[f"{name}_ewma"] = np.where(end > 0, ewma[np.maximum(end - 1, 0)], np.nan)
+            
+            center = x.mean()
+            v = x - center
+            sum_v = np.concatenate(([0.0], np.cumsum(v)))
+            sum_vv = np.concatenate(([0.0], np.cumsum(v * v)))
+            # Windows of zeros (0% loss, a floored score) are exactly zero live; centering would leave rounding residue
+            nonzero = np.concatenate(([0], np.cumsum(x != 0)))
+            for index, ((horizon, seconds), (first, split, end, n, u, su, m2t, shift)) in enumerate(zip(self.horizons, windows)):
+                sum_uv = np.concatenate(([0.0], np.cumsum(u * v)))
+                count = np.maximum(n, 1)
+                sv = sum_v[end] - sum_v[first]
+                m2v = np.maximum(sum_vv[end] - sum_vv[first] - sv * sv / count, 0)
+                ctv = sum_uv[end] - sum_uv[first] + shift * (sum_v[split] - sum_v[first]) - su * sv / count
+                
+                enough = n >= 3
+                zero = nonzero[end] == nonzero[first]
+                mean = np.where(enough, np.where(zero, 0.0, sv / count + center), np.nan)
+                stdev = np.where(enough, np.where(zero, 0.0, np.sqrt(m2v / np.maximum(n - 1, 1))), np.nan)
+                slope = np.where(enough, np.where(m2t > 0, np.where(zero, 0.0, ctv) / np.where(m2t > 0, m2t, 1), 0.0), np.nan)
+                trends[f"{name}_mean_{horizon}"] = mean
+                trends[f"{name}_volatility_{horizon}"] = stdev
+                trends[f"{name}_slope_{horizon}"] = slope * 3600
+                if index == 0:
+                    trends[f"{name}_trend_pct"] = np.where(mean != 0, slope * seconds / np.abs(np.where(mean != 0, mean, 1)) * 100, np.nan)
+                    trends[f"{name}_volatility"] = stdev
+        return trends
+
+class StarlinkTarget:
+    """One monitored terminal: its address, DogStatsD tag suffix and rolling history"""
+    __slots__ = ("ip", "tag_suffix", "labels", "trends", "latency", "check_states", "check_sent", "probe_mode", "healthy_cycles",
+                 "ping_lock", "ping_samples", "ping_sent", "ping_summary")
+
+    def __init__(self, ip, tag_suffix, trends, latency, labels="{}"):
+        self.ip = ip
+        self.tag_suffix = tag_suffix
+        self.labels = labels
+        self.trends = trends
+        self.latency = latency
+        self.check_states = {}
+        self.check_sent = {}
+        self.probe_mode = "normal"
+        self.healthy_cycles = 0
+        # Ping bursts since the last emit, pooled so none of their samples or losses are dropped
+        self.ping_lock = threading.Lock()
+        self.ping_samples = []
+        self.ping_sent = 0
+        self.ping_summary = None
+
+    def add_burst(self, samples, sent):
+        with self.ping_lock:
+            self.ping_samples.extend(samples)
+            self.ping_sent += sent
+
+    def drain_bursts(self):
+        """(samples, sent) of every burst since the last drain"""
+        with self.ping_lock:
+            samples, sent = self.ping_samples, self.ping_sent
+            self.ping_samples, self.ping_sent = [], 0
+        return samples, sent
+
+def parse_target_list(text, separator="\n"):
+    """Parse "<ip> [tag:value ...]" entries into (ip, tags) pairs; # starts a comment"""
+    targets = []
+    for entry in text.split(separator):
+        entry = entry.split("#", 1)[0].strip()
+        if not entry:
+            continue
+        fields = entry.split()
+        targets.append((fields[0], fields[1:]))
+    return targets
+
 class EnhancedStarlinkCollector:
     def __init__(self):
         self.starlink_ip = os.getenv("STARLINK_IP", "192.168.1.1")
@@ -20,409 +2643,801 @@ class EnhancedStarlinkCollector:
         self.version = os.getenv("VERSION", "v1.2.1")
         self.environment = os.getenv("ENVIRONMENT", "prod")
         
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.historical_metrics = []
-        logger.info(f"Enhanced Starlink collector v{self.version} with Service Checks - IP: {self.starlink_ip}, Datadog: {self.datadog_host}:{self.datadog_port}")
+        self.ping_interval = float(os.getenv("PING_INTERVAL", "10"))
+        self.http_interval = float(os.getenv("HTTP_INTERVAL", "30"))
+        self.speed_interval = float(os.getenv("SPEED_INTERVAL", "300"))
+        self.ping_timeout = float(os.getenv("PING_TIMEOUT", "35"))
+        self.http_timeout = float(os.getenv("HTTP_TIMEOUT", "15"))
+        self.speed_timeout = float(os.getenv("SPEED_TIMEOUT", "30"))
+        self.dogstatsd_socket = os.getenv("DD_DOGSTATSD_SOCKET")
+        self.dogstatsd_max_packet_size = int(os.getenv("DOGSTATSD_MAX_PACKET_SIZE", "0")) or None
+        self.ping_count = int(os.getenv("PING_COUNT", "30"))
+        self.adaptive_probing = os.getenv("ADAPTIVE_PROBING", "true").lower() == "true"
+        self.ping_interval_degraded = float(os.getenv("PING_INTERVAL_DEGRADED", "1"))
+        self.ping_count_degraded = int(os.getenv("PING_COUNT_DEGRADED", "10"))
+        self.ping_interval_healthy = float(os.getenv("PING_INTERVAL_HEALTHY", "30"))
+        self.healthy_cycles_required = int(os.getenv("HEALTHY_CYCLES", "3"))
+        self.ping_packet_interval = float(os.getenv("PING_PACKET_INTERVAL", "0.1"))
+        self.ping_reply_timeout = float(os.getenv("PING_REPLY_TIMEOUT", "1.0"))
+        self.udp_echo_port = int(os.getenv("UDP_ECHO_PORT", "7"))
+        self.targets_file = os.getenv("STARLINK_TARGETS_FILE")
+        self.targets_spec = os.getenv("STARLINK_TARGETS")
+        self.max_inflight = os.getenv("FLEET_MAX_INFLIGHT", "auto")
+        self.rtt_windows = [(name.strip(), parse_duration(name)) for name in os.getenv("RTT_SKETCH_WINDOWS", "1m,15m,1h").split(",")]
+        self.emit_rtt_distribution = os.getenv("EMIT_RTT_DISTRIBUTION", "false").lower() == "true"
+        self.trend_horizons = [(name.strip(), parse_duration(name)) for name in os.getenv("TREND_HORIZONS", "10m,1h,24h").split(",")]
+        self.trend_metrics = tuple(pattern.strip() for pattern in os.getenv("TREND_METRICS", "ping_avg_ms,estimated_download_mbps,quality_overall_score").split(","))
+        self.trend_slots = int(os.getenv("TREND_SLOTS", "20"))
+        self.trend_ewma_alpha = float(os.getenv("TREND_EWMA_ALPHA", "0.3"))
+        self.store_dir = os.getenv("METRIC_STORE_DIR")
+        self.record_dir = os.getenv("RECORD_DIR")
+        self.self_metrics = os.getenv("COLLECTOR_SELF_METRICS", "true").lower() == "true"
+        self.dogstatsd_enabled = os.getenv("DOGSTATSD_ENABLED", "true").lower() == "true"
+        self.prometheus_port = int(os.getenv("PROMETHEUS_PORT", "0"))
+        self.prometheus_address = os.getenv("PROMETHEUS_ADDRESS", "0.0.0.0")
+        self.continuous_probe_hz = float(os.getenv("CONTINUOUS_PROBE_HZ", "10"))
+        self.continuous_reply_timeout = float(os.getenv("CONTINUOUS_REPLY_TIMEOUT", "1.0"))
+        self.continuous_ring_seconds = float(os.getenv("CONTINUOUS_RING_SECONDS", "600"))
+        self.outage_threshold = int(os.getenv("OUTAGE_THRESHOLD", "5"))
+        self.path_probe = os.getenv("PATH_PROBE", "false").lower() == "true"
+        self.path_gateway = os.getenv("PATH_GATEWAY", "auto")
+        self.path_dish = os.getenv("PATH_DISH", "192.168.100.1")
+        self.path_hop = os.getenv("PATH_HOP", "auto")
+        self.path_anchors = [anchor.strip() for anchor in os.getenv("PATH_ANCHORS", "1.1.1.1,8.8.8.8").split(",") if anchor.strip()]
+        self.path_packets_per_minute = float(os.getenv("PATH_PACKETS_PER_MINUTE", "240"))
+        self.path_reply_timeout = float(os.getenv("PATH_REPLY_TIMEOUT", "1.0"))
+        self.path_max_hops = int(os.getenv("PATH_MAX_HOPS", "6"))
+        self.path_discovery_interval = float(os.getenv("PATH_DISCOVERY_INTERVAL", "600"))
+        self.profile_dir = os.getenv("PROFILE_DIR", "/tmp")
+        self.rules_file = os.getenv("RULES_FILE")
+        self.service_check_emit = os.getenv("SERVICE_CHECK_EMIT", "change").lower()
+        self.service_check_heartbeat = float(os.getenv("SERVICE_CHECK_HEARTBEAT", "300"))
+        self.speed_url = os.getenv("SPEED_URL", "http://{ip}/")
+        self.speed_upload_url = os.getenv("SPEED_UPLOAD_URL")
+        self.speed_upload = os.getenv("SPEED_UPLOAD", "false").lower() == "true"
+        self.speed_streams = int(os.getenv("SPEED_STREAMS", "4"))
+        self.speed_duration = float(os.getenv("SPEED_DURATION", "5"))
+        self.speed_omit = float(os.getenv("SPEED_OMIT", "1"))
+        self.speed_sample_interval = float(os.getenv("SPEED_SAMPLE_INTERVAL", "0.25"))
+        for url in (self.speed_url, self.speed_upload_url):
+            if url and urlsplit(url).scheme not in ("http", "https"):
+                raise ValueError(f"Speed test URL {url} must be http or https")
+        
+        tags = ["service:network", "device:starlink", "segment:WAN", f"version:{self.version}", f"env:{self.environment}"]
+        self.emitter = DogStatsdEmitter(
+            self.datadog_host, self.datadog_port, tags,
+            socket_path=self.dogstatsd_socket, max_packet_size=self.dogstatsd_max_packet_size,
+            enabled=self.dogstatsd_enabled,
+        )
+        # Pull-based alternative (or addition) to DogStatsD for sites without an agent
+        self.exporter = PrometheusExporter(self.prometheus_address, self.prometheus_port) if self.prometheus_port else None
+        
+        # Fleet mode: probe every terminal from the target list instead of just STARLINK_IP
+        entries = []
+        if self.targets_file:
+            with open(self.targets_file) as f:
+                entries = parse_target_list(f.read())
+        elif self.targets_spec:
+            entries = parse_target_list(self.targets_spec, separator=",")
+        self.fleet_mode = bool(entries)
+        if not self.fleet_mode:
+            entries = [(self.starlink_ip, [])]
+        self.targets = []
+        for ip, target_tags in entries:
+            if self.fleet_mode:
+                target_tags = target_tags + [f"starlink_ip:{ip}"]
+            latency = LatencyDistribution(self.rtt_windows, keep_samples=self.emit_rtt_distribution)
+            trends = TrendEngine(self.trend_horizons, self.trend_metrics, self.trend_slots, self.trend_ewma_alpha)
+            self.targets.append(StarlinkTarget(
+                ip, DogStatsdEmitter.build_tag_suffix(tags + target_tags), trends, latency,
+                PrometheusExporter.build_labels(tags + target_tags),
+            ))
+        
+        self.continuous = None
+        if self.continuous_probe_hz > 0:
+            self.continuous = ContinuousProber(
+                self.continuous_probe_hz, self.continuous_reply_timeout, self.continuous_ring_seconds,
+                self.outage_threshold, self.udp_echo_port,
+                on_sample=lambda target, rtt: target.latency.record((rtt,)),
+                on_outage=self.report_outage,
+            )
+            for target in self.targets:
+                self.continuous.add_target(target, target.ip)
+        
+        # Per-segment probing of this host's own path: LAN gateway, dish, Starlink PoP, internet
+        self.path = None
+        if self.path_probe:
+            gateway = default_gateway() if self.path_gateway == "auto" else self.path_gateway
+            if self.path_gateway == "auto" and not gateway:
+                logger.warning("No default gateway found, path segment lan not probed")
+            segments = [("lan", gateway), ("dish", self.path_dish), ("pop", self.path_hop)]
+            segments += [("internet", anchor) for anchor in self.path_anchors]
+            self.path = PathProber(
+                [(segment, address) for segment, address in segments if address],
+                self.path_packets_per_minute, self.path_reply_timeout, self.path_max_hops,
+                self.path_discovery_interval, self.udp_echo_port,
+            )
+            self.path_tags = [tag for tag in tags if not tag.startswith("segment:")]
+            self.path_labels = {}
+        
+        # Scoring curves and check thresholds are compiled once; RULES_FILE tunes them per site
+        self.rules = RuleEngine.from_file(self.rules_file) if self.rules_file else RuleEngine(DEFAULT_RULES)
+        
+        self.store = MetricStore(self.store_dir) if self.store_dir else None
+        self.recorder = ProbeRecorder(self.record_dir) if self.record_dir else None
+        self.instrumentation = CollectorInstrumentation(self.emitter, self.profile_dir)
+        if self.continuous:
+            self.continuous.profile_hook = self.instrumentation.profile_thread
+        if self.path:
+            self.path.profile_hook = self.instrumentation.profile_thread
+        
+        # Each scheduler worker thread gets its own echo socket so bursts never steal replies
+        self.local = threading.local()
+        self.http_pool = HttpConnectionPool()
+        self.http_probe = HttpTimingProbe(self.http_pool, timeout=10)
+        self.throughput = ThroughputTest(
+            self.http_pool, streams=self.speed_streams, duration=self.speed_duration,
+            sample_interval=self.speed_sample_interval, omit=self.speed_omit,
+        )
+        
+        self.scheduler = ProbeScheduler(max_workers=self.fleet_workers())
+        self.scheduler.profile_hook = self.instrumentation.profile_thread
+        for index, target in enumerate(self.targets):
+            # Stagger first runs so a large fleet does not probe every target at once
+            spread = index / len(self.targets)
+            self.scheduler.add_probe(f"ping:{target.ip}", functools.partial(self.get_enhanced_ping_metrics, target),
+                                     self.ping_interval, self.ping_timeout, offset=spread * self.ping_interval)
+            self.scheduler.add_probe(f"http:{target.ip}", functools.partial(self.get_http_performance_metrics, target.ip),
+                                     self.http_interval, self.http_timeout, offset=spread * self.http_interval)
+            self.scheduler.add_probe(f"speed:{target.ip}", functools.partial(self.get_speed_estimate, target.ip),
+                                     self.speed_interval, self.speed_timeout, offset=spread * self.speed_interval)
+        
+        prober = IcmpProber(self.udp_echo_port)
+        self.ping_mode = prober.mode
+        prober.close()
+        if self.fleet_mode:
+            logger.info(f"Enhanced Starlink collector v{self.version} with Service Checks - fleet of {len(self.targets)} targets, Datadog: {self.datadog_host}:{self.datadog_port}")
+        else:
+            logger.info(f"Enhanced Starlink collector v{self.version} with Service Checks - IP: {self.starlink_ip}, Datadog: {self.datadog_host}:{self.datadog_port}")
+        logger.info(f"Ping probe mode: {self.ping_mode}")
+        if self.store:
+            logger.info(f"Recording metrics to local store {self.store_dir}")
+        if self.dogstatsd_socket:
+            logger.info(f"DogStatsD over Unix socket {self.dogstatsd_socket}")
     
-    def send_metric(self, metric_name, value, metric_type="g"):
-        """Send metrics to Datadog via DogStatsD"""
+    def fleet_workers(self):
+        """Scheduler workers for the fleet: FLEET_MAX_INFLIGHT, or with auto enough to keep every cadence
+        
+        A probe never overlaps itself and may hold a worker for up to its
+        timeout each interval, so keeping every probe on schedule takes
+        sum(min(1, timeout / interval)) workers over all probes. Warns at
+        startup when the configured load does not fit.
+        """
+        ping_interval = min(self.ping_interval, self.ping_interval_degraded) if self.adaptive_probing else self.ping_interval
+        budgets = ((ping_interval, self.ping_timeout), (self.http_interval, self.http_timeout), (self.speed_interval, self.speed_timeout))
+        required = math.ceil(len(self.targets) * sum(min(1.0, timeout / interval) for interval, timeout in budgets))
+        if self.max_inflight == "auto":
+            # Never fewer than the old fixed default, which small fleets rely on for slack
+            workers = min(3 * len(self.targets), max(64, required))
+        else:
+            workers = min(3 * len(self.targets), int(self.max_inflight))
+            if workers < required:
+                logger.warning(f"FLEET_MAX_INFLIGHT={workers} is below the {required} workers the probe timeouts and "
+                               f"intervals need; probes will start late")
+        # Every worker keeps its own echo socket, and HTTP and speed probes open connections on top
+        soft_limit = resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+        if soft_limit != resource.RLIM_INFINITY and 2 * workers > soft_limit:
+            logger.warning(f"{workers} probe workers may need more than the {soft_limit} open files allowed; raise the nofile limit")
+        if self.continuous_probe_hz > 0:
+            rate = self.continuous_probe_hz * len(self.targets)
+            if rate > ContinuousProber.MAX_PACKETS_PER_SECOND:
+                logger.warning(f"Continuous probing sends {rate:g} packets/s from one socket, more than "
+                               f"{ContinuousProber.MAX_PACKETS_PER_SECOND}; set CONTINUOUS_PROBE_HZ to at most "
+                               f"{ContinuousProber.MAX_PACKETS_PER_SECOND / len(self.targets):g}")
+        return workers
+    
+    def get_prober(self):
+        """Echo prober owned by the calling thread"""
+        prober = getattr(self.local, "prober", None)
+        if prober is None:
+            prober = self.local.prober = IcmpProber(self.udp_echo_port)
+        return prober
+    
+    def send_metric(self, metric_name, value, metric_type="g", target=None):
+        """Queue a metric for the next DogStatsD datagram"""
         try:
-            tags = f"service:network,device:starlink,segment:WAN,version:{self.version},env:{self.environment}"
-            metric_data = f"{metric_name}:{value}|{metric_type}|#{tags}".encode("utf-8")
-            self.sock.sendto(metric_data, (self.datadog_host, self.datadog_port))
+            self.emitter.metric(metric_name, value, metric_type, target.tag_suffix if target else None)
         except Exception as e:
             logger.error(f"Failed to send metric {metric_name}: {e}")
     
-    def send_service_check(self, check_name, status, message=None):
-        """Send service checks to Datadog via DogStatsD
+    def send_service_check(self, check_name, status, message=None, target=None):
+        """Queue a service check for the next DogStatsD datagram
         
         Args:
             check_name (str): Name of the service check
             status (int): 0=OK, 1=WARNING, 2=CRITICAL, 3=UNKNOWN
             message (str): Optional message describing the status
+            target (StarlinkTarget): Terminal the check is about, for its tags
         """
         try:
-            tags = f"service:network,device:starlink,segment:WAN,version:{self.version},env:{self.environment}"
-            timestamp = int(time.time())
-            
-            # DogStatsD service check format: _sc|<name>|<status>|d:<timestamp>|h:<hostname>|#<tags>|m:<message>
-            service_check_data = f"_sc|{check_name}|{status}|d:{timestamp}|#{tags}"
-            
-            if message:
-                # Escape special characters in message
-                escaped_message = message.replace("|", "\\|").replace("\n", "\\n")
-                service_check_data += f"|m:{escaped_message}"
-            
-            self.sock.sendto(service_check_data.encode("utf-8"), (self.datadog_host, self.datadog_port))
-            
+            if target is not None:
+                target.check_states[check_name] = status
+            self.emitter.service_check(check_name, status, message, tag_suffix=target.tag_suffix if target else None)
         except Exception as e:
             logger.error(f"Failed to send service check {check_name}: {e}")
     
-    def get_http_performance_metrics(self):
-        """Enhanced HTTP performance metrics using curl"""
+    def get_http_performance_metrics(self, ip=None):
+        """HTTP phase timings for a cold (new connection) and a warm (pooled) request"""
         try:
-            curl_format = """total_time:%{time_total}
-namelookup_time:%{time_namelookup}
-connect_time:%{time_connect}
-appconnect_time:%{time_appconnect}
-pretransfer_time:%{time_pretransfer}
-starttransfer_time:%{time_starttransfer}
-size_download:%{size_download}
-speed_download:%{speed_download}
-speed_upload:%{speed_upload}
-http_code:%{response_code}"""
+            url = f"http://{ip or self.starlink_ip}/"
+            cold = self.http_probe.measure(url, fresh=True)
             
-            result = subprocess.run([
-                "curl", "-s", "-w", curl_format, 
-                f"http://{self.starlink_ip}", 
-                "-o", "/dev/null", "--max-time", "10"
-            ], capture_output=True, text=True, timeout=15)
+            metrics = {
+                "http_total_time": cold["total"],
+                "http_namelookup_time": cold["dns"],
+                "http_connect_time": cold["connect"],
+                "http_starttransfer_time": cold["starttransfer"],
+                "http_size_download": cold["size"],
+                "http_speed_download": cold["size"] / cold["total"] if cold["total"] > 0 else 0,
+                "http_http_code": cold["status"],
+                "http_dns_resolution_ms": cold["dns"] * 1000,
+                "http_tcp_connect_ms": cold["connect"] * 1000,
+                "http_time_to_first_byte_ms": cold["starttransfer"] * 1000,
+                "http_transfer_ms": (cold["total"] - cold["starttransfer"]) * 1000,
+                "http_cold_total_ms": cold["total"] * 1000,
+            }
+            if metrics["http_speed_download"] > 0:
+                metrics["http_download_speed_mbps"] = (metrics["http_speed_download"] * 8) / (1024 * 1024)
             
-            if result.returncode == 0:
-                metrics = {}
-                for line in result.stdout.strip().split("\\n"):
-                    if ":" in line:
-                        key, value = line.split(":", 1)
-                        try:
-                            metrics[f"http_{key}"] = float(value)
-                        except ValueError:
-                            continue
-                
-                # Convert some metrics to more useful units
-                if "http_namelookup_time" in metrics:
-                    metrics["http_dns_resolution_ms"] = metrics["http_namelookup_time"] * 1000
-                if "http_connect_time" in metrics:
-                    metrics["http_tcp_connect_ms"] = metrics["http_connect_time"] * 1000
-                if "http_starttransfer_time" in metrics:
-                    metrics["http_time_to_first_byte_ms"] = metrics["http_starttransfer_time"] * 1000
-                if "http_speed_download" in metrics and metrics["http_speed_download"] > 0:
-                    metrics["http_download_speed_mbps"] = (metrics["http_speed_download"] * 8) / (1024 * 1024)
-                
-                return metrics
+            # Second request reuses the connection the cold request returned to the pool
+            warm = self.http_probe.measure(url)
+            if warm["reused"]:
+                metrics["http_warm_time_to_first_byte_ms"] = warm["starttransfer"] * 1000
+                metrics["http_warm_total_ms"] = warm["total"] * 1000
+            
+            if self.recorder:
+                self.recorder.record_http(ip or self.starlink_ip, time.time(), cold, warm)
+            return metrics
                 
         except Exception as e:
             logger.error(f"HTTP performance test failed: {e}")
             return None
     
-    def get_enhanced_ping_metrics(self):
-        """Enhanced ping metrics with detailed statistics"""
+    def get_enhanced_ping_metrics(self, target=None):
+        """Enhanced ping metrics with detailed statistics from in-process echo probes"""
         try:
-            result = subprocess.run([
-                "ping", "-c", "30", "-i", "0.1", 
-                self.starlink_ip
-            ], capture_output=True, text=True, timeout=35)
+            target = target or self.targets[0]
+            # Shorter, more frequent bursts while the link is degraded
+            count = self.ping_count_degraded if target.probe_mode == "degraded" else self.ping_count
+            ping_times, sent, received = self.get_prober().burst(
+                target.ip, count, self.ping_packet_interval, self.ping_reply_timeout
+            )
+            target.latency.record(ping_times)
+            target.add_burst(ping_times, sent)
+            if self.recorder:
+                self.recorder.record_ping(target.ip, time.time(), ping_times, sent)
+            return self.summarize_ping_samples(ping_times, sent, received)
             
-            if result.returncode == 0:
-                lines = result.stdout.split("\\n")
-                metrics = {}
-                ping_times = []
-                
-                # Extract individual ping times
-                for line in lines:
-                    if "time=" in line:
-                        time_match = re.search(r"time=([0-9.]+)", line)
-                        if time_match:
-                            ping_times.append(float(time_match.group(1)))
-                
-                # Parse packet loss
-                packet_loss = 0
-                for line in lines:
-                    if "packet loss" in line:
-                        loss_match = re.search(r"([0-9.]+)%\\s+packet\\s+loss", line)
-                        if loss_match:
-                            packet_loss = float(loss_match.group(1))
-                            break
-                
-                # Parse timing stats (min/avg/max/mdev)
-                for line in lines:
-                    if "min/avg/max" in line and "=" in line:
-                        stats_part = line.split("=")[1].strip()
-                        if "/" in stats_part:
-                            parts = stats_part.split("/")
-                            if len(parts) >= 4:
-                                metrics.update({
-                                    "ping_min_ms": float(parts[0]),
-                                    "ping_avg_ms": float(parts[1]),
-                                    "ping_max_ms": float(parts[2]),
-                                    "ping_mdev_ms": float(parts[3].split()[0])
-                                })
-                            break
-                
-                # Calculate additional statistics
-                if ping_times:
-                    metrics.update({
-                        "ping_median_ms": statistics.median(ping_times),
-                        "ping_stdev_ms": statistics.stdev(ping_times) if len(ping_times) > 1 else 0,
-                        "ping_95th_percentile_ms": statistics.quantiles(ping_times, n=20)[18] if len(ping_times) >= 20 else max(ping_times),
-                        "ping_packet_count": len(ping_times)
-                    })
-                
-                metrics.update({
-                    "ping_success_rate": 100.0 - packet_loss,
-                    "ping_drop_rate": packet_loss,
-                })
-                
-                if "ping_max_ms" in metrics and "ping_min_ms" in metrics:
-                    metrics["ping_jitter_ms"] = metrics["ping_max_ms"] - metrics["ping_min_ms"]
-                
-                return metrics
-                
         except Exception as e:
             logger.error(f"Enhanced ping test failed: {e}")
             return None
     
+    def pooled_ping_metrics(self, target):
+        """Ping statistics over every burst since the last emit
+        
+        Short degraded-mode bursts would each give a coarse loss rate; pooled
+        they give the full resolution of the faster probing. Without a new
+        burst the previous pooled result is reused until the probe goes stale.
+        """
+        samples, sent = target.drain_bursts()
+        if sent:
+            target.ping_summary = self.summarize_ping_samples(samples, sent, len(samples))
+        elif self.scheduler.latest(f"ping:{target.ip}") is None:
+            target.ping_summary = None
+        return target.ping_summary
+    
+    def summarize_ping_samples(self, ping_times, sent, received):
+        """Derive ping statistics from raw RTT samples in milliseconds"""
+        packet_loss = (sent - received) / sent * 100 if sent else 100.0
+        metrics = {
+            "ping_success_rate": 100.0 - packet_loss,
+            "ping_drop_rate": packet_loss,
+            "ping_packet_count": len(ping_times),
+        }
+        
+        if ping_times:
+            mean = statistics.fmean(ping_times)
+            # mdev as reported by iputils ping: sqrt(E[x^2] - E[x]^2)
+            mean_square = statistics.fmean(t * t for t in ping_times)
+            metrics.update({
+                "ping_min_ms": min(ping_times),
+                "ping_avg_ms": mean,
+                "ping_max_ms": max(ping_times),
+                "ping_mdev_ms": math.sqrt(max(0.0, mean_square - mean * mean)),
+                "ping_median_ms": statistics.median(ping_times),
+                "ping_stdev_ms": statistics.stdev(ping_times) if len(ping_times) > 1 else 0,
+                "ping_95th_percentile_ms": statistics.quantiles(ping_times, n=20)[18] if len(ping_times) >= 20 else max(ping_times),
+            })
+            metrics["ping_jitter_ms"] = metrics["ping_max_ms"] - metrics["ping_min_ms"]
+        
+        return metrics
+    
     def get_quality_scores(self, ping_metrics, http_metrics):
-        """Calculate derived quality and performance scores"""
+        """Calculate derived quality and performance scores from the compiled scoring rules"""
         try:
-            scores = {}
-            
-            # Latency Quality Score (0-100, higher is better)
-            if ping_metrics and "ping_avg_ms" in ping_metrics:
-                avg_ping = ping_metrics["ping_avg_ms"]
-                if avg_ping <= 1:
-                    latency_score = 100
-                elif avg_ping <= 10:
-                    latency_score = 100 - (avg_ping - 1) * 5
-                elif avg_ping <= 50:
-                    latency_score = 50 - (avg_ping - 10) * 1.25
-                else:
-                    latency_score = 0
-                scores["quality_latency_score"] = max(0, min(100, latency_score))
-            
-            # Stability Score based on jitter and packet loss
-            if ping_metrics:
-                stability_score = 100
-                if "ping_drop_rate" in ping_metrics:
-                    stability_score -= ping_metrics["ping_drop_rate"] * 2
-                if "ping_mdev_ms" in ping_metrics:
-                    jitter_penalty = min(ping_metrics["ping_mdev_ms"] * 10, 50)
-                    stability_score -= jitter_penalty
-                scores["quality_stability_score"] = max(0, min(100, stability_score))
-            
-            # HTTP Performance Score
-            if http_metrics and "http_time_to_first_byte_ms" in http_metrics:
-                ttfb = http_metrics["http_time_to_first_byte_ms"]
-                if ttfb <= 5:
-                    http_score = 100
-                elif ttfb <= 50:
-                    http_score = 100 - (ttfb - 5) * 2
-                else:
-                    http_score = max(0, 10 - (ttfb - 50) * 0.2)
-                scores["quality_http_score"] = max(0, min(100, http_score))
-            
-            # Overall Connection Quality
-            if len(scores) >= 2:
-                weights = {"quality_latency_score": 0.4, "quality_stability_score": 0.4, "quality_http_score": 0.2}
-                weighted_sum = sum(scores.get(metric, 0) * weights.get(metric, 0) for metric in weights)
-                scores["quality_overall_score"] = weighted_sum
-            
-            return scores
+            return self.rules.score({**(ping_metrics or {}), **(http_metrics or {})})
             
         except Exception as e:
             logger.error(f"Quality score calculation failed: {e}")
             return {}
     
-    def get_speed_estimate(self):
-        """Improved speed estimation with multiple tests"""
+    def get_speed_estimate(self, ip=None):
+        """Multi-stream throughput test, excluding slow start"""
         try:
-            speeds = []
+            ip = ip or self.starlink_ip
+            download = self.throughput.run(self.speed_url.format(ip=ip))
+            upload = None
+            metrics = {}
+            if download["bytes"] > 0:
+                metrics.update({
+                    "estimated_download_mbps": download["mbps"],
+                    "download_speed_max_mbps": download["max_mbps"],
+                    "download_speed_min_mbps": download["min_mbps"],
+                    "download_speed_consistency": (download["min_mbps"] / download["max_mbps"]) * 100 if download["max_mbps"] > 0 else 0,
+                    "download_bytes": download["bytes"],
+                })
             
-            for i in range(3):
-                start_time = time.time()
-                response = requests.get(f"http://{self.starlink_ip}", timeout=8, stream=True)
-                
-                total_bytes = 0
-                for chunk in response.iter_content(chunk_size=8192):
-                    total_bytes += len(chunk)
-                    if time.time() - start_time > 2:
-                        break
-                
-                duration = time.time() - start_time
-                if duration > 0 and total_bytes > 0:
-                    speed_mbps = (total_bytes * 8) / (duration * 1024 * 1024)
-                    speeds.append(speed_mbps)
-                
-                time.sleep(0.5)
+            if self.speed_upload:
+                upload = self.throughput.run((self.speed_upload_url or self.speed_url).format(ip=ip), upload=True)
+                if upload["bytes"] > 0:
+                    metrics.update({
+                        "estimated_upload_mbps": upload["mbps"],
+                        "upload_speed_max_mbps": upload["max_mbps"],
+                        "upload_speed_min_mbps": upload["min_mbps"],
+                        "upload_bytes": upload["bytes"],
+                    })
             
-            if speeds:
-                return {
-                    "estimated_download_mbps": statistics.mean(speeds),
-                    "download_speed_max_mbps": max(speeds),
-                    "download_speed_min_mbps": min(speeds),
-                    "download_speed_consistency": (min(speeds) / max(speeds)) * 100 if max(speeds) > 0 else 0
-                }
+            if self.recorder:
+                self.recorder.record_speed(ip, time.time(), download, upload)
+            return metrics or None
                 
         except Exception as e:
             logger.error(f"Speed test failed: {e}")
             return None
     
-    def calculate_trends(self, current_metrics):
+    def calculate_trends(self, current_metrics, target=None):
         """Calculate performance trends over time"""
         try:
-            self.historical_metrics.append({
-                "timestamp": time.time(),
-                "metrics": current_metrics.copy()
-            })
-            
-            if len(self.historical_metrics) > 10:
-                self.historical_metrics.pop(0)
-            
-            trends = {}
-            
-            if len(self.historical_metrics) >= 3:
-                key_metrics = ["ping_avg_ms", "estimated_download_mbps", "quality_overall_score"]
-                
-                for metric in key_metrics:
-                    values = []
-                    for hist in self.historical_metrics:
-                        if metric in hist["metrics"]:
-                            values.append(hist["metrics"][metric])
-                    
-                    if len(values) >= 3:
-                        if values[0] != 0:
-                            trend_pct = ((values[-1] - values[0]) / values[0]) * 100
-                            trends[f"{metric}_trend_pct"] = trend_pct
-                        
-                        if len(values) > 1:
-                            trends[f"{metric}_volatility"] = statistics.stdev(values)
-            
-            return trends
+            return (target or self.targets[0]).trends.update(current_metrics)
             
         except Exception as e:
             logger.error(f"Trend calculation failed: {e}")
             return {}
     
-    def send_service_checks(self, ping_metrics, quality_scores, http_metrics):
-        """Send appropriate service checks based on metrics"""
+    def send_service_checks(self, ping_metrics, quality_scores, http_metrics, target=None):
+        """Evaluate the compiled check rules; return the number of service checks sent
+        
+        With SERVICE_CHECK_EMIT=change a check is only sent when its status changes, or
+        again after SERVICE_CHECK_HEARTBEAT seconds so the agent does not mark it stale.
+        """
+        sent = 0
         try:
-            # 1. Starlink Connectivity Service Check
-            if ping_metrics and "ping_success_rate" in ping_metrics:
-                success_rate = ping_metrics["ping_success_rate"]
-                if success_rate >= 95:
-                    self.send_service_check("starlink.connectivity", 0, f"Starlink connected - {success_rate:.1f}% success rate")
-                elif success_rate >= 80:
-                    self.send_service_check("starlink.connectivity", 1, f"Starlink connectivity degraded - {success_rate:.1f}% success rate")
-                else:
-                    self.send_service_check("starlink.connectivity", 2, f"Starlink connectivity critical - {success_rate:.1f}% success rate")
-            else:
-                self.send_service_check("starlink.connectivity", 3, "Unable to determine connectivity status")
-            
-            # 2. Starlink Performance Service Check
-            if quality_scores and "quality_overall_score" in quality_scores:
-                overall_score = quality_scores["quality_overall_score"]
-                if overall_score >= 80:
-                    self.send_service_check("starlink.performance", 0, f"Excellent performance - {overall_score:.1f}/100 score")
-                elif overall_score >= 60:
-                    self.send_service_check("starlink.performance", 1, f"Good performance - {overall_score:.1f}/100 score")
-                elif overall_score >= 40:
-                    self.send_service_check("starlink.performance", 1, f"Fair performance - {overall_score:.1f}/100 score")
-                else:
-                    self.send_service_check("starlink.performance", 2, f"Poor performance - {overall_score:.1f}/100 score")
-            
-            # 3. Starlink Latency Service Check
-            if ping_metrics and "ping_avg_ms" in ping_metrics:
-                avg_ping = ping_metrics["ping_avg_ms"]
-                if avg_ping <= 5:
-                    self.send_service_check("starlink.latency", 0, f"Excellent latency - {avg_ping:.1f}ms average")
-                elif avg_ping <= 20:
-                    self.send_service_check("starlink.latency", 1, f"Good latency - {avg_ping:.1f}ms average")
-                elif avg_ping <= 50:
-                    self.send_service_check("starlink.latency", 1, f"Fair latency - {avg_ping:.1f}ms average")
-                else:
-                    self.send_service_check("starlink.latency", 2, f"High latency - {avg_ping:.1f}ms average")
-            
-            # 4. Starlink Stability Service Check  
-            if ping_metrics and "ping_drop_rate" in ping_metrics:
-                packet_loss = ping_metrics["ping_drop_rate"]
-                jitter = ping_metrics.get("ping_mdev_ms", 0)
+            values = {**(ping_metrics or {}), **(http_metrics or {}), **(quality_scores or {})}
+            now = time.monotonic()
+            for check in self.rules.checks:
+                previous = target.check_states.get(check.name) if target else None
+                result = check.evaluate(values, previous)
+                if result is None:
+                    continue
+                status, template, context = result
+                if (
+                    target is not None and self.service_check_emit == "change" and status == previous
+                    and now - target.check_sent.get(check.name, -math.inf) < self.service_check_heartbeat
+                ):
+                    continue
+                self.send_service_check(check.name, status, template.format_map(context) if template else None, target=target)
+                if target is not None:
+                    target.check_sent[check.name] = now
+                sent += 1
                 
-                if packet_loss == 0 and jitter <= 1:
-                    self.send_service_check("starlink.stability", 0, f"Excellent stability - 0% loss, {jitter:.1f}ms jitter")
-                elif packet_loss <= 1 and jitter <= 5:
-                    self.send_service_check("starlink.stability", 1, f"Good stability - {packet_loss:.1f}% loss, {jitter:.1f}ms jitter")
-                elif packet_loss <= 5 and jitter <= 10:
-                    self.send_service_check("starlink.stability", 1, f"Fair stability - {packet_loss:.1f}% loss, {jitter:.1f}ms jitter")
-                else:
-                    self.send_service_check("starlink.stability", 2, f"Poor stability - {packet_loss:.1f}% loss, {jitter:.1f}ms jitter")
-                    
         except Exception as e:
             logger.error(f"Failed to send service checks: {e}")
+        return sent
+    
+    def store_metrics(self, target, metrics):
+        """Append this cycle's numeric metrics to the local store"""
+        try:
+            numeric = {
+                name: float(value) for name, value in metrics.items()
+                if isinstance(value, (int, float)) and not isinstance(value, bool) and value == value
+            }
+            self.store.append(target.ip, time.time(), numeric)
+        except Exception as e:
+            logger.error(f"Failed to record metrics to {self.store_dir}: {e}")
+    
+    def replay_store(self, series, start, end, rate=200):
+        """Resend stored metrics to DogStatsD with their original timestamps, at most rate datagrams/s"""
+        target = next((t for t in self.targets if t.ip == series), None)
+        tag_suffix = target.tag_suffix if target else None
+        sent = 0
+        for metric in self.store.metrics(series):
+            for timestamps, values in self.store.scan(series, metric, start, end):
+                for timestamp, value in zip(timestamps, values):
+                    before = self.emitter.datagrams_sent
+                    self.emitter.metric(f"starlink.{metric}", value, tag_suffix=tag_suffix, timestamp=timestamp)
+                    sent += 1
+                    if self.emitter.datagrams_sent != before:
+                        time.sleep(1 / rate)
+        self.emitter.flush()
+        logger.info(f"Replayed {sent} points for {series} in {self.emitter.datagrams_sent} datagrams")
+        return sent
+    
+    def recompute_capture(self, series, start, end, interval, patterns=("*",), csv_path=None, rate=200):
+        """Recompute derived metrics from recorded probe results; write CSV or backfill DogStatsD"""
+        started = time.perf_counter()
+        recompute = BatchRecompute(
+            self.rules, self.trend_horizons, self.trend_metrics, self.trend_slots, self.trend_ewma_alpha,
+            max_ages={
+                "ping": 2 * self.ping_interval + self.ping_timeout,
+                "http": 2 * self.http_interval + self.http_timeout,
+                "speed": 2 * self.speed_interval + self.speed_timeout,
+            },
+        )
+        times, columns, checks = recompute.run(self.recorder.load(series, start, end), interval)
+        columns = {name: values for name, values in columns.items() if any(fnmatch.fnmatchcase(name, p) for p in patterns)}
+        logger.info(f"Recomputed {len(columns)} metrics and {len(checks)} checks over {len(times)} cycles in {time.perf_counter() - started:.2f}s")
+        
+        if csv_path:
+            table = np.column_stack([times] + list(columns.values()) + [np.where(s < 0, np.nan, s) for s in checks.values()])
+            with open(csv_path, "w") as f:
+                f.write(",".join(["timestamp"] + list(columns) + list(checks)) + "\n")
+                np.savetxt(f, table, fmt="%.10g", delimiter=",")
+            return len(times)
+        
+        target = next((t for t in self.targets if t.ip == series), None)
+        tag_suffix = target.tag_suffix if target else None
+        names = [f"starlink.{name}" for name in columns]
+        matrix = np.column_stack(list(columns.values())).tolist() if columns else [[]] * len(times)
+        last_status = dict.fromkeys(checks)
+        sent = 0
+        for row, timestamp in enumerate(times.tolist()):
+            before = self.emitter.datagrams_sent
+            for name, value in zip(names, matrix[row]):
+                if value == value:
+                    self.emitter.metric(name, value, tag_suffix=tag_suffix, timestamp=timestamp)
+                    sent += 1
+            # Service checks are backfilled only where their state changes
+            for name, states in checks.items():
+                status = int(states[row])
+                if status >= 0 and status != last_status[name]:
+                    self.emitter.service_check(name, status, timestamp=timestamp, tag_suffix=tag_suffix)
+                    last_status[name] = status
+            if self.emitter.datagrams_sent != before:
+                time.sleep((self.emitter.datagrams_sent - before) / rate)
+        self.emitter.flush()
+        logger.info(f"Backfilled {sent} points for {series} in {self.emitter.datagrams_sent} datagrams")
+        return sent
+    
+    def report_outage(self, target, start, duration, lost, ended):
+        """Send a DogStatsD event when the continuous prober detects an outage and when it ends"""
+        started = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(start))
+        if ended:
+            title, alert_type, timestamp = "Starlink outage recovered", "success", start + duration
+            text = f"{target.ip} lost {lost} consecutive probes over {duration:.2f}s starting {started}"
+            logger.warning(f"Outage on {target.ip} over: {lost} probes lost over {duration:.2f}s starting {started}")
+        else:
+            title, alert_type, timestamp = "Starlink outage", "error", start
+            text = f"{target.ip} stopped answering at {started}, {lost} consecutive probes lost so far"
+            logger.warning(f"Outage on {target.ip}: no replies since {started}")
+        try:
+            self.emitter.event(title, text, timestamp=timestamp, alert_type=alert_type, tag_suffix=target.tag_suffix)
+            self.emitter.flush()
+        except Exception as e:
+            logger.error(f"Failed to send outage event: {e}")
+    
+    def collect_path(self):
+        """Queue the path prober's per-segment RTT, loss and deltas since the last cycle"""
+        summary = []
+        for index, segment, address, metrics in self.path.drain():
+            tagging = self.path_labels.get((segment, address))
+            if tagging is None:
+                tags = self.path_tags + [f"segment:{segment}", f"path_target:{address}"]
+                tagging = self.path_labels[segment, address] = (
+                    DogStatsdEmitter.build_tag_suffix(tags), PrometheusExporter.build_labels(tags),
+                )
+            for metric_name, value in metrics.items():
+                self.emitter.metric(f"starlink.{metric_name}", value, tag_suffix=tagging[0])
+            if self.exporter:
+                # Keyed by position so a rediscovered hop replaces the old one
+                self.exporter.update(f"path:{index}", tagging[1], metrics, {})
+            if "path_rtt_delta_ms" in metrics:
+                summary.append(f"{segment} {address} {metrics['path_rtt_delta_ms']:+.1f}ms/{metrics['path_loss_delta_pct']:+.1f}%")
+            else:
+                summary.append(f"{segment} {address} unreachable")
+        if summary:
+            logger.info(f"Path: {', '.join(summary)}")
+    
+    def adapt_probe_rate(self, target):
+        """Ping in fast bursts while stability or connectivity is WARNING/CRITICAL, back off once healthy"""
+        states = target.check_states
+        watched = (states.get("starlink.stability"), states.get("starlink.connectivity"))
+        if any(status in (1, 2) for status in watched):
+            target.healthy_cycles = 0
+            mode = "degraded"
+        elif all(status == 0 for status in watched):
+            target.healthy_cycles += 1
+            mode = "healthy" if target.healthy_cycles >= self.healthy_cycles_required else "normal"
+        else:
+            target.healthy_cycles = 0
+            mode = "normal"
+        
+        if mode == target.probe_mode:
+            return
+        interval = {"degraded": self.ping_interval_degraded, "healthy": self.ping_interval_healthy}.get(mode, self.ping_interval)
+        self.scheduler.set_interval(f"ping:{target.ip}", interval, run_now=mode == "degraded")
+        logger.info(f"{target.ip}: link {mode}, pinging every {interval:g}s")
+        target.probe_mode = mode
+    
+    def collect_cycle(self, target):
+        """Merge a target's latest probe results, derive scores and trends and queue everything"""
+        all_metrics = {}
+        # Per-target detail would flood the log in fleet mode
+        log = logger.debug if self.fleet_mode else logger.info
+        
+        ping_metrics = self.pooled_ping_metrics(target)
+        if ping_metrics:
+            all_metrics.update(ping_metrics)
+            avg_ping = ping_metrics.get("ping_avg_ms", 0)
+            success_rate = ping_metrics.get("ping_success_rate", 0)
+            mdev = ping_metrics.get("ping_mdev_ms", 0)
+            log(f"Ping: {avg_ping:.1f}ms avg, {mdev:.1f}ms jitter, {success_rate:.1f}% success")
+        
+        http_metrics = self.scheduler.latest(f"http:{target.ip}")
+        if http_metrics:
+            all_metrics.update(http_metrics)
+            ttfb = http_metrics.get("http_time_to_first_byte_ms", 0)
+            http_speed = http_metrics.get("http_download_speed_mbps", 0)
+            log(f"HTTP: {ttfb:.1f}ms TTFB, {http_speed:.2f} Mbps")
+        
+        all_metrics["ping_probe_interval_s"] = self.scheduler.probes[f"ping:{target.ip}"]["interval"]
+        
+        if self.continuous:
+            continuous_metrics = self.continuous.drain(target)
+            all_metrics.update(continuous_metrics)
+            if continuous_metrics.get("outage_count") or continuous_metrics.get("microdrop_count"):
+                log(f"Continuous: {continuous_metrics['outage_seconds']:.1f}s outage, {continuous_metrics['microdrop_count']} micro-drops")
+        
+        speed_metrics = self.scheduler.latest(f"speed:{target.ip}")
+        if speed_metrics:
+            all_metrics.update(speed_metrics)
+            est_speed = speed_metrics.get("estimated_download_mbps", 0)
+            consistency = speed_metrics.get("download_speed_consistency", 0)
+            log(f"Speed: {est_speed:.2f} Mbps avg, {consistency:.1f}% consistency")
+        
+        stage = self.instrumentation.stage
+        
+        # Rolling percentiles over every RTT sample, not just the latest burst
+        with stage("percentiles"):
+            latency_percentiles = target.latency.percentiles()
+            if latency_percentiles:
+                all_metrics.update(latency_percentiles)
+            if self.emit_rtt_distribution:
+                samples = target.latency.drain()
+                if samples:
+                    self.emitter.distribution("starlink.ping_rtt_ms", samples, target.tag_suffix)
+        
+        # Calculate quality scores
+        with stage("scoring"):
+            quality_scores = self.get_quality_scores(ping_metrics, http_metrics)
+        if quality_scores:
+            all_metrics.update(quality_scores)
+            overall_score = quality_scores.get("quality_overall_score", 0)
+            log(f"Quality: {overall_score:.1f}/100 overall score")
+        
+        # Record measured and derived values locally; trends can be recomputed from them
+        if self.store:
+            with stage("store"):
+                self.store_metrics(target, all_metrics)
+        
+        # Calculate trends
+        with stage("trends"):
+            trends = self.calculate_trends(all_metrics, target)
+        if trends:
+            all_metrics.update(trends)
+        
+        # Send Service Checks (replaces connectivity metric)
+        with stage("service_checks"):
+            service_checks_sent = self.send_service_checks(ping_metrics, quality_scores, http_metrics, target)
+        
+        # Send regular metrics (excluding connectivity)
+        if all_metrics and not self.dogstatsd_enabled:
+            log(f"Collected {len(all_metrics)} metrics for the Prometheus exporter")
+        elif all_metrics:
+            with stage("emit"):
+                metrics_sent = 0
+                for metric_name, value in all_metrics.items():
+                    if isinstance(value, (int, float)) and not (value != value):
+                        self.send_metric(f"starlink.{metric_name}", value, target=target)
+                        metrics_sent += 1
+                
+                # Send total counts
+                self.send_metric("starlink.total_metrics", len(all_metrics), target=target)
+                self.send_metric("starlink.service_checks_sent", service_checks_sent, target=target)
+            
+            log(f"Successfully sent {metrics_sent} metrics and {service_checks_sent} service checks to Datadog")
+        else:
+            self.send_service_check("starlink.connectivity", 3, "No metrics collected - service unknown", target=target)
+            logger.warning(f"No metrics collected from {target.ip}")
+        
+        if self.exporter:
+            self.exporter.update(target.ip, target.labels, all_metrics, target.check_states)
     
     def run(self):
         logger.info("Starting Enhanced Starlink Metrics Collector v2.1 with Service Checks...")
+        logger.info(f"Probe intervals - ping: {self.ping_interval}s, http: {self.http_interval}s, speed: {self.speed_interval}s")
+        if self.adaptive_probing:
+            logger.info(f"Adaptive ping interval - degraded: {self.ping_interval_degraded}s, healthy: {self.ping_interval_healthy}s")
+        
+        self.instrumentation.install_signal_handlers()
+        self.scheduler.start()
+        if self.continuous:
+            self.continuous.start()
+            logger.info(f"Continuous probing at {self.continuous_probe_hz:g} Hz, outage after {self.outage_threshold} consecutive losses")
+        if self.path:
+            self.path.start()
+            segments = ", ".join(f"{target.segment} {target.address or 'auto'}" for target in self.path.targets)
+            logger.info(f"Path probing {segments} at {self.path_packets_per_minute:g} packets/min")
+        if self.exporter:
+            self.exporter.start()
+        if not self.dogstatsd_enabled:
+            logger.info("DogStatsD output disabled")
+        # Emits happen on a fixed monotonic grid so work done in a cycle never shifts the next one
+        next_emit = time.monotonic() + self.collection_interval
+        last_emit = None
+        first_cycle = True
+        consecutive_errors = 0
         
         while True:
             try:
-                all_metrics = {}
-                
-                # Collect ping metrics
-                ping_metrics = self.get_enhanced_ping_metrics()
-                if ping_metrics:
-                    all_metrics.update(ping_metrics)
-                    avg_ping = ping_metrics.get("ping_avg_ms", 0)
-                    success_rate = ping_metrics.get("ping_success_rate", 0)
-                    mdev = ping_metrics.get("ping_mdev_ms", 0)
-                    logger.info(f"Ping: {avg_ping:.1f}ms avg, {mdev:.1f}ms jitter, {success_rate:.1f}% success")
+                next_probe = self.scheduler.dispatch()
                 
-                # Collect HTTP metrics
-                http_metrics = self.get_http_performance_metrics()
-                if http_metrics:
-                    all_metrics.update(http_metrics)
-                    ttfb = http_metrics.get("http_time_to_first_byte_ms", 0)
-                    http_speed = http_metrics.get("http_download_speed_mbps", 0)
-                    logger.info(f"HTTP: {ttfb:.1f}ms TTFB, {http_speed:.2f} Mbps")
-                
-                # Collect speed metrics
-                speed_metrics = self.get_speed_estimate()
-                if speed_metrics:
-                    all_metrics.update(speed_metrics)
-                    est_speed = speed_metrics.get("estimated_download_mbps", 0)
-                    consistency = speed_metrics.get("download_speed_consistency", 0)
-                    logger.info(f"Speed: {est_speed:.2f} Mbps avg, {consistency:.1f}% consistency")
-                
-                # Calculate quality scores
-                quality_scores = self.get_quality_scores(ping_metrics, http_metrics)
-                if quality_scores:
-                    all_metrics.update(quality_scores)
-                    overall_score = quality_scores.get("quality_overall_score", 0)
-                    logger.info(f"Quality: {overall_score:.1f}/100 overall score")
-                
-                # Calculate trends
-                trends = self.calculate_trends(all_metrics)
-                if trends:
-                    all_metrics.update(trends)
-                
-                # Send Service Checks (replaces connectivity metric)
-                self.send_service_checks(ping_metrics, quality_scores, http_metrics)
-                service_checks_sent = 4  # connectivity, performance, latency, stability
-                
-                # Send regular metrics (excluding connectivity)
-                if all_metrics:
-                    metrics_sent = 0
-                    for metric_name, value in all_metrics.items():
-                        if isinstance(value, (int, float)) and not (value != value):
-                            self.send_metric(f"starlink.{metric_name}", value)
-                            metrics_sent += 1
-                    
-                    # Send total counts
-                    self.send_metric("starlink.total_metrics", len(all_metrics))
-                    self.send_metric("starlink.service_checks_sent", service_checks_sent)
-                    
-                    logger.info(f"Successfully sent {metrics_sent} metrics and {service_checks_sent} service checks to Datadog")
-                else:
-                    self.send_service_check("starlink.connectivity", 3, "No metrics collected - service unknown")
-                    logger.warning("No metrics collected")
+                # Emit on the collection interval, or as soon as every probe has reported once
+                now = time.monotonic()
+                if now >= next_emit or (first_cycle and self.scheduler.all_reported()):
+                    first_cycle = False
+                    with self.instrumentation.stage("cycle"):
+                        for target in self.targets:
+                            self.collect_cycle(target)
+                            if self.adaptive_probing:
+                                self.adapt_probe_rate(target)
+                        if self.path:
+                            with self.instrumentation.stage("path"):
+                                self.collect_path()
+                        if self.exporter:
+                            # Rendered once per cycle; scrapes are served from this buffer
+                            with self.instrumentation.stage("publish"):
+                                self.exporter.publish()
+                        with self.instrumentation.stage("flush"):
+                            self.emitter.flush()
+                    if self.self_metrics:
+                        drift = now - last_emit - self.collection_interval if last_emit is not None else 0.0
+                        self.instrumentation.emit(self.scheduler, max(0.0, now - next_emit), drift)
+                        self.emitter.flush()
+                    if self.fleet_mode:
+                        logger.info(f"Emitted cycle for {len(self.targets)} targets")
+                    last_emit = now
+                    if now >= next_emit:
+                        # Skip any ticks that were missed rather than emitting them back to back
+                        missed = int((now - next_emit) // self.collection_interval)
+                        next_emit += (missed + 1) * self.collection_interval
+                    consecutive_errors = 0
                 
-                time.sleep(self.collection_interval)
+                self.scheduler.wait(min(next_probe, next_emit - time.monotonic()))
                 
             except KeyboardInterrupt:
                 logger.info("Shutting down enhanced collector...")
+                self.scheduler.shutdown()
+                if self.continuous:
+                    self.continuous.stop()
+                if self.path:
+                    self.path.stop()
+                if self.exporter:
+                    self.exporter.stop()
                 break
             except Exception as e:
-                logger.error(f"Collection error: {e}")
-                self.send_service_check("starlink.connectivity", 2, f"Collection error: {str(e)}")
-                time.sleep(30)
+                # Back off 1s, 2s, 4s ... up to one interval; the emit grid is unaffected
+                consecutive_errors += 1
+                backoff = min(self.collection_interval, 2 ** (consecutive_errors - 1))
+                logger.error(f"Collection error: {e} - retrying in {backoff}s")
+                self.instrumentation.errors += 1
+                self.instrumentation.penalty_seconds += backoff
+                # Per target, so the state is recorded and the next good cycle sends the recovery
+                for target in self.targets:
+                    self.send_service_check("starlink.connectivity", 2, f"Collection error: {str(e)}", target=target)
+                    target.check_sent["starlink.connectivity"] = time.monotonic()
+                self.emitter.flush()
+                time.sleep(backoff)
 
-if __name__ == "__main__":
+def parse_time(text, now):
+    """Epoch seconds, or a duration such as 7d meaning that long before now"""
+    try:
+        value = float(text)
+    except ValueError:
+        return now - parse_duration(text)
+    return value if value > 1e9 else now - value
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Starlink metrics collector")
+    commands = parser.add_subparsers(dest="command")
+    commands.add_parser("run", help="collect and emit metrics (default)")
+    
+    query = commands.add_parser("query", help="aggregate a metric from the local store")
+    query.add_argument("metric", nargs="?", help="metric name without the starlink. prefix; omit to list metrics")
+    query.add_argument("--agg", default="avg", help="count, sum, avg, min, max, last or a percentile like p95")
+    query.add_argument("--since", default="1d", help="start: duration before now (7d) or epoch seconds")
+    query.add_argument("--until", default="0s", help="end: duration before now or epoch seconds")
+    query.add_argument("--target", default=os.getenv("STARLINK_IP", "192.168.1.1"))
+    query.add_argument("--store", default=os.getenv("METRIC_STORE_DIR"))
+    
+    replay = commands.add_parser("replay", help="resend stored metrics to DogStatsD with their timestamps")
+    replay.add_argument("--since", default="1d")
+    replay.add_argument("--until", default="0s")
+    replay.add_argument("--target", default=os.getenv("STARLINK_IP", "192.168.1.1"))
+    replay.add_argument("--store", default=os.getenv("METRIC_STORE_DIR"))
+    replay.add_argument("--rate", type=float, default=200, help="maximum datagrams per second")
+    
+    recompute = commands.add_parser("recompute", help="recompute derived metrics from recorded probe results")
+    recompute.add_argument("--since", default="1d")
+    recompute.add_argument("--until", default="0s")
+    recompute.add_argument("--target", default=os.getenv("STARLINK_IP", "192.168.1.1"))
+    recompute.add_argument("--record", default=os.getenv("RECORD_DIR"))
+    recompute.add_argument("--interval", type=float, default=float(os.getenv("COLLECTION_INTERVAL", "60")), help="emit grid in seconds")
+    recompute.add_argument("--metrics", default="*", help="comma-separated glob patterns of metrics to output")
+    recompute.add_argument("--csv", help="write a CSV file instead of backfilling DogStatsD")
+    recompute.add_argument("--rate", type=float, default=200, help="maximum datagrams per second")
+    
+    args = parser.parse_args(argv)
+    
+    if args.command == "recompute":
+        if not args.record:
+            parser.error("--record or RECORD_DIR is required")
+        if np is None:
+            parser.error("recompute requires numpy (pip install numpy)")
+        now = time.time()
+        collector = EnhancedStarlinkCollector()
+        collector.recorder = ProbeRecorder(args.record)
+        collector.recompute_capture(
+            args.target, parse_time(args.since, now), parse_time(args.until, now), args.interval,
+            tuple(pattern.strip() for pattern in args.metrics.split(",")), args.csv, args.rate,
+        )
+        return 0
+    
+    if args.command in ("query", "replay"):
+        if not args.store:
+            parser.error("--store or METRIC_STORE_DIR is required")
+        now = time.time()
+        start, end = parse_time(args.since, now), parse_time(args.until, now)
+        store = MetricStore(args.store)
+        
+        if args.command == "query":
+            if not args.metric:
+                for metric in store.metrics(args.target):
+                    print(metric)
+                return 0
+            started = time.perf_counter()
+            value = store.aggregate(args.target, args.metric, args.agg, start, end)
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            print(f"{args.agg}({args.metric}) = {value if value is not None else 'no data'} [{elapsed_ms:.1f} ms]")
+            return 0
+        
+        collector = EnhancedStarlinkCollector()
+        collector.store = store
+        collector.replay_store(args.target, start, end, args.rate)
+        return 0
+    
     collector = EnhancedStarlinkCollector()
     collector.run()
+    return 0
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,62 @@
+"""Prometheus /metrics scrapes: gzip and identity bodies with their own validators"""
+import gzip
+import http.client
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from starlink_collector import PrometheusExporter  # noqa: E402
+
+class ExporterScrapeTest(unittest.TestCase):
+    def setUp(self):
+        self.exporter = PrometheusExporter("127.0.0.1", 0)
+        self.exporter.update("dish", PrometheusExporter.build_labels(["starlink_ip:192.168.1.1"]),
+                             {"ping_avg_ms": 31.5}, {"starlink.connectivity": 0}, timestamp=1.7e9)
+        self.exporter.publish()
+        self.exporter.start()
+
+    def tearDown(self):
+        self.exporter.stop()
+
+    def scrape(self, **headers):
+        conn = http.client.HTTPConnection("127.0.0.1", self.exporter.server.server_address[1], timeout=5)
+        try:
+            conn.request("GET", "/metrics", headers=headers)
+            response = conn.getresponse()
+            return response.status, dict(response.getheaders()), response.read()
+        finally:
+            conn.close()
+
+    def test_gzip_copy_has_its_own_etag(self):
+        status, plain_headers, plain = self.scrape()
+        self.assertEqual(status, 200)
+        self.assertIn(b'starlink_ping_avg_ms{starlink_ip="192.168.1.1"} 31.5', plain)
+        status, gzip_headers, compressed = self.scrape(**{"Accept-Encoding": "gzip"})
+        self.assertEqual(status, 200)
+        self.assertEqual(gzip_headers["Content-Encoding"], "gzip")
+        self.assertEqual(gzip.decompress(compressed), plain)
+        self.assertNotEqual(gzip_headers["ETag"], plain_headers["ETag"])
+        self.assertEqual(plain_headers["Vary"], "Accept-Encoding")
+        self.assertEqual(gzip_headers["Vary"], "Accept-Encoding")
+
+        # Each validator only matches its own representation
+        status, headers, _ = self.scrape(**{"Accept-Encoding": "gzip", "If-None-Match": gzip_headers["ETag"]})
+        self.assertEqual((status, headers["ETag"], headers["Vary"]), (304, gzip_headers["ETag"], "Accept-Encoding"))
+        status, _, body = self.scrape(**{"If-None-Match": gzip_headers["ETag"]})
+        self.assertEqual((status, body), (200, plain))
+        status, _, body = self.scrape(**{"Accept-Encoding": "gzip", "If-None-Match": plain_headers["ETag"]})
+        self.assertEqual((status, body), (200, compressed))
+
+    def test_new_body_changes_etag(self):
+        _, before, _ = self.scrape()
+        self.exporter.update("dish", PrometheusExporter.build_labels(["starlink_ip:192.168.1.1"]),
+                             {"ping_avg_ms": 40.0}, {"starlink.connectivity": 0}, timestamp=1.7e9 + 60)
+        self.exporter.publish()
+        status, after, _ = self.scrape(**{"If-None-Match": before["ETag"]})
+        self.assertEqual(status, 200)
+        self.assertNotEqual(after["ETag"], before["ETag"])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,78 @@
+"""SIGUSR1 profiling while probe workers are running
+
+The profiler is toggled on and off around scheduled probes on two worker
+threads. The probes must keep reporting throughout, and the dump must cover
+both workers. Run it on 3.11 (one profiler per thread) and on 3.12 or later
+(one process-wide profiler on sys.monitoring).
+"""
+import os
+import pstats
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import starlink_collector  # noqa: E402
+from starlink_collector import CollectorInstrumentation, ProbeScheduler  # noqa: E402
+
+def busy_probe_a():
+    return sum(i * i for i in range(20000))
+
+def busy_probe_b():
+    return sum(i * i for i in range(20000))
+
+class ProfilerToggleTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.instrumentation = CollectorInstrumentation(None, self.tmp.name)
+        self.scheduler = ProbeScheduler(max_workers=2)
+        self.scheduler.add_probe("a", busy_probe_a, 0.02, 1.0)
+        self.scheduler.add_probe("b", busy_probe_b, 0.02, 1.0)
+        self.scheduler.profile_hook = self.instrumentation.profile_thread
+        self.scheduler.start()
+
+    def tearDown(self):
+        self.scheduler.shutdown()
+        self.tmp.cleanup()
+
+    def run_for(self, seconds):
+        """Dispatch probes for a while; returns how many runs finished"""
+        finished = len(self.scheduler.timings)
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            self.scheduler.wait(min(self.scheduler.dispatch(), deadline - time.monotonic()))
+        return len(self.scheduler.timings) - finished
+
+    def test_probes_keep_running_and_dump_covers_workers(self):
+        self.run_for(0.2)
+        # A worker whose profiler fails to start logs the failure; none may
+        with self.assertNoLogs(starlink_collector.logger, "WARNING"):
+            self.instrumentation.toggle_profiler()
+            try:
+                self.assertGreater(self.run_for(0.5), 10)
+            finally:
+                self.instrumentation.toggle_profiler()
+        self.assertIsNotNone(self.scheduler.latest("a"))
+        self.assertIsNotNone(self.scheduler.latest("b"))
+        # Probing carries on after the dump too
+        self.assertGreater(self.run_for(0.3), 5)
+
+        dumps = [name for name in os.listdir(self.tmp.name) if name.endswith(".pstats")]
+        self.assertEqual(len(dumps), 1)
+        functions = {function for _, _, function in pstats.Stats(os.path.join(self.tmp.name, dumps[0])).stats}
+        self.assertIn("busy_probe_a", functions)
+        self.assertIn("busy_probe_b", functions)
+        self.assertIsNone(sys.getprofile())
+
+    def test_failing_hook_does_not_fail_probes(self):
+        def broken_hook():
+            raise ValueError("Another profiling tool is already active")
+
+        self.scheduler.profile_hook = broken_hook
+        self.assertGreater(self.run_for(0.3), 5)
+        self.assertEqual(self.scheduler.latest("a"), busy_probe_a())
+
+if __name__ == "__main__":
+    unittest.main()
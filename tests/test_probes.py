@@ -0,0 +1,315 @@
+"""In-process probes against loopback: ICMP and UDP echo, HTTP throughput and path probing
+
+Everything runs against 127.0.0.0/8 and servers started by the tests, so no
+network access is needed. The ICMP tests are skipped where the kernel does
+not allow unprivileged ICMP sockets (net.ipv4.ping_group_range).
+"""
+import http.server
+import math
+import os
+import socket
+import sys
+import threading
+import time
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import starlink_collector  # noqa: E402
+from starlink_collector import (  # noqa: E402
+    ContinuousProber, HttpConnectionPool, HttpTimingProbe, IcmpProber, PathProber, ThroughputTest,
+)
+
+def icmp_allowed():
+    try:
+        socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_ICMP).close()
+    except OSError:
+        return False
+    return True
+
+# Sending to the limited broadcast address without SO_BROADCAST fails locally,
+# which the probers count as a lost probe, so it stands in for an unreachable
+# host without depending on the routes of the machine running the tests
+UNREACHABLE = "255.255.255.255"
+
+_socket = socket.socket
+
+def udp_only_socket(family=socket.AF_INET, kind=socket.SOCK_DGRAM, proto=0, *args):
+    """socket.socket that refuses ICMP, to make IcmpProber fall back to UDP echo"""
+    if proto == socket.IPPROTO_ICMP:
+        raise PermissionError("ICMP sockets not permitted")
+    return _socket(family, kind, proto, *args)
+
+class UdpEchoServer:
+    """Echoes every datagram back to its sender, like the RFC 862 echo service"""
+
+    def __init__(self, host="127.0.0.1"):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind((host, 0))
+        self.sock.settimeout(0.1)
+        self.port = self.sock.getsockname()[1]
+        self.received = 0
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self._loop, daemon=True)
+        self.thread.start()
+
+    def _loop(self):
+        while not self.stop_event.is_set():
+            try:
+                data, address = self.sock.recvfrom(2048)
+            except socket.timeout:
+                continue
+            self.received += 1
+            self.sock.sendto(data, address)
+
+    def close(self):
+        self.stop_event.set()
+        self.thread.join()
+        self.sock.close()
+
+def link_local_address():
+    """(address, interface) of an IPv6 link-local address from /proc/net/if_inet6, or None"""
+    try:
+        with open("/proc/net/if_inet6") as f:
+            for line in f:
+                address, _, _, scope, _, interface = line.split()
+                if scope == "20" and interface != "lo":
+                    return socket.inet_ntop(socket.AF_INET6, bytes.fromhex(address)), interface
+    except (OSError, ValueError):
+        pass
+    return None
+
+class BlobHandler(http.server.BaseHTTPRequestHandler):
+    """Serves BODY on every GET over HTTP/1.1 keep-alive; idle connections close after timeout"""
+    protocol_version = "HTTP/1.1"
+    BODY = bytes(1024 * 1024)
+    timeout = 0.5
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(len(self.BODY)))
+        self.end_headers()
+        self.wfile.write(self.BODY)
+
+    def log_message(self, format, *args):
+        pass
+
+class BlobServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Streams still reading when a throughput test ends close with a reset
+        pass
+
+@unittest.skipUnless(icmp_allowed(), "unprivileged ICMP sockets are not permitted")
+class IcmpBurstTest(unittest.TestCase):
+    def test_burst_to_loopback(self):
+        prober = IcmpProber()
+        try:
+            self.assertEqual(prober.mode, "icmp")
+            samples, sent, received = prober.burst("127.0.0.1", 5, 0.02, 1.0)
+        finally:
+            prober.close()
+        self.assertEqual((sent, received), (5, 5))
+        self.assertEqual(len(samples), 5)
+        self.assertTrue(all(0 < rtt < 100 for rtt in samples))
+        self.assertEqual(prober.pending, {})
+
+    def test_burst_loses_probes_without_reply(self):
+        prober = IcmpProber()
+        try:
+            samples, sent, received = prober.burst(UNREACHABLE, 3, 0.01, 0.2)
+        finally:
+            prober.close()
+        self.assertEqual((samples, sent, received), ([], 3, 0))
+        self.assertEqual(prober.pending, {})
+
+class UdpEchoBurstTest(unittest.TestCase):
+    def setUp(self):
+        self.server = UdpEchoServer()
+        with mock.patch.object(starlink_collector.socket, "socket", udp_only_socket):
+            self.prober = IcmpProber(udp_echo_port=self.server.port)
+
+    def tearDown(self):
+        self.prober.close()
+        self.server.close()
+
+    def test_burst_to_echo_server(self):
+        self.assertEqual(self.prober.mode, "udp")
+        samples, sent, received = self.prober.burst("127.0.0.1", 5, 0.02, 1.0)
+        self.assertEqual((sent, received), (5, 5))
+        self.assertEqual(self.server.received, 5)
+        self.assertTrue(all(0 < rtt < 100 for rtt in samples))
+
+    def test_ignores_replies_for_another_ident(self):
+        seq = self.prober.send("127.0.0.1")
+        # A reply carrying a foreign identifier must not complete the probe
+        other = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            other.sendto(starlink_collector.struct.pack("!HH", (self.prober.ident + 1) & 0xFFFF, seq),
+                         self.prober.sock.getsockname())
+        finally:
+            other.close()
+        replies = []
+        deadline = time.monotonic() + 1.0
+        while len(replies) < 1 and time.monotonic() < deadline:
+            replies += self.prober.poll(deadline - time.monotonic())
+        self.assertEqual([reply[:2] for reply in replies], [(seq, "127.0.0.1")])
+
+class ThroughputLoopbackTest(unittest.TestCase):
+    def setUp(self):
+        self.server = BlobServer(("127.0.0.1", 0), BlobHandler)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}/blob"
+        self.pool = HttpConnectionPool()
+
+    def tearDown(self):
+        self.pool.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def run_test(self):
+        test = ThroughputTest(self.pool, streams=2, duration=0.6, sample_interval=0.1, omit=0.2, timeout=5)
+        return test.run(self.url)
+
+    def test_download(self):
+        result = self.run_test()
+        self.assertEqual(result["errors"], 0)
+        self.assertGreater(result["bytes"], len(BlobHandler.BODY))
+        self.assertGreater(result["mbps"], 0)
+        self.assertLessEqual(result["min_mbps"], result["mbps"])
+        self.assertLessEqual(result["mbps"], result["max_mbps"])
+
+    def test_stale_pooled_connection_is_retried(self):
+        timings = HttpTimingProbe(self.pool, timeout=5).measure(self.url)
+        self.assertEqual(timings["size"], len(BlobHandler.BODY))
+        self.assertEqual(len(self.pool.idle[("http", "127.0.0.1", self.server.server_address[1])]), 1)
+        # Let the server close the idle keep-alive connection the probe left in the pool
+        time.sleep(BlobHandler.timeout * 2)
+        result = self.run_test()
+        self.assertEqual(result["errors"], 0)
+        self.assertGreater(result["bytes"], 0)
+
+    def test_buffers_are_reused(self):
+        probe = HttpTimingProbe(self.pool, timeout=5)
+        probe.measure(self.url)
+        view = probe.local.view
+        self.assertEqual(probe.measure(self.url)["size"], len(BlobHandler.BODY))
+        self.assertIs(probe.local.view, view)
+
+        test = ThroughputTest(self.pool, streams=2, duration=0.3, sample_interval=0.1, omit=0.1, timeout=5)
+        test.run(self.url)
+        views = test.local.views
+        self.assertGreater(test.run(self.url)["bytes"], 0)
+        self.assertIs(test.local.views, views)
+
+    def test_rejects_other_schemes(self):
+        with self.assertRaises(ValueError):
+            ThroughputTest(self.pool).run("ftp://127.0.0.1/blob")
+
+@unittest.skipUnless(link_local_address(), "no IPv6 link-local address")
+class LinkLocalHttpTest(unittest.TestCase):
+    """An IPv6 link-local target only connects with the scope id of its sockaddr"""
+
+    def setUp(self):
+        address, self.interface = link_local_address()
+
+        class Server(BlobServer):
+            address_family = socket.AF_INET6
+
+        self.server = Server((address, 0, 0, socket.if_nametoindex(self.interface)), BlobHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = f"http://[{address}%{self.interface}]:{self.server.server_address[1]}/blob"
+        self.pool = HttpConnectionPool()
+
+    def tearDown(self):
+        self.pool.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_timing_probe(self):
+        timings = HttpTimingProbe(self.pool, timeout=5).measure(self.url, fresh=True)
+        self.assertEqual((timings["status"], timings["size"]), (200, len(BlobHandler.BODY)))
+
+    def test_throughput(self):
+        test = ThroughputTest(self.pool, streams=1, duration=0.3, sample_interval=0.1, omit=0.1, timeout=5)
+        result = test.run(self.url)
+        self.assertEqual(result["errors"], 0)
+        self.assertGreater(result["bytes"], 0)
+
+class ContinuousOutageTest(unittest.TestCase):
+    def setUp(self):
+        self.events = []
+        self.prober = ContinuousProber(rate_hz=10, outage_threshold=5, on_outage=lambda *event: self.events.append(event))
+        self.prober.add_target("dish", "127.0.0.1")
+        self.state = self.prober.by_key["dish"]
+
+    def feed(self, start, outcomes):
+        """Record one probe per tick from start; outcomes is a string of r (reply) and l (lost)"""
+        for i, outcome in enumerate(outcomes):
+            self.prober._record(self.state, start + i * 0.1, 5.0 if outcome == "r" else math.nan)
+
+    def test_outage_reported_when_it_starts_and_when_it_ends(self):
+        self.feed(1000.0, "rr" + "l" * 5)
+        # Reported while still going, without waiting for a reply
+        self.assertEqual(len(self.events), 1)
+        key, start, duration, lost, ended = self.events[0]
+        self.assertEqual((key, start, lost, ended), ("dish", 1000.2, 5, False))
+        self.assertAlmostEqual(duration, 0.5)
+
+        self.feed(1000.7, "l" * 10 + "r")
+        self.assertEqual(len(self.events), 2)
+        key, start, duration, lost, ended = self.events[1]
+        self.assertEqual((key, start, lost, ended), ("dish", 1000.2, 15, True))
+        self.assertAlmostEqual(duration, 1.5)
+        metrics = self.prober.drain("dish")
+        self.assertEqual(metrics["outage_count"], 1)
+        self.assertAlmostEqual(metrics["outage_seconds"], 1.5)
+
+    def test_short_runs_are_microdrops(self):
+        self.feed(1000.0, "rllllrlr")
+        self.assertEqual(self.events, [])
+        self.assertEqual(self.prober.drain("dish")["microdrop_count"], 2)
+
+@unittest.skipUnless(icmp_allowed(), "unprivileged ICMP sockets are not permitted")
+class PathProberLoopbackTest(unittest.TestCase):
+    def test_drain_deltas(self):
+        prober = PathProber(
+            [("lan", "127.0.0.1"), ("dish", "127.0.0.2"), ("dish", "127.0.0.3"), ("internet", UNREACHABLE)],
+            packets_per_minute=1200, reply_timeout=0.2,
+        )
+        prober.start()
+        time.sleep(1.5)
+        prober.stop()
+        prober.thread.join(5)
+        self.assertFalse(prober.thread.is_alive())
+
+        results = {address: (index, segment, metrics) for index, segment, address, metrics in prober.drain()}
+        self.assertEqual(set(results), {"127.0.0.1", "127.0.0.2", "127.0.0.3", UNREACHABLE})
+        self.assertEqual([results[address][:2] for address in ("127.0.0.1", "127.0.0.2", "127.0.0.3", UNREACHABLE)],
+                         [(0, "lan"), (1, "dish"), (2, "dish"), (3, "internet")])
+
+        lan = results["127.0.0.1"][2]
+        self.assertEqual(lan["path_loss_pct"], 0)
+        self.assertEqual(lan["path_rtt_delta_ms"], lan["path_rtt_avg_ms"])
+        self.assertLessEqual(lan["path_rtt_min_ms"], lan["path_rtt_avg_ms"])
+        # Both dish targets compare against the LAN, not against each other
+        for address in ("127.0.0.2", "127.0.0.3"):
+            metrics = results[address][2]
+            self.assertEqual(metrics["path_loss_pct"], 0)
+            self.assertAlmostEqual(metrics["path_rtt_delta_ms"], metrics["path_rtt_avg_ms"] - lan["path_rtt_avg_ms"])
+
+        internet = results[UNREACHABLE][2]
+        self.assertGreater(internet["path_probes_sent"], 0)
+        self.assertEqual(internet["path_loss_pct"], 100)
+        self.assertEqual(internet["path_loss_delta_pct"], 100)
+        self.assertNotIn("path_rtt_avg_ms", internet)
+
+        # Counters restart after each drain
+        self.assertEqual(prober.drain(), [])
+
+if __name__ == "__main__":
+    unittest.main()
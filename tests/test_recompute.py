@@ -0,0 +1,188 @@
+"""BatchRecompute must reproduce what the live collector derives from the same probe results
+
+The capture is written through the live probe methods with fake probes, and
+each emit is replayed through the live per-cycle code: pooled ping statistics,
+RuleEngine.score, RuleCheck.evaluate with the previous state and
+TrendEngine.update. The batch columns must match row for row.
+"""
+import math
+import os
+import random
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import starlink_collector  # noqa: E402
+from starlink_collector import EnhancedStarlinkCollector, np  # noqa: E402
+
+def f32(value):
+    """Round to float32, the precision the recorder stores, so both sides see the same inputs"""
+    return float(np.float32(value))
+
+class FakeProber:
+    mode = "fake"
+
+    def __init__(self, rng):
+        self.rng = rng
+
+    def burst(self, host, count, interval, timeout):
+        base = self.rng.choice((4, 15, 35, 70))
+        rtts = [f32(self.rng.uniform(base, base * 1.5)) for _ in range(count)]
+        lost = self.rng.choice((0, 0, 0, 1, 3, count))
+        rtts = rtts[:count - lost]
+        return rtts, count, len(rtts)
+
+class FakeHttpProbe:
+    def __init__(self, rng):
+        self.rng = rng
+
+    def measure(self, url, fresh=False, max_duration=None):
+        if not fresh and self.rng.random() < 0.3:
+            return {"reused": False, "dns": 0.0, "connect": 0.0, "tls": 0.0, "starttransfer": 0.0, "total": 0.0, "size": 0, "status": 0}
+        starttransfer = f32(self.rng.uniform(0.002, 0.2))
+        return {
+            "reused": not fresh, "dns": f32(self.rng.uniform(0, 0.01)), "connect": f32(self.rng.uniform(0.001, 0.05)),
+            "tls": 0.0, "starttransfer": starttransfer, "total": f32(starttransfer + self.rng.uniform(0.001, 0.1)),
+            "size": 1842, "status": 200,
+        }
+
+class FakeThroughput:
+    def __init__(self, rng):
+        self.rng = rng
+
+    def run(self, url, upload=False):
+        low = self.rng.uniform(10, 100)
+        high = low + self.rng.uniform(0, 100)
+        return {"mbps": (low + high) / 2, "max_mbps": high, "min_mbps": low, "bytes": float(self.rng.randint(1, 10 ** 8)), "errors": 0}
+
+@unittest.skipIf(np is None, "recompute needs numpy")
+class BatchRecomputeEquivalenceTest(unittest.TestCase):
+    ROWS = 400
+    INTERVAL = 60.0
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        env = {
+            "RECORD_DIR": self.directory.name,
+            "CONTINUOUS_PROBE_HZ": "0",
+            "COLLECTOR_SELF_METRICS": "false",
+            "DOGSTATSD_ENABLED": "false",
+            "PING_INTERVAL": "20",
+            "HTTP_INTERVAL": "150",
+            "SPEED_INTERVAL": "600",
+            "TREND_METRICS": "*",
+            "TREND_HORIZONS": "10m,1h,6h",
+        }
+        with mock.patch.dict(os.environ, env):
+            self.collector = EnhancedStarlinkCollector()
+        rng = random.Random(7)
+        self.rng = rng
+        self.collector.get_prober = lambda: FakeProber(rng)
+        self.collector.http_probe = FakeHttpProbe(rng)
+        self.collector.throughput = FakeThroughput(rng)
+
+    def tearDown(self):
+        self.collector.scheduler.shutdown()
+        self.directory.cleanup()
+
+    def at(self, timestamp, probe, *args):
+        with mock.patch.object(starlink_collector.time, "time", return_value=timestamp):
+            return probe(*args)
+
+    def live(self, start):
+        """Run the probes and the per-emit derivations the way run() does, row by row"""
+        collector = self.collector
+        target = collector.targets[0]
+        max_ages = {
+            "http": 2 * collector.http_interval + collector.http_timeout,
+            "speed": 2 * collector.speed_interval + collector.speed_timeout,
+        }
+        latest = {"http": None, "speed": None}
+        next_run = {"ping": start + 1, "http": start + 2, "speed": start + 3}
+        rows = []
+        for row in range(self.ROWS):
+            now = start + row * self.INTERVAL
+            # Probe runs due since the previous emit; ping gaps sometimes outlast an emit
+            while next_run["ping"] <= now:
+                self.at(next_run["ping"], collector.get_enhanced_ping_metrics, target)
+                next_run["ping"] += self.rng.choice((5, 20, 20, 45, 130))
+            for kind, probe, every in (("http", collector.get_http_performance_metrics, 150), ("speed", collector.get_speed_estimate, 600)):
+                while next_run[kind] <= now:
+                    latest[kind] = (next_run[kind], self.at(next_run[kind], probe, target.ip))
+                    next_run[kind] += every * self.rng.choice((0.5, 1, 1, 3))
+
+            fresh = {kind: result for kind, (stamp, result) in ((k, v) for k, v in latest.items() if v) if now - stamp <= max_ages[kind]}
+            with mock.patch.object(collector.scheduler, "latest", return_value=True):
+                ping = collector.pooled_ping_metrics(target)
+            http = fresh.get("http")
+            scores = collector.get_quality_scores(ping, http)
+            values = {**(ping or {}), **(http or {}), **(scores or {})}
+            checks = {}
+            for check in collector.rules.checks:
+                result = check.evaluate(values, target.check_states.get(check.name))
+                checks[check.name] = -1 if result is None else result[0]
+                if result is not None:
+                    target.check_states[check.name] = result[0]
+            metrics = {**(ping or {}), **(http or {}), **(fresh.get("speed") or {}), **(scores or {})}
+            trends = target.trends.update(metrics, now=now)
+            rows.append((now, {**metrics, **trends}, checks))
+        return rows
+
+    def test_matches_live_cycles(self):
+        # The live trend engine counts time from when it was created; start the history off any slot boundary
+        start = self.collector.targets[0].trends.start + 37.3
+        rows = self.live(start)
+        collector = self.collector
+        recompute = starlink_collector.BatchRecompute(
+            collector.rules, collector.trend_horizons, collector.trend_metrics, collector.trend_slots, collector.trend_ewma_alpha,
+            max_ages={"ping": math.inf, "http": 2 * collector.http_interval + collector.http_timeout,
+                      "speed": 2 * collector.speed_interval + collector.speed_timeout},
+        )
+        times, columns, checks = recompute.run(
+            collector.recorder.load(collector.targets[0].ip), self.INTERVAL, start, start + (self.ROWS - 1) * self.INTERVAL,
+        )
+        self.assertEqual(len(times), self.ROWS)
+        # Batch window sums come from prefix-sum differences, so allow rounding relative to the column's scale
+        scales = {name: max(1.0, float(np.nanmax(np.abs(column)))) for name, column in columns.items() if not np.isnan(column).all()}
+        first_horizon = collector.trend_horizons[0][0]
+
+        def ill_conditioned(name, row):
+            # trend_pct divides by the window mean; at rounding level both sides are noise
+            if not name.endswith("_trend_pct"):
+                return False
+            base = name[:-len("_trend_pct")]
+            mean = columns[f"{base}_mean_{first_horizon}"][row]
+            return abs(mean) <= 1e-9 * scales[base]
+
+        compared = 0
+        for row, (now, metrics, states) in enumerate(rows):
+            self.assertEqual(times[row], now)
+            for name, value in metrics.items():
+                if ill_conditioned(name, row):
+                    continue
+                self.assertIn(name, columns, name)
+                batch = columns[name][row]
+                # A volatility is the square root of a variance, which turns live rounding residue of
+                # a constant window (about 1e-12 of the value squared) into about 1e-6 of the value
+                base, volatility, _ = name.partition("_volatility")
+                tolerance = 1e-5 * scales[base] if volatility else 1e-7 * scales[name]
+                self.assertTrue(
+                    math.isclose(batch, value, rel_tol=1e-6, abs_tol=tolerance),
+                    f"row {row} {name}: batch {batch} live {value}",
+                )
+                compared += 1
+            # Nothing the live cycle left out may appear in the batch row
+            extra = [
+                name for name, column in columns.items()
+                if name not in metrics and not np.isnan(column[row]) and not ill_conditioned(name, row)
+            ]
+            self.assertEqual(extra, [], f"row {row}")
+            for name, status in states.items():
+                self.assertEqual(checks[name][row], status, f"row {row} {name}")
+        self.assertGreater(compared, self.ROWS * 50)
+
+if __name__ == "__main__":
+    unittest.main()